@@ -80,3 +80,463 @@ BEGIN
     UPDATE transaction_entry SET te_time = STATEMENT_TIMESTAMP(), dirty = true WHERE id = $1;
 END;
 $$ LANGUAGE plpgsql;
+
+--
+-- sale_summary maintenance, see SaleSummary in stoqlib/domain/sale.py
+--
+
+-- Adds the given values to the summary of the sale
+CREATE OR REPLACE FUNCTION sale_summary_add(sale_id uuid, subtotal numeric,
+                                            total_quantity numeric,
+                                            v_ipi numeric) RETURNS void AS $$
+BEGIN
+    IF $1 IS NULL THEN
+        RETURN;
+    END IF;
+    LOOP
+        UPDATE sale_summary
+           SET subtotal = sale_summary.subtotal + $2,
+               total_quantity = sale_summary.total_quantity + $3,
+               v_ipi = sale_summary.v_ipi + $4
+         WHERE sale_summary.sale_id = $1;
+        EXIT WHEN FOUND;
+        BEGIN
+            INSERT INTO sale_summary (sale_id, subtotal, total_quantity, v_ipi)
+                VALUES ($1, $2, $3, $4);
+            EXIT;
+        EXCEPTION WHEN unique_violation THEN
+            -- Inserted by a concurrent transaction, it will be updated
+            -- on the next iteration
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keeps sale_summary up to date when a sale_item is inserted/updated/deleted
+CREATE OR REPLACE FUNCTION sale_item_update_sale_summary() RETURNS trigger AS $$
+DECLARE
+    item_v_ipi numeric;
+BEGIN
+    IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+        SELECT COALESCE(v_ipi, 0) INTO item_v_ipi
+            FROM invoice_item_ipi WHERE id = OLD.ipi_info_id;
+        PERFORM sale_summary_add(
+            OLD.sale_id,
+            -COALESCE(OLD.quantity * OLD.price, 0),
+            -COALESCE(OLD.quantity, 0),
+            -COALESCE(item_v_ipi, 0));
+    END IF;
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+        SELECT COALESCE(v_ipi, 0) INTO item_v_ipi
+            FROM invoice_item_ipi WHERE id = NEW.ipi_info_id;
+        PERFORM sale_summary_add(
+            NEW.sale_id,
+            COALESCE(NEW.quantity * NEW.price, 0),
+            COALESCE(NEW.quantity, 0),
+            COALESCE(item_v_ipi, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keeps sale_summary up to date when the ipi of a sale_item changes
+CREATE OR REPLACE FUNCTION invoice_item_ipi_update_sale_summary() RETURNS trigger AS $$
+BEGIN
+    IF NEW.v_ipi IS DISTINCT FROM OLD.v_ipi THEN
+        PERFORM sale_summary_add(sale_item.sale_id, 0, 0,
+                                 COALESCE(NEW.v_ipi, 0) - COALESCE(OLD.v_ipi, 0))
+           FROM sale_item WHERE sale_item.ipi_info_id = NEW.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recreates the whole sale_summary from the sale items
+CREATE OR REPLACE FUNCTION rebuild_sale_summary() RETURNS void AS $$
+BEGIN
+    -- Wait for the transactions that changed the summaries and keep the
+    -- sale item triggers from changing them until this one is done
+    LOCK TABLE sale_summary IN EXCLUSIVE MODE;
+    DELETE FROM sale_summary;
+    INSERT INTO sale_summary (sale_id, subtotal, total_quantity, v_ipi)
+        SELECT sale_item.sale_id,
+               COALESCE(SUM(sale_item.quantity * sale_item.price), 0),
+               COALESCE(SUM(sale_item.quantity), 0),
+               COALESCE(SUM(invoice_item_ipi.v_ipi), 0)
+          FROM sale_item
+          LEFT JOIN invoice_item_ipi
+            ON invoice_item_ipi.id = sale_item.ipi_info_id
+         WHERE sale_item.sale_id IS NOT NULL
+         GROUP BY sale_item.sale_id;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- product_stock_summary maintenance, see ProductStockSummary in
+-- stoqlib/domain/product.py
+--
+
+-- Adds the given values to the stock summary of the storable on the branch
+CREATE OR REPLACE FUNCTION product_stock_summary_add(storable_id uuid,
+                                                     branch_id uuid,
+                                                     stock numeric,
+                                                     total_stock_cost numeric)
+    RETURNS void AS $$
+BEGIN
+    IF $1 IS NULL OR $2 IS NULL THEN
+        RETURN;
+    END IF;
+    LOOP
+        UPDATE product_stock_summary
+           SET stock = product_stock_summary.stock + $3,
+               total_stock_cost = product_stock_summary.total_stock_cost + $4
+         WHERE product_stock_summary.storable_id = $1 AND
+               product_stock_summary.branch_id = $2;
+        EXIT WHEN FOUND;
+        BEGIN
+            INSERT INTO product_stock_summary (storable_id, branch_id, stock,
+                                               total_stock_cost)
+                VALUES ($1, $2, $3, $4);
+            EXIT;
+        EXCEPTION WHEN unique_violation THEN
+            -- Inserted by a concurrent transaction, it will be updated
+            -- on the next iteration
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keeps product_stock_summary up to date when a product_stock_item
+-- is inserted/updated/deleted
+CREATE OR REPLACE FUNCTION product_stock_item_update_stock_summary() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+        PERFORM product_stock_summary_add(
+            OLD.storable_id, OLD.branch_id,
+            -COALESCE(OLD.quantity, 0),
+            -COALESCE(OLD.quantity * OLD.stock_cost, 0));
+    END IF;
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+        PERFORM product_stock_summary_add(
+            NEW.storable_id, NEW.branch_id,
+            COALESCE(NEW.quantity, 0),
+            COALESCE(NEW.quantity * NEW.stock_cost, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates the empty stock summaries of a new storable on all branches
+CREATE OR REPLACE FUNCTION storable_create_stock_summary() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO product_stock_summary (storable_id, branch_id)
+        SELECT NEW.id, branch.id FROM branch;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Creates the empty stock summaries of all storables on a new branch
+CREATE OR REPLACE FUNCTION branch_create_stock_summary() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO product_stock_summary (storable_id, branch_id)
+        SELECT storable.id, NEW.id FROM storable;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recreates the whole product_stock_summary from the stock items
+CREATE OR REPLACE FUNCTION rebuild_product_stock_summary() RETURNS void AS $$
+BEGIN
+    -- Wait for the transactions that changed the summaries and keep the
+    -- stock item triggers from changing them until this one is done
+    LOCK TABLE product_stock_summary IN EXCLUSIVE MODE;
+    DELETE FROM product_stock_summary;
+    INSERT INTO product_stock_summary (storable_id, branch_id, stock,
+                                       total_stock_cost)
+        SELECT storable.id, branch.id,
+               COALESCE(SUM(product_stock_item.quantity), 0),
+               COALESCE(SUM(product_stock_item.quantity *
+                            product_stock_item.stock_cost), 0)
+          FROM storable
+         CROSS JOIN branch
+          LEFT JOIN product_stock_item
+            ON product_stock_item.storable_id = storable.id AND
+               product_stock_item.branch_id = branch.id
+         GROUP BY storable.id, branch.id;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- parameter_data change notification, see ParameterAccess in
+-- stoqlib/lib/parameters.py
+--
+
+-- Notifies the listeners of the parameter_data channel with the name of
+-- the parameter that was modified
+CREATE OR REPLACE FUNCTION notify_parameter_data() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('parameter_data', OLD.field_name);
+        RETURN OLD;
+    END IF;
+    PERFORM pg_notify('parameter_data', NEW.field_name);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- account_balance_checkpoint maintenance, see AccountBalanceCheckpoint in
+-- stoqlib/domain/account.py
+--
+
+-- Adds the given value to the balance of the account at the end of the
+-- month of the date and of all the months after it
+CREATE OR REPLACE FUNCTION account_balance_checkpoint_add(account_id uuid,
+                                                          transaction_date timestamp,
+                                                          value numeric) RETURNS void AS $$
+DECLARE
+    checkpoint_month timestamp := date_trunc('month', $2);
+    previous_balance numeric;
+BEGIN
+    -- Make sure the checkpoint of the month exists. The first transaction
+    -- of the month starts it from the balance of the month before it
+    LOOP
+        PERFORM 1 FROM account_balance_checkpoint
+         WHERE account_balance_checkpoint.account_id = $1
+           AND account_balance_checkpoint.month = checkpoint_month;
+        EXIT WHEN FOUND;
+
+        SELECT account_balance_checkpoint.balance INTO previous_balance
+          FROM account_balance_checkpoint
+         WHERE account_balance_checkpoint.account_id = $1
+           AND account_balance_checkpoint.month < checkpoint_month
+         ORDER BY account_balance_checkpoint.month DESC
+         LIMIT 1
+           FOR UPDATE;
+        BEGIN
+            INSERT INTO account_balance_checkpoint (account_id, month, balance)
+                VALUES ($1, checkpoint_month, COALESCE(previous_balance, 0));
+            EXIT;
+        EXCEPTION WHEN unique_violation THEN
+            -- Inserted by a concurrent transaction, it will be found
+            -- on the next iteration
+        END;
+    END LOOP;
+
+    UPDATE account_balance_checkpoint
+       SET balance = account_balance_checkpoint.balance + $3
+     WHERE account_balance_checkpoint.account_id = $1
+       AND account_balance_checkpoint.month >= checkpoint_month;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Adds the value of a transaction to the checkpoints of its destination
+-- and subtracts it from the ones of its source. The accounts are always
+-- updated in the order of their ids, so that concurrent transactions
+-- between the same accounts lock their checkpoints in the same order
+-- instead of deadlocking.
+CREATE OR REPLACE FUNCTION account_transaction_add_to_checkpoints(account_id uuid,
+                                                                  source_account_id uuid,
+                                                                  transaction_date timestamp,
+                                                                  value numeric) RETURNS void AS $$
+BEGIN
+    IF $1 = $2 THEN
+        -- Doesn't change the balance, but still has a checkpoint
+        PERFORM account_balance_checkpoint_add($1, $3, 0);
+    ELSIF $1 < $2 THEN
+        PERFORM account_balance_checkpoint_add($1, $3, $4);
+        PERFORM account_balance_checkpoint_add($2, $3, -$4);
+    ELSE
+        PERFORM account_balance_checkpoint_add($2, $3, -$4);
+        PERFORM account_balance_checkpoint_add($1, $3, $4);
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keeps account_balance_checkpoint up to date when an account_transaction
+-- is inserted/updated/deleted.
+CREATE OR REPLACE FUNCTION account_transaction_update_balance_checkpoint() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+        PERFORM account_transaction_add_to_checkpoints(
+            OLD.account_id, OLD.source_account_id, OLD.date,
+            -COALESCE(OLD.value, 0));
+    END IF;
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+        PERFORM account_transaction_add_to_checkpoints(
+            NEW.account_id, NEW.source_account_id, NEW.date,
+            COALESCE(NEW.value, 0));
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recreates the whole account_balance_checkpoint from the transactions
+CREATE OR REPLACE FUNCTION rebuild_account_balance_checkpoint() RETURNS void AS $$
+BEGIN
+    DELETE FROM account_balance_checkpoint;
+    INSERT INTO account_balance_checkpoint (account_id, month, balance)
+        SELECT entry.account_id, entry.month,
+               SUM(SUM(entry.value)) OVER (PARTITION BY entry.account_id
+                                           ORDER BY entry.month)
+          FROM (SELECT account_transaction.account_id,
+                       date_trunc('month', account_transaction.date) AS month,
+                       CASE WHEN account_transaction.account_id =
+                                 account_transaction.source_account_id THEN 0
+                            ELSE COALESCE(account_transaction.value, 0)
+                       END AS value
+                  FROM account_transaction
+                UNION ALL
+                SELECT account_transaction.source_account_id,
+                       date_trunc('month', account_transaction.date),
+                       CASE WHEN account_transaction.account_id =
+                                 account_transaction.source_account_id THEN 0
+                            ELSE -COALESCE(account_transaction.value, 0)
+                       END
+                  FROM account_transaction) AS entry
+         GROUP BY entry.account_id, entry.month;
+END;
+$$ LANGUAGE plpgsql;
+
+--
+-- client_credit_ledger maintenance, see ClientCreditLedger in
+-- stoqlib/domain/person.py
+--
+
+-- Adds the given values to the credit ledger of the payer
+CREATE OR REPLACE FUNCTION client_credit_ledger_add(person_id uuid,
+                                                    credit_received numeric,
+                                                    credit_spent numeric,
+                                                    store_credit_debit numeric) RETURNS void AS $$
+BEGIN
+    IF $1 IS NULL OR ($2 = 0 AND $3 = 0 AND $4 = 0) THEN
+        RETURN;
+    END IF;
+    LOOP
+        UPDATE client_credit_ledger
+           SET credit_received = client_credit_ledger.credit_received + $2,
+               credit_spent = client_credit_ledger.credit_spent + $3,
+               store_credit_debit = client_credit_ledger.store_credit_debit + $4
+         WHERE client_credit_ledger.person_id = $1;
+        EXIT WHEN FOUND;
+        BEGIN
+            INSERT INTO client_credit_ledger (person_id, credit_received,
+                                              credit_spent, store_credit_debit)
+                VALUES ($1, $2, $3, $4);
+            EXIT;
+        EXCEPTION WHEN unique_violation THEN
+            -- Inserted by a concurrent transaction, it will be updated
+            -- on the next iteration
+        END;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Adds (or removes, when sign is -1) a payment to the credit ledger of
+-- the payer. Only paid credit payments and pending or confirmed store
+-- credit payments are in the ledger. The columns of the payment are
+-- passed one by one, since the payment table doesn't exist yet when the
+-- functions are first created.
+CREATE OR REPLACE FUNCTION client_credit_ledger_add_payment(payer_id uuid,
+                                                            method_id uuid,
+                                                            status text,
+                                                            payment_type text,
+                                                            value numeric,
+                                                            paid_value numeric,
+                                                            sign numeric) RETURNS void AS $$
+DECLARE
+    method text;
+BEGIN
+    IF $1 IS NULL THEN
+        RETURN;
+    END IF;
+    SELECT method_name INTO method FROM payment_method WHERE id = $2;
+    IF method = 'credit' AND $3 = 'paid' THEN
+        IF $4 = 'out' THEN
+            PERFORM client_credit_ledger_add($1, $7 * COALESCE($6, 0), 0, 0);
+        ELSE
+            PERFORM client_credit_ledger_add($1, 0, $7 * COALESCE($6, 0), 0);
+        END IF;
+    ELSIF (method = 'store_credit' AND $4 = 'in' AND
+           $3 IN ('pending', 'confirmed')) THEN
+        PERFORM client_credit_ledger_add($1, 0, 0, $7 * COALESCE($5, 0));
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Keeps client_credit_ledger up to date when a payment is
+-- inserted/updated/deleted, eg. when it's paid or cancelled
+CREATE OR REPLACE FUNCTION payment_update_client_credit_ledger() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'UPDATE' AND
+       (OLD.status, OLD.payment_type, OLD.value, OLD.paid_value,
+        OLD.method_id, OLD.group_id) IS NOT DISTINCT FROM
+       (NEW.status, NEW.payment_type, NEW.value, NEW.paid_value,
+        NEW.method_id, NEW.group_id) THEN
+        RETURN NULL;
+    END IF;
+    IF TG_OP = 'UPDATE' OR TG_OP = 'DELETE' THEN
+        PERFORM client_credit_ledger_add_payment(
+                    payment_group.payer_id, OLD.method_id, OLD.status::text,
+                    OLD.payment_type::text, OLD.value, OLD.paid_value, -1)
+           FROM payment_group WHERE payment_group.id = OLD.group_id;
+    END IF;
+    IF TG_OP = 'INSERT' OR TG_OP = 'UPDATE' THEN
+        PERFORM client_credit_ledger_add_payment(
+                    payment_group.payer_id, NEW.method_id, NEW.status::text,
+                    NEW.payment_type::text, NEW.value, NEW.paid_value, 1)
+           FROM payment_group WHERE payment_group.id = NEW.group_id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Moves the payments of a group to the ledger of its new payer
+CREATE OR REPLACE FUNCTION payment_group_update_client_credit_ledger() RETURNS trigger AS $$
+BEGIN
+    IF NEW.payer_id IS DISTINCT FROM OLD.payer_id THEN
+        PERFORM client_credit_ledger_add_payment(
+                    OLD.payer_id, payment.method_id, payment.status::text,
+                    payment.payment_type::text, payment.value,
+                    payment.paid_value, -1),
+                client_credit_ledger_add_payment(
+                    NEW.payer_id, payment.method_id, payment.status::text,
+                    payment.payment_type::text, payment.value,
+                    payment.paid_value, 1)
+           FROM payment WHERE payment.group_id = NEW.id;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Recreates the whole client_credit_ledger from the payments
+CREATE OR REPLACE FUNCTION rebuild_client_credit_ledger() RETURNS void AS $$
+BEGIN
+    -- Wait for the transactions that changed the ledger and keep the
+    -- payment triggers from changing it until this one is done
+    LOCK TABLE client_credit_ledger IN EXCLUSIVE MODE;
+    DELETE FROM client_credit_ledger;
+    INSERT INTO client_credit_ledger (person_id, credit_received,
+                                      credit_spent, store_credit_debit)
+        SELECT payment_group.payer_id,
+               COALESCE(SUM(CASE WHEN payment_method.method_name = 'credit' AND
+                                      payment.status = 'paid' AND
+                                      payment.payment_type = 'out'
+                                 THEN payment.paid_value END), 0),
+               COALESCE(SUM(CASE WHEN payment_method.method_name = 'credit' AND
+                                      payment.status = 'paid' AND
+                                      payment.payment_type = 'in'
+                                 THEN payment.paid_value END), 0),
+               COALESCE(SUM(CASE WHEN payment_method.method_name = 'store_credit' AND
+                                      payment.status IN ('pending', 'confirmed') AND
+                                      payment.payment_type = 'in'
+                                 THEN payment.value END), 0)
+          FROM payment
+          JOIN payment_group ON payment_group.id = payment.group_id
+          JOIN payment_method ON payment_method.id = payment.method_id
+         WHERE payment_group.payer_id IS NOT NULL
+         GROUP BY payment_group.payer_id;
+    DELETE FROM client_credit_ledger
+     WHERE credit_received = 0 AND credit_spent = 0 AND store_credit_debit = 0;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,16 @@
+-- Use GIN trigram indexes on the normalized text columns used by the
+-- searches. QueryExecuter filters those using
+-- stoq_normalize_string(column) LIKE '%word%', which can use them.
+-- GIN is slower to update than GiST, but a lot faster to search.
+
+CREATE EXTENSION IF NOT EXISTS "pg_trgm";
+
+DROP INDEX IF EXISTS sellable_description_normalized_idx;
+CREATE INDEX sellable_description_normalized_idx ON sellable
+    USING gin (stoq_normalize_string(description) gin_trgm_ops);
+
+CREATE INDEX person_name_normalized_idx ON person
+    USING gin (stoq_normalize_string(name) gin_trgm_ops);
+
+CREATE INDEX address_street_normalized_idx ON address
+    USING gin (stoq_normalize_string(street) gin_trgm_ops);
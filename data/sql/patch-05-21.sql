@@ -0,0 +1,23 @@
+-- Keep the sale items summary in a table instead of aggregating the
+-- whole sale_item table every time SaleView is queried.
+-- The trigger functions are defined in functions.sql
+
+CREATE TABLE sale_summary (
+    sale_id uuid PRIMARY KEY REFERENCES sale(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    subtotal numeric NOT NULL DEFAULT 0,
+    total_quantity numeric(20, 3) NOT NULL DEFAULT 0,
+    v_ipi numeric(20, 2) NOT NULL DEFAULT 0
+);
+
+CREATE INDEX sale_item_sale_id_idx ON sale_item (sale_id);
+CREATE INDEX sale_item_ipi_info_id_idx ON sale_item (ipi_info_id);
+
+CREATE TRIGGER sale_item_update_sale_summary
+    AFTER INSERT OR UPDATE OR DELETE ON sale_item
+    FOR EACH ROW EXECUTE PROCEDURE sale_item_update_sale_summary();
+CREATE TRIGGER invoice_item_ipi_update_sale_summary
+    AFTER UPDATE ON invoice_item_ipi
+    FOR EACH ROW EXECUTE PROCEDURE invoice_item_ipi_update_sale_summary();
+
+SELECT rebuild_sale_summary();
@@ -0,0 +1,28 @@
+-- Keep the stock of each storable on each branch in a table instead of
+-- cross joining storable and branch and aggregating product_stock_item
+-- every time a stock view is filtered by branch.
+-- The trigger functions are defined in functions.sql
+
+CREATE TABLE product_stock_summary (
+    storable_id uuid NOT NULL REFERENCES storable(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    branch_id uuid NOT NULL REFERENCES branch(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    stock numeric(20, 3) NOT NULL DEFAULT 0,
+    total_stock_cost numeric NOT NULL DEFAULT 0,
+    PRIMARY KEY (storable_id, branch_id)
+);
+CREATE INDEX product_stock_summary_branch_id_idx
+    ON product_stock_summary (branch_id);
+
+CREATE TRIGGER product_stock_item_update_stock_summary
+    AFTER INSERT OR UPDATE OR DELETE ON product_stock_item
+    FOR EACH ROW EXECUTE PROCEDURE product_stock_item_update_stock_summary();
+CREATE TRIGGER storable_create_stock_summary
+    AFTER INSERT ON storable
+    FOR EACH ROW EXECUTE PROCEDURE storable_create_stock_summary();
+CREATE TRIGGER branch_create_stock_summary
+    AFTER INSERT ON branch
+    FOR EACH ROW EXECUTE PROCEDURE branch_create_stock_summary();
+
+SELECT rebuild_product_stock_summary();
@@ -0,0 +1,7 @@
+-- Notify the running stations when a parameter changes, so they don't
+-- need to be restarted to pick up the new value.
+-- The trigger function is defined in functions.sql
+
+CREATE TRIGGER parameter_data_notify
+    AFTER INSERT OR UPDATE OR DELETE ON parameter_data
+    FOR EACH ROW EXECUTE PROCEDURE notify_parameter_data();
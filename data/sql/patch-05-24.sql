@@ -0,0 +1,9 @@
+-- Indexes for SellableLookup (stoqlib/domain/sellable.py), which searches
+-- for the lowered barcode, code and batch number of the sellables and
+-- refreshes itself with the entries modified since its last refresh.
+
+CREATE INDEX sellable_lower_barcode_idx ON sellable (lower(barcode));
+CREATE INDEX sellable_lower_code_idx ON sellable (lower(code));
+CREATE INDEX storable_batch_lower_batch_number_idx
+    ON storable_batch (lower(batch_number));
+CREATE INDEX transaction_entry_te_time_idx ON transaction_entry (te_time);
@@ -0,0 +1,5 @@
+-- Confirming a sale looks for the work order item of each sale item,
+-- see WorkOrderItem.get_from_sale_item
+
+CREATE INDEX work_order_item_sale_item_id_idx
+    ON work_order_item (sale_item_id);
@@ -0,0 +1,23 @@
+-- Keep the balance of each account at the end of each month, so that the
+-- running balances of the financial app are computed from the month of
+-- the transactions instead of from the first transaction of the account.
+-- The trigger functions are defined in functions.sql
+
+CREATE TABLE account_balance_checkpoint (
+    account_id uuid NOT NULL REFERENCES account(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    month timestamp NOT NULL,
+    balance numeric(20, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (account_id, month)
+);
+
+CREATE INDEX account_transaction_account_id_date_idx
+    ON account_transaction (account_id, date);
+CREATE INDEX account_transaction_source_account_id_date_idx
+    ON account_transaction (source_account_id, date);
+
+CREATE TRIGGER account_transaction_update_balance_checkpoint
+    AFTER INSERT OR UPDATE OR DELETE ON account_transaction
+    FOR EACH ROW EXECUTE PROCEDURE account_transaction_update_balance_checkpoint();
+
+SELECT rebuild_account_balance_checkpoint();
@@ -0,0 +1,23 @@
+-- Keep the credit of each client in a ledger instead of summing all
+-- their credit payments every time the balance is needed, eg. when
+-- checking if the client can purchase on the point of sale.
+-- The trigger functions are defined in functions.sql
+
+CREATE TABLE client_credit_ledger (
+    person_id uuid PRIMARY KEY REFERENCES person(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    credit_received numeric(20, 2) NOT NULL DEFAULT 0,
+    credit_spent numeric(20, 2) NOT NULL DEFAULT 0,
+    store_credit_debit numeric(20, 2) NOT NULL DEFAULT 0
+);
+
+CREATE INDEX payment_group_id_idx ON payment (group_id);
+
+CREATE TRIGGER payment_update_client_credit_ledger
+    AFTER INSERT OR UPDATE OR DELETE ON payment
+    FOR EACH ROW EXECUTE PROCEDURE payment_update_client_credit_ledger();
+CREATE TRIGGER payment_group_update_client_credit_ledger
+    AFTER UPDATE ON payment_group
+    FOR EACH ROW EXECUTE PROCEDURE payment_group_update_client_credit_ledger();
+
+SELECT rebuild_client_credit_ledger();
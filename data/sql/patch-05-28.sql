@@ -0,0 +1,10 @@
+-- Keep the indexes that the schema updates create concurrently, after the
+-- patches are committed, until they are created. The ones that could not
+-- be created are created again on the next update, see PatchRunner
+
+CREATE TABLE schema_deferred_index (
+    id serial NOT NULL PRIMARY KEY,
+    filename text NOT NULL,
+    lineno integer NOT NULL,
+    statement text NOT NULL
+);
@@ -111,6 +111,7 @@ CREATE TABLE transaction_entry (
     te_time timestamp NOT NULL,
     dirty boolean DEFAULT TRUE
 );
+CREATE INDEX transaction_entry_te_time_idx ON transaction_entry (te_time);
 
 --
 -- Domain tables
@@ -138,6 +139,9 @@ CREATE TABLE person (
 );
 CREATE RULE update_te AS ON UPDATE TO person DO ALSO SELECT update_te(old.te_id);
 
+CREATE INDEX person_name_normalized_idx ON person
+    USING gin (stoq_normalize_string(name) gin_trgm_ops);
+
 CREATE TABLE client_category (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
     te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te(),
@@ -458,7 +462,10 @@ CREATE RULE update_te AS ON UPDATE TO sellable DO ALSO SELECT update_te(old.te_i
 CREATE INDEX sellable_description_idx ON sellable
     USING gist (description gist_trgm_ops);
 CREATE INDEX sellable_description_normalized_idx ON sellable
-    USING gist (stoq_normalize_string(description) gist_trgm_ops);
+    USING gin (stoq_normalize_string(description) gin_trgm_ops);
+-- Used by SellableLookup
+CREATE INDEX sellable_lower_barcode_idx ON sellable (lower(barcode));
+CREATE INDEX sellable_lower_code_idx ON sellable (lower(code));
 
 CREATE TABLE product_icms_template (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -614,6 +621,8 @@ CREATE TABLE storable_batch (
     storable_id uuid NOT NULL REFERENCES storable(id) ON UPDATE CASCADE
 );
 CREATE RULE update_te AS ON UPDATE TO storable_batch DO ALSO SELECT update_te(old.te_id);
+CREATE INDEX storable_batch_lower_batch_number_idx
+    ON storable_batch (lower(batch_number));
 
 CREATE TABLE product_stock_item (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -628,6 +637,29 @@ CREATE TABLE product_stock_item (
 );
 CREATE RULE update_te AS ON UPDATE TO product_stock_item DO ALSO SELECT update_te(old.te_id);
 
+-- Kept up to date by the triggers below, see functions.sql
+CREATE TABLE product_stock_summary (
+    storable_id uuid NOT NULL REFERENCES storable(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    branch_id uuid NOT NULL REFERENCES branch(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    stock numeric(20, 3) NOT NULL DEFAULT 0,
+    total_stock_cost numeric NOT NULL DEFAULT 0,
+    PRIMARY KEY (storable_id, branch_id)
+);
+CREATE INDEX product_stock_summary_branch_id_idx
+    ON product_stock_summary (branch_id);
+
+CREATE TRIGGER product_stock_item_update_stock_summary
+    AFTER INSERT OR UPDATE OR DELETE ON product_stock_item
+    FOR EACH ROW EXECUTE PROCEDURE product_stock_item_update_stock_summary();
+CREATE TRIGGER storable_create_stock_summary
+    AFTER INSERT ON storable
+    FOR EACH ROW EXECUTE PROCEDURE storable_create_stock_summary();
+CREATE TRIGGER branch_create_stock_summary
+    AFTER INSERT ON branch
+    FOR EACH ROW EXECUTE PROCEDURE branch_create_stock_summary();
+
 CREATE TABLE product_supplier_info (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
     te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te(),
@@ -976,6 +1008,23 @@ CREATE TABLE sale_item (
     cfop_id uuid REFERENCES cfop_data(id) ON UPDATE CASCADE
 );
 CREATE RULE update_te AS ON UPDATE TO sale_item DO ALSO SELECT update_te(old.te_id);
+CREATE INDEX sale_item_sale_id_idx ON sale_item (sale_id);
+CREATE INDEX sale_item_ipi_info_id_idx ON sale_item (ipi_info_id);
+
+-- Kept up to date by the triggers below, see functions.sql
+CREATE TABLE sale_summary (
+    sale_id uuid PRIMARY KEY REFERENCES sale(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    subtotal numeric NOT NULL DEFAULT 0,
+    total_quantity numeric(20, 3) NOT NULL DEFAULT 0,
+    v_ipi numeric(20, 2) NOT NULL DEFAULT 0
+);
+CREATE TRIGGER sale_item_update_sale_summary
+    AFTER INSERT OR UPDATE OR DELETE ON sale_item
+    FOR EACH ROW EXECUTE PROCEDURE sale_item_update_sale_summary();
+CREATE TRIGGER invoice_item_ipi_update_sale_summary
+    AFTER UPDATE ON invoice_item_ipi
+    FOR EACH ROW EXECUTE PROCEDURE invoice_item_ipi_update_sale_summary();
 
 CREATE TABLE returned_sale (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -1028,6 +1077,9 @@ CREATE TABLE address (
 );
 CREATE RULE update_te AS ON UPDATE TO address DO ALSO SELECT update_te(old.te_id);
 
+CREATE INDEX address_street_normalized_idx ON address
+    USING gin (stoq_normalize_string(street) gin_trgm_ops);
+
 CREATE TABLE delivery (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
     te_id bigint UNIQUE REFERENCES transaction_entry(id) DEFAULT new_te(),
@@ -1131,6 +1183,22 @@ CREATE TABLE payment (
     UNIQUE (identifier, branch_id)
 );
 CREATE RULE update_te AS ON UPDATE TO payment DO ALSO SELECT update_te(old.te_id);
+CREATE INDEX payment_group_id_idx ON payment (group_id);
+
+-- Kept up to date by the triggers below, see functions.sql
+CREATE TABLE client_credit_ledger (
+    person_id uuid PRIMARY KEY REFERENCES person(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    credit_received numeric(20, 2) NOT NULL DEFAULT 0,
+    credit_spent numeric(20, 2) NOT NULL DEFAULT 0,
+    store_credit_debit numeric(20, 2) NOT NULL DEFAULT 0
+);
+CREATE TRIGGER payment_update_client_credit_ledger
+    AFTER INSERT OR UPDATE OR DELETE ON payment
+    FOR EACH ROW EXECUTE PROCEDURE payment_update_client_credit_ledger();
+CREATE TRIGGER payment_group_update_client_credit_ledger
+    AFTER UPDATE ON payment_group
+    FOR EACH ROW EXECUTE PROCEDURE payment_group_update_client_credit_ledger();
 
 CREATE TABLE payment_comment (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -1297,6 +1365,9 @@ CREATE TABLE parameter_data (
     is_editable boolean
 );
 CREATE RULE update_te AS ON UPDATE TO parameter_data DO ALSO SELECT update_te(old.te_id);
+CREATE TRIGGER parameter_data_notify
+    AFTER INSERT OR UPDATE OR DELETE ON parameter_data
+    FOR EACH ROW EXECUTE PROCEDURE notify_parameter_data();
 
 CREATE TABLE profile_settings (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -1796,6 +1867,8 @@ CREATE TABLE work_order_item (
     order_id uuid REFERENCES work_order(id) ON UPDATE CASCADE
 );
 CREATE RULE update_te AS ON UPDATE TO work_order_item DO ALSO SELECT update_te(old.te_id);
+CREATE INDEX work_order_item_sale_item_id_idx
+    ON work_order_item (sale_item_id);
 
 CREATE TABLE work_order_package (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -1851,6 +1924,22 @@ CREATE TABLE account_transaction (
     payment_id uuid REFERENCES payment(id) ON UPDATE CASCADE
 );
 CREATE RULE update_te AS ON UPDATE TO account_transaction DO ALSO SELECT update_te(old.te_id);
+CREATE INDEX account_transaction_account_id_date_idx
+    ON account_transaction (account_id, date);
+CREATE INDEX account_transaction_source_account_id_date_idx
+    ON account_transaction (source_account_id, date);
+
+-- Kept up to date by the trigger below, see functions.sql
+CREATE TABLE account_balance_checkpoint (
+    account_id uuid NOT NULL REFERENCES account(id)
+        ON UPDATE CASCADE ON DELETE CASCADE,
+    month timestamp NOT NULL,
+    balance numeric(20, 2) NOT NULL DEFAULT 0,
+    PRIMARY KEY (account_id, month)
+);
+CREATE TRIGGER account_transaction_update_balance_checkpoint
+    AFTER INSERT OR UPDATE OR DELETE ON account_transaction
+    FOR EACH ROW EXECUTE PROCEDURE account_transaction_update_balance_checkpoint();
 
 CREATE TABLE ui_form (
     id uuid PRIMARY KEY DEFAULT uuid_generate_v1(),
@@ -1924,6 +2013,15 @@ CREATE TABLE credit_check_history (
 );
 CREATE RULE update_te AS ON UPDATE TO credit_check_history DO ALSO SELECT update_te(old.te_id);
 
+-- The indexes that the schema updates create concurrently, until they
+-- are created, see PatchRunner
+CREATE TABLE schema_deferred_index (
+    id serial NOT NULL PRIMARY KEY,
+    filename text NOT NULL,
+    lineno integer NOT NULL,
+    statement text NOT NULL
+);
+
 
 -- Add new tables above this line when creating a new schema generation,
 -- unless they are referenced by other tables above.
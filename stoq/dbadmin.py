@@ -26,6 +26,7 @@
 
 import optparse
 import sys
+import time
 
 
 class StoqCommandHandler:
@@ -306,6 +307,11 @@ class StoqCommandHandler:
             return 30
         return 0
 
+    def _print_progress(self, done, total):
+        sys.stderr.write("\r%d of %d tables" % (done, total))
+        if done == total:
+            sys.stderr.write("\n")
+
     def opt_updateschema(self, parser, group):
         group.add_option('-b', '--disable-backup',
                          action='store_false',
@@ -329,7 +335,8 @@ class StoqCommandHandler:
         else:
             backup = options.disable_backup
 
-        if not migration.update(backup=backup):
+        # With --dry-run the patches are applied and timed, but rolled back
+        if not migration.update(backup=backup, dry_run=options.dry):
             return 1
 
     def opt_clone(self, parser, group):
@@ -348,8 +355,15 @@ class StoqCommandHandler:
 
         if output == '-':
             output = None
-        self._db_settings.dump_database(output, gzip=options.gzip,
-                                        format=options.format)
+        if output is None and options.blobs == 'separate':
+            print("ERROR: The blobs can only be dumped separately to a file")
+            return 1
+        if not self._db_settings.dump_database(
+                output, gzip=options.gzip, format=options.format,
+                jobs=options.jobs, blobs=options.blobs,
+                progress=self._print_progress):
+            print("ERROR: Failed to dump the database")
+            return 1
 
     def opt_dump(self, parser, group):
         group.add_option('-z', '--gzip',
@@ -360,12 +374,46 @@ class StoqCommandHandler:
                          default='custom',
                          help="dump format see man pg_dump for more information",
                          dest='format')
+        group.add_option('-j', '--jobs',
+                         action='store',
+                         type='int',
+                         default=1,
+                         help="number of tables to dump in parallel, "
+                              "implies the directory format",
+                         dest='jobs')
+        group.add_option('', '--blobs',
+                         action='store',
+                         choices=['include', 'skip', 'separate'],
+                         default='include',
+                         help="include the attachments and images, skip "
+                              "them or dump them to a separate file",
+                         dest='blobs')
 
     def cmd_restore(self, options, schema):
         """Restore a database dump"""
         self._read_config(options, register_station=False,
                           check_schema=False)
-        self._db_settings.execute_sql(schema)
+        if schema.endswith('.sql'):
+            self._db_settings.execute_sql(schema)
+            return
+
+        # Dumps created by the dump command are restored to a new database
+        from stoqlib.exceptions import DatabaseError
+        try:
+            new_name = self._db_settings.restore_database(
+                schema, jobs=options.jobs, progress=self._print_progress)
+        except DatabaseError as e:
+            print("ERROR: %s" % (e, ))
+            return 1
+        print("Database restored as %s" % (new_name, ))
+
+    def opt_restore(self, parser, group):
+        group.add_option('-j', '--jobs',
+                         action='store',
+                         type='int',
+                         default=1,
+                         help="number of tables to restore in parallel",
+                         dest='jobs')
 
     def cmd_enable_plugin(self, options, plugin_name):
         """Enable a plugin on Stoq"""
@@ -408,6 +456,9 @@ class StoqCommandHandler:
         self._read_config(options, register_station=False)
         from stoqlib.importers import importer
         importer = importer.get_by_type(options.type)
+        importer.set_bulk(options.bulk)
+        if options.items_per_commit:
+            importer.set_items_per_commit(options.items_per_commit)
         importer.feed_file(options.filename)
         importer.process()
 
@@ -420,6 +471,96 @@ class StoqCommandHandler:
                          action="store",
                          help="Filename to import",
                          dest="filename")
+        group.add_option('', '--bulk',
+                         action="store_true",
+                         help="Import the items in batches",
+                         dest="bulk")
+        group.add_option('', '--items-per-commit',
+                         action="store",
+                         type="int",
+                         help="Number of items to import between commits",
+                         dest="items_per_commit")
+
+    def cmd_check_summaries(self, options):
+        """Check the summary tables for drift"""
+        self._read_config(options, register_station=False)
+        from stoqlib.database.runtime import new_store
+        from stoqlib.domain.account import AccountBalanceCheckpoint
+        from stoqlib.domain.person import ClientCreditLedger
+        from stoqlib.domain.product import ProductStockSummary
+        from stoqlib.domain.sale import SaleSummary
+
+        store = new_store()
+        retval = 0
+        for summary in [SaleSummary, ProductStockSummary,
+                        AccountBalanceCheckpoint, ClientCreditLedger]:
+            table = summary.__storm_table__
+            inconsistencies = summary.find_inconsistencies(store)
+            for row in inconsistencies:
+                print("%s: %s expected %r, found %r" % ((table, ) + row))
+            print("%s: %d inconsistencies" % (table, len(inconsistencies)))
+            if not inconsistencies:
+                continue
+            retval = 1
+            if options.rebuild:
+                print("%s: rebuilding" % (table, ))
+                summary.rebuild(store)
+
+        if options.dry:
+            store.rollback(close=True)
+        else:
+            store.commit(close=True)
+        return retval
+
+    def opt_check_summaries(self, parser, group):
+        group.add_option('', '--rebuild',
+                         action="store_true",
+                         help="Rebuild the summaries with inconsistencies",
+                         dest="rebuild")
+
+    def cmd_benchmark_viewables(self, options):
+        """Compare viewable queries with and without the statement cache"""
+        self._read_config(options, register_station=False)
+        from stoqlib.database.runtime import new_store
+        from stoqlib.database.statements import (get_statement_stats,
+                                                 reset_statement_stats,
+                                                 set_statement_cache_enabled)
+        from stoqlib.domain.payment.views import InPaymentView
+        from stoqlib.domain.sale import SaleView
+        from stoqlib.domain.views import ProductFullStockView
+
+        store = new_store()
+        reset_statement_stats()
+        for viewable in [SaleView, ProductFullStockView, InPaymentView]:
+            item = store.find(viewable).any()
+            if item is None:
+                print("%s: no rows to query" % (viewable.__name__, ))
+                continue
+
+            latencies = []
+            # Cold compiles and plans every query, warm uses the cache
+            for enabled in [False, True]:
+                set_statement_cache_enabled(enabled)
+                start = time.time()
+                for i in range(options.queries):
+                    store.find(viewable, viewable.id == item.id).one()
+                latencies.append(
+                    (time.time() - start) * 1000 / options.queries)
+            print("%s: cold %.2f ms, warm %.2f ms" % (
+                (viewable.__name__, ) + tuple(latencies)))
+
+        set_statement_cache_enabled(self._db_settings.statement_cache)
+        for name, value in sorted(get_statement_stats().items()):
+            print("%s: %d" % (name, value))
+        store.rollback(close=True)
+
+    def opt_benchmark_viewables(self, parser, group):
+        group.add_option('-n', '--queries',
+                         action="store",
+                         type="int",
+                         default=100,
+                         help="Number of queries on each viewable",
+                         dest="queries")
 
     def cmd_console(self, options):
         """Drop to a Stoq python console"""
@@ -28,20 +28,18 @@ stoq/gui/financial/financial.py:
 """
 
 import datetime
-import decimal
 
 from dateutil.relativedelta import relativedelta
 import gobject
 import gtk
 from kiwi.currency import currency
-from kiwi.python import Settable
 from kiwi.ui.dialogs import selectfile
 from kiwi.ui.objectlist import ColoredColumn, Column
 import pango
 from stoqlib.api import api
 from stoqlib.database.expr import Date
 from stoqlib.database.queryexecuter import DateQueryState, DateIntervalQueryState
-from stoqlib.domain.account import Account, AccountTransaction, AccountTransactionView
+from stoqlib.domain.account import Account, AccountLedgerView
 from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.views import InPaymentView, OutPaymentView
 from stoqlib.gui.base.dialogs import run_dialog
@@ -63,20 +61,13 @@ from stoqlib.lib.dateutils import get_month_names
 from stoqlib.lib.message import yesno
 from stoqlib.lib.translation import stoqlib_gettext as _
 from stoqlib.reporting.payment import AccountTransactionReport
-from storm.expr import And, Or
+from storm.expr import And
 
 from stoq.gui.shell.shellapp import ShellApp
 
 
 class FinancialSearchResults(SearchResultListView):
-
-    def search_completed(self, results):
-        page = self.page
-        executer = page.search.get_query_executer()
-        if executer.search_spec == AccountTransactionView:
-            page.append_transactions(results)
-        else:
-            super(FinancialSearchResults, self).search_completed(results)
+    """The results of a :class:`TransactionPage`"""
 
 gobject.type_register(FinancialSearchResults)
 
@@ -162,18 +153,25 @@ class TransactionPage(object):
         return store.find(search_spec)
 
     def _transaction_query(self, store):
-        queries = [Or(self.model.id == AccountTransaction.account_id,
-                      self.model.id == AccountTransaction.source_account_id)]
-
-        queries.extend(self._append_date_query(AccountTransaction.date))
-        return store.find(AccountTransactionView, And(*queries))
+        date = self.date_filter.get_state()
+        start = end = None
+        if isinstance(date, DateQueryState) and date.date is not None:
+            start = end = date.date
+        elif isinstance(date, DateIntervalQueryState):
+            start, end = date.start, date.end
+        return AccountLedgerView.find_by_account(store, self.model,
+                                                 start=start, end=end)
 
     def show(self):
         self.search.show()
 
     def _setup_search(self):
         if self.model.kind == 'account':
-            self.search.set_search_spec(AccountTransactionView)
+            # The balances are computed by the database, so the
+            # transactions don't need to be all loaded
+            if api.sysparam.get_bool('SMART_LIST_LOADING'):
+                self.search.enable_lazy_search()
+            self.search.set_search_spec(AccountLedgerView)
             self.search.set_text_field_columns(['description'])
             self.search.set_query(self._transaction_query)
         elif self.model.kind == 'payable':
@@ -190,8 +188,7 @@ class TransactionPage(object):
     def refresh(self):
         self.search.result_view.clear()
         if self.model.kind == 'account':
-            transactions = AccountTransactionView.get_for_account(self.model, self.app.store)
-            self.append_transactions(transactions)
+            self.search.refresh()
         elif self.model.kind == 'payable':
             self._populate_payable_payments(OutPaymentView)
         elif self.model.kind == 'receivable':
@@ -212,10 +209,9 @@ class TransactionPage(object):
         if self.model.kind != 'account':
             return text
 
-        trans = account_view.transaction
         is_imbalance = self.app._imbalance_account_id in [
-            trans.dest_account_id,
-            trans.source_account_id]
+            account_view.dest_account_id,
+            account_view.source_account_id]
 
         renderer.set_property('weight-set', is_imbalance)
         if is_imbalance:
@@ -260,46 +256,13 @@ class TransactionPage(object):
                 SearchColumn('value', title=_("Value"),
                              data_type=currency)]
 
-    def append_transactions(self, transactions):
-        for transaction in transactions:
-            description = transaction.get_account_description(self.model)
-            value = transaction.get_value(self.model)
-            # If a transaction has the source equals to the destination account.
-            # Show the same transaction, but with reversed value.
-            if transaction.source_account_id == transaction.dest_account_id:
-                self._add_transaction(transaction, description, -value)
-            self._add_transaction(transaction, description, value)
-        self.update_totals()
-
     def _populate_payable_payments(self, view_class):
         for view in self.app.store.find(view_class):
             self.search.result_view.append(view)
 
-    def _add_transaction(self, transaction, description, value):
-        item = Settable(transaction=transaction)
-        self._update_transaction(item, transaction, description, value)
-        self.search.result_view.append(item)
-        return item
-
-    def _update_transaction(self, item, transaction, description, value):
-        item.account = description
-        item.date = transaction.date
-        item.description = transaction.description
-        item.value = value
-        item.code = transaction.code
-
-    def update_totals(self):
-        total = decimal.Decimal('0')
-        for item in self.search.result_view:
-            total += item.value
-            item.total = total
-
     def _edit_transaction_dialog(self, item):
         store = api.new_store()
-        if isinstance(item.transaction, AccountTransactionView):
-            account_transaction = store.fetch(item.transaction.transaction)
-        else:
-            account_transaction = store.fetch(item.transaction)
+        account_transaction = store.fetch(item.transaction)
         model = getattr(self.model, 'account', self.model)
 
         transaction = run_dialog(AccountTransactionEditor, self.app,
@@ -308,7 +271,6 @@ class TransactionPage(object):
         store.confirm(transaction)
         if transaction:
             self.app.refresh_pages()
-            self.update_totals()
             self.app.accounts.refresh_accounts(self.app.store)
         store.close()
 
@@ -328,7 +290,6 @@ class TransactionPage(object):
         store.confirm(transaction)
         if transaction:
             self.app.refresh_pages()
-            self.update_totals()
             self.app.accounts.refresh_accounts(self.app.store)
         store.close()
 
@@ -755,17 +716,11 @@ class FinancialApp(ShellApp):
                      _(u"Remove transaction"), _(u"Keep transaction")):
             return
 
-        account_transactions = self.get_current_page()
-        account_transactions.result_view.remove(item)
-
+        # The page is refreshed after this, with the balances updated
         store = api.new_store()
-        if isinstance(item.transaction, AccountTransactionView):
-            account_transaction = store.fetch(item.transaction.transaction)
-        else:
-            account_transaction = store.fetch(item.transaction)
+        account_transaction = store.fetch(item.transaction)
         account_transaction.delete(account_transaction.id, store=store)
         store.commit(close=True)
-        account_transactions.update_totals()
 
     def _print_transaction_report(self):
         assert not self._is_accounts_tab()
@@ -34,19 +34,17 @@ from kiwi.datatypes import converter, ValidationError
 from kiwi.python import Settable
 from kiwi.ui.objectlist import Column
 from kiwi.ui.widgets.contextmenu import ContextMenu, ContextMenuItem
-from storm.expr import And, Lower
 
 from stoqdrivers.enum import UnitType
 from stoqlib.api import api
 from stoqlib.domain.devices import DeviceSettings
 from stoqlib.domain.payment.group import PaymentGroup
-from stoqlib.domain.product import StorableBatch
 from stoqlib.domain.sale import Sale, Delivery
-from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.sellable import Sellable, sellable_lookup
 from stoqlib.drivers.scale import read_scale_info
 from stoqlib.exceptions import StoqlibError, TaxError
 from stoqlib.gui.events import POSConfirmSaleEvent, CloseLoanWizardFinishEvent
-from stoqlib.lib.barcode import parse_barcode, BarcodeInfo
+from stoqlib.lib.barcode import BarcodeInfo
 from stoqlib.lib.decorators import cached_property, public
 from stoqlib.lib.defaults import quantize
 from stoqlib.lib.formatters import (format_sellable_description,
@@ -251,6 +249,8 @@ class PosApp(ShellApp):
         self.uimanager.get_widget('/menubar/ViewMenu/ToggleToolbar').hide()
 
         self.check_open_inventory()
+        # Keep the barcodes in memory, so that reading them is fast
+        sellable_lookup.warm(self.store)
         self._update_parameter_widgets()
         self._update_widgets()
         # This is important to do after the other calls, since
@@ -504,39 +504,13 @@ class PosApp(ShellApp):
         text = unicode(text)
 
         fmt = api.sysparam.get_int('SCALE_BARCODE_FORMAT')
-
-        # Check if this barcode is from a scale
-        barinfo = parse_barcode(text, fmt)
+        sellable, batch, barinfo = sellable_lookup.find(
+            self.store, text,
+            accept=lambda s, b: s.status == Sellable.STATUS_AVAILABLE,
+            scale_barcode_format=fmt)
         if barinfo:
-            text = barinfo.code
             weight = barinfo.weight
 
-        batch = None
-        query = Sellable.status == Sellable.STATUS_AVAILABLE
-
-        # FIXME: Put this logic for getting the sellable based on
-        # barcode/code/batch_number on domain. Note that something very
-        # simular is done on abstractwizard.py
-
-        sellable = self.store.find(
-            Sellable, And(query, Lower(Sellable.barcode) == text.lower())).one()
-
-        # If the barcode didnt match, maybe the user typed the product code
-        if not sellable:
-            sellable = self.store.find(
-                Sellable, And(query, Lower(Sellable.code) == text.lower())).one()
-
-        # If none of the above found, try to get the batch number
-        if not sellable:
-            query = Lower(StorableBatch.batch_number) == text.lower()
-            batch = self.store.find(StorableBatch, query).one()
-            if batch:
-                sellable = batch.storable.product.sellable
-                if not sellable.is_available:
-                    # If the sellable is not available, reset both
-                    sellable = None
-                    batch = None
-
         # If the barcode has the price information, we need to calculate the
         # corresponding weight.
         if barinfo and sellable and barinfo.mode == BarcodeInfo.MODE_PRICE:
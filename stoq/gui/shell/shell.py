@@ -319,6 +319,19 @@ class Shell(object):
             seconds = minutes * 60
             glib.timeout_add_seconds(5, self._verify_idle_logout, seconds)
 
+    def _listen_parameter_changes(self):
+        # Reload the parameters as soon as another station modifies them
+        from stoqlib.database.runtime import get_default_store
+        from stoqlib.lib.parameters import sysparam
+        sysparam.listen(get_default_store())
+        glib.io_add_watch(sysparam.get_listen_fileno(), glib.IO_IN,
+                          self._on_parameter_notification)
+
+    def _on_parameter_notification(self, fd, condition):
+        from stoqlib.lib.parameters import sysparam
+        sysparam.process_notifications()
+        return True
+
     def _verify_idle_logout(self, seconds):
         # This is called once every 10 seconds
         from stoqlib.gui.utils.idle import get_idle_seconds
@@ -497,6 +510,7 @@ class Shell(object):
                 action.activate()
 
         self._maybe_schedule_idle_logout()
+        self._listen_parameter_changes()
 
         log.debug("Entering reactor")
         self._bootstrap.entered_main = True
@@ -35,7 +35,6 @@ from stoqlib.gui.dialogs.spreadsheetexporterdialog import SpreadSheetExporter
 from stoqlib.gui.events import ApplicationSetupSearchEvent
 from stoqlib.gui.search.searchslave import SearchSlave
 from stoqlib.gui.utils.printing import print_report
-from stoqlib.gui.widgets.lazyobjectlist import LazyObjectModel
 from stoqlib.lib.decorators import cached_function
 from stoqlib.lib.translation import stoqlib_gettext as _
 
@@ -215,14 +214,10 @@ class ShellApp(GladeDelegate):
         if self.search_spec is None:
             raise NotImplementedError
 
-        model = self.results.get_model()
-        if isinstance(model, LazyObjectModel):
-            model.load_items_from_results(0, model._count)
-
         sse = SpreadSheetExporter()
-        sse.export(object_list=self.results,
-                   name=self.app_name,
-                   filename_prefix=self.app_name)
+        sse.export_search(self.search,
+                          name=self.app_name,
+                          filename_prefix=self.app_name)
 
     def create_filters(self):
         """Implement this to provide filters for the search container"""
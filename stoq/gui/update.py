@@ -100,6 +100,11 @@ class UpdateSchemaStep(BaseWizardStep):
         elif line.startswith('BACKUP-START:'):
             text = _("Creating a database backup")
             longer = _('Creating a database backup in case anything goes wrong.')
+        elif line.startswith('BACKUP-PROGRESS:'):
+            done, total = line.split(':', 1)[1].split('/')
+            text = _("Creating a database backup (%s of %s tables)") % (
+                done, total)
+            longer = _('Creating a database backup in case anything goes wrong.')
         elif line.startswith('RESTORE-START:'):
             text = _("Restoring database backup")
             longer = _(
@@ -117,6 +122,16 @@ class UpdateSchemaStep(BaseWizardStep):
                 'possible to use Stoq %s again.\n\n'
                 'A backup database was created as <b>%s</b>') % (
                 stoq.version, msg, )
+        elif line.startswith('RESTORE-ERROR:'):
+            msg = line.split(':', 1)[1]
+            text = _("Could not restore the database backup")
+            longer = _(
+                'Stoq database update failed and the database could not be '
+                'restored.\n'
+                'An automatic crash report was submitted. Please, '
+                'enter in contact at <b>stoq-users@stoq.com.br</b> for '
+                'assistance in recovering your database.\n\n'
+                'The backup was kept as <b>%s</b>') % (msg, )
         else:
             return
         self.progressbar.set_text(text)
@@ -307,14 +307,22 @@ def _get_latest_schema():
     return schemas[-1]
 
 
+def get_database_functions():
+    """Get the sql of the functions we define on the database
+
+    :returns: data/sql/functions.sql, rendered
+    """
+    functions = environ.get_resource_string('stoq', 'sql', 'functions.sql')
+    return render_template_string(functions)
+
+
 def create_database_functions():
     """Create some functions we define on the database
 
     This will simply read data/sql/functions.sql and execute it
     """
     with tempfile.NamedTemporaryFile(suffix='stoqfunctions-') as tmp_f:
-        functions = environ.get_resource_string('stoq', 'sql', 'functions.sql')
-        tmp_f.write(render_template_string(functions))
+        tmp_f.write(get_database_functions())
         tmp_f.flush()
         if db_settings.execute_sql(tmp_f.name) != 0:
             error(u'Failed to create functions')
@@ -30,7 +30,7 @@ Most of them are specific to PostgreSQL
 
 from storm.expr import (Expr, NamedFunc, PrefixExpr, SQL, ComparableExpr,
                         compile as expr_compile, FromExpr, Undef, EXPR,
-                        is_safe_token, BinaryOper, SetExpr)
+                        is_safe_token, BinaryOper, SetExpr, JoinExpr)
 
 
 class Age(NamedFunc):
@@ -279,6 +279,65 @@ class UnionAll(SetExpr):
 expr_compile.set_precedence(10, UnionAll)
 
 
+class FullJoin(JoinExpr):
+    """Join returning the rows of both tables, even when they don't match"""
+    # http://www.postgresql.org/docs/9.1/static/queries-table-expressions.html
+    __slots__ = ()
+    oper = "FULL JOIN"
+
+
+expr_compile.set_precedence(10, FullJoin)
+
+
+class DeclareCursor(Expr):
+    """Declares a server side cursor for a select
+
+    The rows can then be fetched with ``FETCH FORWARD n FROM name``.
+    The cursor only lives until the end of the transaction.
+    """
+    # http://www.postgresql.org/docs/9.1/static/sql-declare.html
+    __slots__ = ('name', 'select')
+
+    def __init__(self, name, select):
+        self.name = name
+        self.select = select
+
+
+@expr_compile.when(DeclareCursor)
+def compile_declare_cursor(compile, expr, state):
+    return 'DECLARE %s NO SCROLL CURSOR FOR %s' % (
+        expr.name, compile(expr.select, state))
+
+
+class Over(ComparableExpr):
+    """Calls an aggregate over a window of the rows
+
+    The aggregate is computed for each row, over the rows of its
+    partition. With an order, only the rows up to the current one are
+    considered, eg. a running sum::
+
+        Over(Sum(Entry.value), partition_by=[Entry.account_id],
+             order_by=[Entry.date, Entry.id])
+    """
+    # http://www.postgresql.org/docs/9.1/static/tutorial-window.html
+    __slots__ = ('expr', 'partition_by', 'order_by')
+
+    def __init__(self, expr, partition_by=Undef, order_by=Undef):
+        self.expr = expr
+        self.partition_by = partition_by
+        self.order_by = order_by
+
+
+@expr_compile.when(Over)
+def compile_over(compile, expr, state):
+    window = []
+    if expr.partition_by is not Undef:
+        window.append('PARTITION BY ' + compile(expr.partition_by, state))
+    if expr.order_by is not Undef:
+        window.append('ORDER BY ' + compile(expr.order_by, state))
+    return '%s OVER (%s)' % (compile(expr.expr, state), ' '.join(window))
+
+
 def is_sql_identifier(identifier):
     return (not expr_compile.is_reserved_word(identifier) and
             is_safe_token(identifier))
@@ -30,15 +30,19 @@ import logging
 import os
 import re
 import shutil
+import StringIO
 import sys
 import tempfile
+import time
 import traceback
 
 from kiwi.environ import environ
 
+from stoqlib.database.exceptions import PostgreSQLError, SQLError
 from stoqlib.database.runtime import (get_default_store,
                                       new_store)
-from stoqlib.database.settings import db_settings, check_extensions
+from stoqlib.database.settings import (db_settings, check_extensions,
+                                       get_dump_jobs)
 from stoqlib.domain.plugin import InstalledPlugin
 from stoqlib.domain.profile import update_profile_applications
 from stoqlib.exceptions import (DatabaseInconsistency, StoqlibError,
@@ -54,6 +58,164 @@ log = logging.getLogger(__name__)
 # Used by the wizard
 create_log = logging.getLogger('stoqlib.database.create')
 
+_CREATE_INDEX_RE = re.compile(
+    r'^CREATE\s+INDEX\s+(\w+)\s+ON\s+(\w+)\b', re.IGNORECASE)
+_COPY_FROM_STDIN_RE = re.compile(
+    r'^COPY\b.*\bFROM\s+stdin\b', re.IGNORECASE | re.DOTALL)
+_COPY_END_RE = re.compile(r'^\\\.[ \t\r]*$', re.MULTILINE)
+_DOLLAR_QUOTE_RE = re.compile(r'\$(?:[A-Za-z_]\w*)?\$')
+_ERROR_LINE_RE = re.compile(r'^LINE (\d+):', re.MULTILINE)
+_VARIABLE_RE = re.compile(r'(?<![:\w]):([A-Za-z_]\w*)')
+
+
+def split_sql(data):
+    """Split an sql script in statements
+
+    Quoted strings and identifiers, escape strings (``E'...'``), dollar
+    quoted strings (used by function bodies) and comments are taken into
+    account when looking for the semicolons that end the statements.
+
+    Some psql constructs are also understood: lines starting with a
+    backslash, like ``\\set``, are returned as statements of their own and
+    the rows of a ``COPY ... FROM stdin`` are returned in its statement,
+    after the semicolon and a line break, up to the ``\\.`` line.
+
+    :param data: the sql script
+    :returns: a list of (line number, statement) tuples, where line number
+      is the line of the script where the statement starts
+    """
+    statements = []
+    start = None
+    i = 0
+    length = len(data)
+    while i < length:
+        char = data[i]
+        if data.startswith('--', i):
+            end = data.find('\n', i)
+            i = length if end == -1 else end
+            continue
+        elif data.startswith('/*', i):
+            end = data.find('*/', i + 2)
+            i = length if end == -1 else end + 2
+            continue
+        elif char.isspace():
+            i += 1
+            continue
+
+        if start is None:
+            start = i
+            if char == '\\':
+                # A psql meta command, which ends at the end of the line
+                end = data.find('\n', i)
+                end = length if end == -1 else end
+                statements.append((data.count('\n', 0, start) + 1,
+                                   data[start:end].strip()))
+                start = None
+                i = end
+                continue
+        if char == ';':
+            statement = data[start:i].strip()
+            i += 1
+            if _COPY_FROM_STDIN_RE.match(statement):
+                # The rows start on the next line and end on a \. line
+                end = data.find('\n', i)
+                rows_start = length if end == -1 else end + 1
+                match = _COPY_END_RE.search(data, rows_start)
+                rows_end = length if match is None else match.start()
+                statement += ';\n' + data[rows_start:rows_end]
+                i = length if match is None else match.end()
+            statements.append((data.count('\n', 0, start) + 1, statement))
+            start = None
+        elif char == "'" and _is_escape_string(data, i):
+            i = _skip_escape_string(data, i + 1)
+        elif char in '\'"':
+            # A doubled quote is an escaped one, it will be seen
+            # as two strings next to each other
+            end = data.find(char, i + 1)
+            i = length if end == -1 else end + 1
+        elif char == '$':
+            match = _DOLLAR_QUOTE_RE.match(data, i)
+            if match is None:
+                i += 1
+                continue
+            tag = match.group()
+            end = data.find(tag, match.end())
+            i = length if end == -1 else end + len(tag)
+        else:
+            i += 1
+
+    if start is not None:
+        statements.append((data.count('\n', 0, start) + 1,
+                           data[start:].strip()))
+    return statements
+
+
+def _is_escape_string(data, i):
+    # E'...', but not an identifier ending with an e followed by a quote
+    return (i > 0 and data[i - 1] in 'eE' and
+            (i < 2 or not (data[i - 2].isalnum() or data[i - 2] == '_')))
+
+
+def _skip_escape_string(data, i):
+    # Backslashes escape the next character inside escape strings, and
+    # a doubled quote is still an escaped one
+    length = len(data)
+    while i < length:
+        char = data[i]
+        if char == '\\':
+            i += 2
+        elif data.startswith("''", i):
+            i += 2
+        elif char == "'":
+            return i + 1
+        else:
+            i += 1
+    return length
+
+
+def _execute_statement(store, filename, lineno, statement):
+    # The statements are passed directly to psycopg2, since storm
+    # would replace the question marks in them by parameters
+    connection = store._connection
+    try:
+        if _COPY_FROM_STDIN_RE.match(statement):
+            command, rows = statement.split(';\n', 1)
+            cursor = connection.build_raw_cursor()
+            cursor.copy_expert(command, StringIO.StringIO(rows))
+        else:
+            cursor = connection.raw_execute(statement, ())
+    except PostgreSQLError as e:
+        raise SQLError('%s:%d: %s' % (
+            os.path.basename(filename),
+            _get_error_line(e, lineno, statement),
+            (e.pgerror or str(e)).strip().split('\n')[0]))
+    cursor.close()
+
+
+def _remove_dump(filename):
+    # Parallel dumps are directories, and the blobs may have been
+    # dumped to a file of their own
+    if os.path.isdir(filename):
+        shutil.rmtree(filename)
+    elif os.path.exists(filename):
+        os.unlink(filename)
+    if os.path.exists(filename + '-blobs'):
+        os.unlink(filename + '-blobs')
+
+
+def _get_error_line(exc, lineno, statement):
+    # Postgres reports the position of some errors inside the statement,
+    # translate it to a line of the patch.
+    diag = getattr(exc, 'diag', None)
+    position = diag and diag.statement_position
+    if position:
+        return lineno + statement.count('\n', 0, int(position) - 1)
+
+    match = _ERROR_LINE_RE.search(exc.pgerror or '')
+    if match:
+        return lineno + int(match.group(1)) - 1
+    return lineno
+
 
 class Patch(object):
     """A Database Patch
@@ -83,33 +245,18 @@ class Patch(object):
 
     def apply(self, store):
         """Apply the patch
-        :param store: a store
-        """
 
-        # Dont lock the database here, since StoqlibSchemaMigration.update has
-        # already did that before starting to apply the patches
+        The patch and the update of the migration versioning information
+        are executed on *store*, but not committed, see :class:`PatchRunner`.
 
+        :param store: a store
+        """
         # SQL statement to update the system_table
         sql = self._migration.generate_sql_for_patch(self)
 
         if self.filename.endswith('.sql'):
-            # Create a temporary file used for writing SQL statements
-            temporary = tempfile.mktemp(prefix="patch-%d-%d-" % self.get_version())
-
-            # Overwrite the temporary file with the sql patch we want to apply
-            shutil.copy(self.filename, temporary)
-
-            # After successfully executing the SQL statements, we need to
-            # make sure that the system_table is updated with the correct
-            # schema generation and patchlevel
-            open(temporary, 'a').write(sql)
-
-            retcode = db_settings.execute_sql(temporary)
-            if retcode != 0:
-                error('Failed to apply %s, psql returned error code: %d' % (
-                    os.path.basename(self.filename), retcode))
-
-            os.unlink(temporary)
+            for lineno, statement in self.get_statements():
+                self._execute(store, lineno, statement)
         elif self.filename.endswith('.py'):
             # Execute the patch, we cannot use __import__() since there are
             # hyphens in the filename and data/sql lacks an __init__.py
@@ -117,27 +264,262 @@ class Patch(object):
             execfile(self.filename, ns, ns)
             function = ns['apply_patch']
 
-            # Create a new store that will be used to apply the patch and
-            # to update the system tables after the patch has been successfully
-            # applied
-            patch_store = new_store()
-
-            # Apply the patch itself
-            function(patch_store)
-
-            # After applying the patch, update the system_table within the same
-            # transaction
-            patch_store.execute(sql)
-            patch_store.commit(close=True)
+            # Some patches commit the store themselves, but everything
+            # needs to stay on the runner's transaction
+            commit = store.commit
+            store.commit = lambda close=False: store.flush()
+            try:
+                function(store)
+            finally:
+                store.commit = commit
+            store.flush()
         else:
             raise AssertionError("Unknown filename: %s" % (self.filename, ))
 
+        # After applying the patch, update the system_table within the same
+        # transaction
+        store.execute(sql)
+
+    def get_statements(self):
+        """Get the statements of an sql patch
+
+        :returns: a list of (line number, statement) tuples
+        """
+        data = open(self.filename).read()
+        # Rename serial into bigserial, for 64-bit id columns
+        data = data.replace('id serial', 'id bigserial')
+
+        # Interpolate the variables defined with \set, like psql does
+        variables = {}
+        statements = []
+        for lineno, statement in split_sql(data):
+            if statement.startswith('\\'):
+                self._set_variable(variables, lineno, statement)
+                continue
+            if variables and not _COPY_FROM_STDIN_RE.match(statement):
+                statement = _VARIABLE_RE.sub(
+                    lambda m: variables.get(m.group(1), m.group(0)),
+                    statement)
+            statements.append((lineno, statement))
+        return statements
+
+    def get_source(self):
+        """Get the source code of the patch
+
+        :returns: the contents of the patch file
+        """
+        return open(self.filename).read()
+
     def get_version(self):
         """Returns the patch version
         :returns: a tuple with the patch generation and level
         """
         return self.generation, self.level
 
+    def _set_variable(self, variables, lineno, command):
+        # Only \set is supported, the comments after the value are
+        # not part of it
+        args = command.split('--', 1)[0].split()
+        if args[0] != '\\set' or len(args) < 2:
+            raise SQLError('%s:%d: unsupported psql command %s' % (
+                os.path.basename(self.filename), lineno, args[0]))
+        variables[args[1]] = ''.join(args[2:])
+
+    def _execute(self, store, lineno, statement):
+        _execute_statement(store, self.filename, lineno, statement)
+
+
+class PatchRunner(object):
+    """Applies patches on a single database connection
+
+    All the patches are applied on the same transaction, each one inside
+    its own savepoint. When a patch fails, it is rolled back to its
+    savepoint and the patches applied before it are committed, so the
+    next update will continue from it.
+
+    Indexes created by the patches on tables that already exist are
+    created concurrently after the patches are committed, so the tables
+    are not locked while the index is built. That is only done for
+    non unique indexes when neither the index nor its table are
+    referenced by the following patches, since they could depend on the
+    index to exist or drop and rename the table or its columns.
+
+    Those indexes are recorded on the schema_deferred_index table, on
+    the transaction of the patches, and removed from it once created.
+    The ones that could not be created are created again on the next
+    update, before its patches are applied.
+
+    :param migration: the :class:`SchemaMigration` of the patches
+    :param dry_run: if ``True``, the patches will be rolled back
+      instead of committed
+    :param concurrent_indexes: if indexes should be created concurrently
+      when possible
+    """
+
+    def __init__(self, migration, dry_run=False, concurrent_indexes=True):
+        self.migration = migration
+        self.dry_run = dry_run
+        self.concurrent_indexes = concurrent_indexes and not dry_run
+        #: a list of (name, seconds) tuples, for each patch and index
+        #: created concurrently
+        self.timings = []
+        #: the names of the indexes that could not be created after the
+        #: patches were committed
+        self.failed_indexes = []
+
+    #
+    #  Public API
+    #
+
+    def apply(self, patches, on_patch=None, functions=None):
+        """Apply patches
+
+        :param patches: a list of :class:`Patch`
+        :param on_patch: if not ``None``, a callable that will be called
+          with the index and the patch before applying each patch
+        :param functions: if not ``None``, the sql of the database
+          functions, created on the same transaction before the patches
+        :raises: :exc:`SQLError` when a sql patch fails, with the
+          patch filename and line number in the message
+        """
+        store = new_store()
+        try:
+            if self.concurrent_indexes:
+                # Indexes that could not be created by the last update
+                self._create_deferred_indexes(store, [])
+            store.execute("SET LOCAL client_min_messages TO 'warning'",
+                          noresult=True)
+            if functions is not None:
+                for lineno, statement in split_sql(functions):
+                    _execute_statement(store, 'functions.sql', lineno,
+                                       statement)
+            tables = set(row[0] for row in store.execute(
+                "SELECT tablename FROM pg_tables "
+                "WHERE schemaname = 'public'").get_all())
+            sources = [patch.get_source() for patch in patches]
+
+            deferred = []
+            for i, patch in enumerate(patches):
+                name = os.path.basename(patch.filename)
+                if on_patch is not None:
+                    on_patch(i, patch)
+                savepoint = 'patch_%d_%d' % patch.get_version()
+                store.savepoint(savepoint)
+                start = time.time()
+                n_deferred = len(deferred)
+                try:
+                    self._apply_patch(store, patch, tables,
+                                      ''.join(sources[i + 1:]), deferred)
+                except Exception:
+                    store.rollback_to_savepoint(savepoint)
+                    # The indexes of the patches that will be committed
+                    # are created on the next update
+                    del deferred[n_deferred:]
+                    self._save_deferred_indexes(store, deferred)
+                    self._finish(store)
+                    raise
+                self._add_timing(name, time.time() - start)
+
+            deferred = self._save_deferred_indexes(store, deferred)
+            self._finish(store)
+            if self.concurrent_indexes:
+                self._create_deferred_indexes(store, deferred)
+        finally:
+            store.close()
+
+    #
+    #  Private
+    #
+
+    def _apply_patch(self, store, patch, tables, following, deferred):
+        if not (self.concurrent_indexes and patch.filename.endswith('.sql')):
+            patch.apply(store)
+            return
+
+        sql = self.migration.generate_sql_for_patch(patch)
+        for lineno, statement in patch.get_statements():
+            match = _CREATE_INDEX_RE.match(statement)
+            if (match and match.group(2) in tables and
+                    not re.search(r'\b(%s|%s)\b' % match.groups(),
+                                  following)):
+                deferred.append((os.path.basename(patch.filename), lineno,
+                                 statement))
+            else:
+                patch._execute(store, lineno, statement)
+        store.execute(sql)
+
+    def _save_deferred_indexes(self, store, deferred):
+        # Databases that were not updated to have the table yet only
+        # keep them in memory
+        if not deferred or not store.table_exists(u'schema_deferred_index'):
+            return [(None, ) + index for index in deferred]
+        for filename, lineno, statement in deferred:
+            store.execute(
+                "INSERT INTO schema_deferred_index (filename, lineno, statement) "
+                "VALUES (?, ?, ?)", (unicode(filename), lineno,
+                                     unicode(statement)), noresult=True)
+        return []
+
+    def _create_deferred_indexes(self, store, deferred):
+        if store.table_exists(u'schema_deferred_index'):
+            deferred = deferred + store.execute(
+                "SELECT id, filename, lineno, statement "
+                "FROM schema_deferred_index ORDER BY id").get_all()
+        # Nothing can be running on the transaction when switching to
+        # autocommit
+        store.commit()
+
+        for index_id, filename, lineno, statement in deferred:
+            name = _CREATE_INDEX_RE.match(statement).group(1)
+            if name in self.failed_indexes:
+                # Already tried before the patches were applied
+                continue
+            try:
+                self._create_index_concurrently(store, filename, lineno,
+                                                statement)
+            except SQLError as e:
+                store.rollback(close=False)
+                log.error("Could not create %s, it will be created on the "
+                          "next update: %s" % (name, e))
+                self.failed_indexes.append(name)
+                continue
+            if index_id is not None:
+                store.execute("DELETE FROM schema_deferred_index WHERE id = ?",
+                              (index_id, ), noresult=True)
+                store.commit()
+
+    def _create_index_concurrently(self, store, filename, lineno, statement):
+        name = _CREATE_INDEX_RE.match(statement).group(1)
+        start = time.time()
+        # CREATE INDEX CONCURRENTLY cannot be executed inside a transaction
+        raw_connection = store._connection._raw_connection
+        raw_connection.autocommit = True
+        try:
+            _execute_statement(store, filename, lineno, re.sub(
+                r'^CREATE\s+INDEX', 'CREATE INDEX CONCURRENTLY', statement,
+                flags=re.IGNORECASE))
+        except SQLError as e:
+            # A failed concurrent build leaves an invalid index behind,
+            # drop it and build the index normally
+            log.info("Could not create %s concurrently: %s" % (name, e))
+            store.execute('DROP INDEX IF EXISTS %s' % (name, ))
+            raw_connection.autocommit = False
+            _execute_statement(store, filename, lineno, statement)
+            store.commit()
+        finally:
+            raw_connection.autocommit = False
+        self._add_timing(name, time.time() - start)
+
+    def _finish(self, store):
+        if self.dry_run:
+            store.rollback(close=False)
+        else:
+            store.commit()
+
+    def _add_timing(self, name, seconds):
+        log.info("%s applied in %.3fs" % (name, seconds))
+        self.timings.append((name, seconds))
+
 
 class SchemaMigration(object):
     """Schema migration management
@@ -162,6 +544,7 @@ class SchemaMigration(object):
                 _("%s needs to have the patch_patterns class variable set") % (
                     self.__class__.__name__))
         self.default_store = get_default_store()
+        self.runner = None
 
         try:
             check_extensions(store=self.default_store)
@@ -194,9 +577,12 @@ class SchemaMigration(object):
 
         return sorted(patches)
 
-    def _update_schema(self):
+    def _update_schema(self, dry_run=False):
         """Check the current version of database and update the schema if
         it's needed
+
+        :param dry_run: if ``True``, the patches will be rolled back
+          after applied
         """
         log.info("Updating schema")
 
@@ -216,23 +602,27 @@ class SchemaMigration(object):
                     continue
                 patches_to_apply.append(patch)
 
-            from stoqlib.database.admin import create_database_functions
-            create_database_functions()
+            # The functions are recreated on the transaction of the
+            # patches, so that a dry run rolls them back too
+            from stoqlib.database.admin import get_database_functions
 
             log.info("Applying %d patches" % (len(patches_to_apply), ))
             create_log.info("PATCHES:%d" % (len(patches_to_apply), ))
 
-            for patch in patches_to_apply:
-                create_log.info("PATCH:%d.%d" % (patch.generation,
-                                                 patch.level))
-                patch.apply(self.default_store)
+            self.runner = PatchRunner(self, dry_run=dry_run)
+            self.runner.apply(
+                patches_to_apply,
+                on_patch=lambda i, patch: create_log.info(
+                    "PATCH:%d.%d" % (patch.generation, patch.level)),
+                functions=get_database_functions())
 
             assert patches_to_apply
             log.info("All patches (%s) applied." % (
                 ', '.join(str(p.level) for p in patches_to_apply)))
             last_level = patches_to_apply[-1].get_version()
 
-        self.after_update()
+        if not dry_run:
+            self.after_update()
 
         return current_version, last_level
 
@@ -290,25 +680,41 @@ class SchemaMigration(object):
                 to_apply.append(patch)
 
         self._log("PATCHES:%d" % (len(to_apply), ))
-        for i, patch in enumerate(to_apply):
-            self._log("PATCH:%d" % (i, ))
-            patch.apply(self.default_store)
+        self.runner = PatchRunner(self)
+        self.runner.apply(
+            to_apply, on_patch=lambda i, patch: self._log("PATCH:%d" % (i, )))
 
         self._log("PATCHES APPLIED")
 
-    def update(self):
+    def update(self, dry_run=False):
         """Updates the database schema
+
+        :param dry_run: if ``True``, the patches will be applied and
+          timed, but rolled back at the end
         """
         if self.check_uptodate():
             print('Database is already at the latest version %d.%d' % (
                 self.get_current_version()))
         else:
-            from_, to = self._update_schema()
+            from_, to = self._update_schema(dry_run=dry_run)
             if to is None:
                 print('Database schema is already up to date')
+                return
+
+            for name, seconds in self.runner.timings:
+                print('%-30s %8.3fs' % (name, seconds))
+            print('%-30s %8.3fs' % (
+                'Total', sum(seconds for name, seconds in self.runner.timings)))
+            for name in self.runner.failed_indexes:
+                print('Could not create the index %s, it will be created '
+                      'on the next update' % (name, ))
+
+            f = "(%d.%d)" % from_
+            t = "(%d.%d)" % to
+            if dry_run:
+                print('Database schema would be updated from %s to %s' % (
+                    f, t))
             else:
-                f = "(%d.%d)" % from_
-                t = "(%d.%d)" % to
                 print('Database schema updated from %s to %s' % (f, t))
 
     def get_current_version(self):
@@ -355,9 +761,13 @@ class StoqlibSchemaMigration(SchemaMigration):
 
         return retval
 
-    def update(self, plugins=True, backup=True):
-        log.info("Upgrading database (plugins=%r, backup=%r)" % (
-            plugins, backup))
+    def update(self, plugins=True, backup=True, dry_run=False):
+        log.info("Upgrading database (plugins=%r, backup=%r, dry_run=%r)" % (
+            plugins, backup, dry_run))
+        if dry_run:
+            # Nothing will be changed, and the plugin patches may depend
+            # on the patches that will be rolled back
+            plugins = backup = False
 
         try:
             log.info("Locking database")
@@ -368,8 +778,8 @@ class StoqlibSchemaMigration(SchemaMigration):
                     'before updating the database')
             error(msg)
 
-        # Database migration is actually run in subprocesses, We need to unlock
-        # the tables again and let the upgrade continue
+        # The patches are applied on a connection of their own, We need to
+        # unlock the tables again and let the upgrade continue
         log.info("Releasing database lock")
         self.default_store.unlock_database()
 
@@ -388,8 +798,14 @@ class StoqlibSchemaMigration(SchemaMigration):
             temporary = tempfile.mktemp(prefix="stoq-dump-")
             log.info("Making a backup to %s" % (temporary, ))
             create_log.info("BACKUP-START:")
-            success = db_settings.dump_database(temporary)
+            # The blobs are dumped without compression, and all the
+            # processors are used to dump the other tables
+            success = db_settings.dump_database(
+                temporary, jobs=get_dump_jobs(), blobs='separate',
+                progress=lambda done, total: create_log.info(
+                    "BACKUP-PROGRESS:%d/%d" % (done, total)))
             if not success:
+                _remove_dump(temporary)
                 info(_(u'Could not create backup! Aborting.'))
                 info(_(u'Please contact stoq team to inform this problem.\n'))
                 return
@@ -398,7 +814,7 @@ class StoqlibSchemaMigration(SchemaMigration):
         # support python previous to 2.5 version.
         try:
             try:
-                super(StoqlibSchemaMigration, self).update()
+                super(StoqlibSchemaMigration, self).update(dry_run=dry_run)
                 if plugins:
                     self.update_plugins()
             except Exception:
@@ -410,12 +826,20 @@ class StoqlibSchemaMigration(SchemaMigration):
                 if backup:
                     log.info("Restoring backup %s" % (temporary, ))
                     create_log.info("RESTORE-START:")
-                    new_name = db_settings.restore_database(temporary)
-                    create_log.info("RESTORE-DONE:%s" % (new_name, ))
+                    try:
+                        new_name = db_settings.restore_database(
+                            temporary, jobs=get_dump_jobs())
+                    except DatabaseError as e:
+                        # Keep the backup, it can still be restored by hand
+                        log.error("Could not restore %s: %s" % (temporary, e))
+                        create_log.info("RESTORE-ERROR:%s" % (temporary, ))
+                        backup = False
+                    else:
+                        create_log.info("RESTORE-DONE:%s" % (new_name, ))
                 return False
         finally:
             if backup is True:
-                os.unlink(temporary)
+                _remove_dump(temporary)
         log.info("Migration done")
         return True
 
@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""A pool of database connections shared by the stores
+
+Opening a connection to postgres means a TCP (and maybe SSL) handshake,
+authentication and some setup queries, which is expensive when the
+database is on a remote branch. :class:`PooledPostgres` is a storm database
+that keeps the raw connections of closed stores around so that the next
+store can reuse them.
+"""
+
+import collections
+import logging
+import os
+import threading
+import time
+import weakref
+
+import psycopg2
+from storm.database import Connection
+from storm.databases.postgres import Postgres, PostgresConnection
+from storm.tracer import trace
+
+from stoqlib.database.statements import (PreparedStatements,
+                                         is_statement_cache_enabled)
+from stoqlib.net.socketutils import get_hostname
+
+log = logging.getLogger(__name__)
+
+#: pooled databases, indexed by their uri
+_databases = {}
+
+#: The default number of idle connections kept by the pool
+DEFAULT_POOL_SIZE = 5
+#: Idle connections older than this (in seconds) are checked before reused
+HEALTH_CHECK_INTERVAL = 30
+
+#: Executed on the connections given back to the pool, so that the session
+#: state of a store doesn't leak to the next one
+_RESET_STATEMENTS = ['RESET ALL', 'UNLISTEN *', 'DISCARD TEMP']
+
+
+def get_application_name():
+    """Get the name used to identify our connections on pg_stat_activity"""
+    return 'stoq - %s - %s' % (get_hostname(), os.getpid())
+
+
+class PooledPostgresConnection(PostgresConnection):
+    """A storm connection that gives its raw connection back to the pool
+    when closed, instead of closing it.
+    """
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        raw_connection = self._raw_connection
+        self._raw_connection = None
+        if raw_connection is not None:
+            self._database.release_raw_connection(raw_connection)
+
+    def raw_execute(self, statement, params=None):
+        # The SELECTs executed often are prepared on the raw connection,
+        # see stoqlib.database.statements
+        raw_connection = self._raw_connection
+        if (not params or not is_statement_cache_enabled() or
+                raw_connection is None or raw_connection.autocommit):
+            return super(PooledPostgresConnection, self).raw_execute(
+                statement, params)
+
+        if type(statement) is unicode:
+            statement = statement.encode('utf-8')
+        prepared = self._database.get_prepared_statements(raw_connection)
+        key = prepared.accept(statement, params)
+        if key is None:
+            return Connection.raw_execute(self, statement, params)
+
+        raw_cursor = self._check_disconnect(self.build_raw_cursor)
+        raw_params = tuple(self.to_database(params))
+        trace("connection_raw_execute", self, raw_cursor, statement,
+              raw_params)
+        try:
+            self._check_disconnect(prepared.execute, raw_cursor, key,
+                                   raw_params)
+        except Exception as error:
+            trace("connection_raw_execute_error", self, raw_cursor,
+                  statement, raw_params, error)
+            raise
+        trace("connection_raw_execute_success", self, raw_cursor,
+              statement, raw_params)
+        return raw_cursor
+
+
+class PooledPostgres(Postgres):
+    """A postgres database that pools its raw connections
+
+    The application name and the client encoding are passed on the
+    connection string, so they are the session defaults and a ``RESET ALL``
+    brings them back. When a connection is given back it is rolled back,
+    has its settings reset, its notification channels unlistened and its
+    temporary tables dropped. If that fails, or if the pool already has
+    *size* idle connections, it is closed. The prepared statements are
+    kept, see :meth:`.get_prepared_statements`.
+
+    :param uri: the uri of the database
+    :param size: the maximum number of idle connections to keep
+    """
+
+    connection_factory = PooledPostgresConnection
+
+    def __init__(self, uri, size=DEFAULT_POOL_SIZE):
+        super(PooledPostgres, self).__init__(uri)
+        self.dbname = uri.database
+        self._dsn += " application_name='%s' client_encoding='UTF8'" % (
+            get_application_name().replace("'", "\\'"), )
+        self.size = size
+        self._idle = collections.deque()
+        self._prepared = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+        self._stats = dict(created=0, reused=0, discarded=0,
+                           health_check_failures=0, in_use=0)
+
+    #
+    #  Database
+    #
+
+    def raw_connect(self):
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                raw_connection, released_at = self._idle.pop()
+            if self._is_healthy(raw_connection, released_at):
+                with self._lock:
+                    self._stats['reused'] += 1
+                    self._stats['in_use'] += 1
+                return raw_connection
+
+        raw_connection = super(PooledPostgres, self).raw_connect()
+        with self._lock:
+            self._stats['created'] += 1
+            self._stats['in_use'] += 1
+        return raw_connection
+
+    #
+    #  Public API
+    #
+
+    def release_raw_connection(self, raw_connection):
+        """Gives a raw connection back to the pool
+
+        :param raw_connection: a psycopg2 connection obtained
+          from :meth:`.raw_connect`
+        """
+        with self._lock:
+            self._stats['in_use'] -= 1
+
+        if not self._reset(raw_connection):
+            self._discard(raw_connection)
+            return
+
+        with self._lock:
+            if len(self._idle) < self.size:
+                self._idle.append((raw_connection, time.time()))
+                return
+        self._discard(raw_connection)
+
+    def warm(self, count=1):
+        """Opens connections so the next stores don't need to wait for them
+
+        :param count: the number of idle connections the pool should have
+        """
+        count = min(count, self.size)
+        while len(self._idle) < count:
+            raw_connection = super(PooledPostgres, self).raw_connect()
+            with self._lock:
+                self._stats['created'] += 1
+                self._idle.append((raw_connection, time.time()))
+
+    def clear(self):
+        """Closes all the idle connections"""
+        with self._lock:
+            idle = list(self._idle)
+            self._idle.clear()
+        for raw_connection, released_at in idle:
+            self._discard(raw_connection)
+
+    def raw_connect_unpooled(self):
+        """Opens a connection that doesn't come from the pool
+
+        It should be used by connections that keep session state, like
+        the ones listening for notifications. It is not counted on the
+        pool statistics and should be closed instead of released.
+
+        :returns: a psycopg2 connection
+        """
+        return super(PooledPostgres, self).raw_connect()
+
+    def get_prepared_statements(self, raw_connection):
+        """Get the statements prepared on a raw connection
+
+        :param raw_connection: a psycopg2 connection obtained
+          from :meth:`.raw_connect`
+        :returns: a :class:`stoqlib.database.statements.PreparedStatements`
+        """
+        with self._lock:
+            prepared = self._prepared.get(raw_connection)
+            if prepared is None:
+                prepared = self._prepared[raw_connection] = (
+                    PreparedStatements())
+        return prepared
+
+    def get_stats(self):
+        """Get statistics about the pool usage
+
+        :returns: a dict with the pool ``size``, the number of ``idle``
+          and ``in_use`` connections and the number of connections
+          ``created``, ``reused``, ``discarded`` and that failed
+          the health check since the pool was created
+        """
+        with self._lock:
+            stats = self._stats.copy()
+            stats['idle'] = len(self._idle)
+        stats['size'] = self.size
+        return stats
+
+    #
+    #  Private
+    #
+
+    def _reset(self, raw_connection):
+        if raw_connection.closed:
+            return False
+        try:
+            raw_connection.rollback()
+            cursor = raw_connection.cursor()
+            # Not DISCARD ALL, since it would also deallocate the
+            # prepared statements
+            for statement in _RESET_STATEMENTS:
+                cursor.execute(statement)
+            cursor.close()
+            raw_connection.commit()
+        except psycopg2.Error as e:
+            log.info('Could not reset connection: %s' % (e, ))
+            return False
+        return True
+
+    def _is_healthy(self, raw_connection, released_at):
+        if raw_connection.closed:
+            healthy = False
+        elif time.time() - released_at < HEALTH_CHECK_INTERVAL:
+            healthy = True
+        else:
+            try:
+                cursor = raw_connection.cursor()
+                cursor.execute("SELECT 1")
+                cursor.close()
+                raw_connection.rollback()
+                healthy = True
+            except psycopg2.Error as e:
+                log.info('Discarding broken connection: %s' % (e, ))
+                healthy = False
+
+        if not healthy:
+            with self._lock:
+                self._stats['health_check_failures'] += 1
+            self._discard(raw_connection)
+        return healthy
+
+    def _discard(self, raw_connection):
+        with self._lock:
+            self._stats['discarded'] += 1
+        try:
+            raw_connection.close()
+        except psycopg2.Error:
+            pass
+
+
+def get_pooled_database(uri, size=DEFAULT_POOL_SIZE):
+    """Get the pooled database for an uri
+
+    The same database is returned for the same uri, so that all the stores
+    connected to it share the same connections.
+
+    :param uri: a storm uri
+    :param size: the size of the pool, only used when it gets created
+    :returns: a :class:`PooledPostgres`
+    """
+    key = str(uri)
+    database = _databases.get(key)
+    if database is None:
+        database = _databases[key] = PooledPostgres(uri, size=size)
+    return database
+
+
+def clear_pools(dbname=None):
+    """Closes the idle connections of the pooled databases
+
+    This needs to be done before dropping a database, since postgres will
+    refuse to drop it while there are connections to it.
+
+    :param dbname: if not ``None``, only clear the pools connected to it
+    """
+    for database in _databases.values():
+        if dbname is None or database.dbname == dbname:
+            database.clear()
+
+
+def get_pool_stats():
+    """Get statistics about all the pooled databases
+
+    :returns: a dict mapping the database name to the
+      :meth:`PooledPostgres.get_stats` of its pool
+    """
+    stats = {}
+    for database in _databases.values():
+        stats[database.dbname] = database.get_stats()
+    return stats
@@ -40,6 +40,30 @@ from stoqlib.database.viewable import Viewable
 from stoqlib.database.interfaces import ISearchFilter
 
 
+def _escape_like(value):
+    """Escape the LIKE wildcards present on value
+
+    :param value: the text typed by the user
+    :returns: the text, lowercased and with ``\\``, ``%`` and ``_`` escaped
+    """
+    value = value.lower()
+    for char in [u'\\', u'%', u'_']:
+        value = value.replace(char, u'\\' + char)
+    return value
+
+
+def _split_words(text):
+    """Split text in lowercased words, removing duplicates
+
+    The order of the words is kept, so the generated query is stable
+    """
+    words = []
+    for word in text.lower().split(' '):
+        if word and word not in words:
+            words.append(word)
+    return words
+
+
 class QueryState(object):
     def __init__(self, search_filter):
         """
@@ -244,7 +268,7 @@ class QueryExecuter(object):
 
     # Public API
 
-    def search(self, states=None, resultset=None):
+    def search(self, states=None, resultset=None, store=None):
         """
         Execute a search.
 
@@ -252,9 +276,11 @@ class QueryExecuter(object):
           just execute a normal store.find() on the search_spec set in
           .set_search_spec()
         :param states:
+        :param store: the store to search on, if ``None`` we will
+          use the store of this executer
         """
         if resultset is None:
-            resultset = self._query(self.store)
+            resultset = self._query(store or self.store)
         resultset = self._parse_states(resultset, states)
         if self._limit > 0:
             resultset.config(limit=self._limit)
@@ -534,20 +560,25 @@ class QueryExecuter(object):
         if not state.text.strip():
             return
 
+        # Both sides are lowercased by stoq_normalize_string, so a case
+        # sensitive LIKE is enough. That, together with escaping the
+        # wildcards typed by the user, allows the planner to use the
+        # trigram indexes created on stoq_normalize_string(column),
+        # see patch-05-20.sql
         def _like(value):
             return Like(StoqNormalizeString(table_field),
-                        StoqNormalizeString(u'%%%s%%' % value.lower()),
-                        case_sensitive=False)
+                        StoqNormalizeString(u'%%%s%%' % _escape_like(value)),
+                        case_sensitive=True)
 
         if state.mode == StringQueryState.CONTAINS_ALL:
-            queries = [_like(word) for word in state.text.split(' ') if word]
+            queries = [_like(word) for word in _split_words(state.text)]
             retval = And(*queries)
         elif state.mode == StringQueryState.IDENTICAL_TO:
             retval = Lower(table_field) == state.text.lower()
         elif state.mode == StringQueryState.CONTAINS_EXACTLY:
             retval = (_like(state.text.lower()))
         elif state.mode == StringQueryState.NOT_CONTAINS:
-            queries = [Not(_like(word)) for word in state.text.split(' ') if word]
+            queries = [Not(_like(word)) for word in _split_words(state.text)]
             retval = And(*queries)
         else:  # pragma nocoverage
             raise AssertionError
@@ -23,30 +23,37 @@
 ##
 """ Runtime routines for applications"""
 
+import collections
 from collections import namedtuple
+import itertools
 import logging
+import re
 import sys
 import warnings
 import weakref
-import os
 
 from kiwi.component import get_utility, provide_utility
 from storm import Undef
-from storm.expr import SQL, Avg
+from storm.expr import SQL, Avg, Delete, Table, Update
 from storm.info import get_obj_info
-from storm.store import Store, ResultSet
+from storm.store import (Store, ResultSet, AutoReload, PENDING_ADD,
+                         PENDING_REMOVE)
 from storm.tracer import trace
 
 from stoqlib.database.exceptions import InterfaceError, OperationalError
 from stoqlib.database.interfaces import (
     ICurrentBranch,
     ICurrentBranchStation, ICurrentUser)
-from stoqlib.database.expr import is_sql_identifier
+from stoqlib.database.expr import DeclareCursor, is_sql_identifier
 from stoqlib.database.orm import ORMObject
+from stoqlib.database.pool import PooledPostgres, get_application_name
 from stoqlib.database.properties import Identifier
 from stoqlib.database.settings import db_settings
-from stoqlib.database.viewable import Viewable
+from stoqlib.database.statements import CompiledColumns, CompiledTables
+from stoqlib.database.viewable import (DEFERRED_BATCH_SIZE, DeferredLoader,
+                                       Viewable)
 from stoqlib.exceptions import DatabaseError, LoginError
+from stoqlib.lib.cache import commit_caches
 from stoqlib.lib.decorators import public
 from stoqlib.lib.message import error, yesno
 from stoqlib.lib.translation import stoqlib_gettext
@@ -58,27 +65,158 @@ log = logging.getLogger(__name__)
 #: the default store, considered read-only in Stoq
 _default_store = None
 
-#: list of global stores used by the application,
+#: the default number of rows fetched at a time by
+#: :meth:`StoqlibResultSet.fast_iter` when streaming
+DEFAULT_ITERSIZE = 2000
+
+#: the named tuples used by :meth:`StoqlibResultSet.fast_iter`, by class
+_named_tuples = {}
+_cursor_ids = itertools.count()
+
+#: the total number of objects touched by the commits of all stores,
+#: see :func:`get_commit_stats`
+_commit_stats = collections.Counter()
+
+_CHANGE_STATEMENT_RE = re.compile(
+    r'^\s*(?:UPDATE|DELETE\s+FROM)\s+(?:ONLY\s+)?"?(\w+)"?', re.IGNORECASE)
+
+
+class _AliveIndex(object):
+    """An index of the objects alive in all the stores
+
+    The objects are indexed by their class and id, so that when an object
+    is committed, the copies of it in other stores can be found directly.
+    Only weak references to the objects are kept.
+    """
+
+    def __init__(self):
+        # (cls, id) -> a list of weakrefs to the objects
+        self._refs = {}
+
+    def add(self, key, obj):
+        # Storm adds the objects to the alive set again after each flush
+        refs = self._refs.setdefault(key, [])
+        for ref in refs:
+            if ref() is obj:
+                return
+
+        def collected(ref):
+            self._discard(key, ref)
+        refs.append(weakref.ref(obj, collected))
+
+    def remove(self, key, obj):
+        for ref in self._refs.get(key, [])[:]:
+            if ref() is obj:
+                self._discard(key, ref)
+
+    def get(self, key):
+        """Get the objects alive with the given key
+
+        :param key: a tuple with the class and the id
+        :returns: a list of objects
+        """
+        objs = []
+        for ref in self._refs.get(key, [])[:]:
+            obj = ref()
+            if obj is not None:
+                objs.append(obj)
+        return objs
+
+    def get_by_table(self, table):
+        """Get the objects alive of the classes stored on a table
+
+        :param table: the name of the table
+        :returns: a list of objects
+        """
+        objs = []
+        for key in list(self._refs):
+            if getattr(key[0], '__storm_table__', None) == table:
+                objs.extend(self.get(key))
+        return objs
+
+    def _discard(self, key, ref):
+        refs = self._refs.get(key)
+        if refs is None:
+            return
+        if ref in refs:
+            refs.remove(ref)
+        if not refs:
+            del self._refs[key]
+
+
+#: the objects alive in the stores used by the application,
 #: should not be used by anything except autoreload_object()
-_stores = weakref.WeakSet()
+_alive_index = _AliveIndex()
+
+
+def _get_alive_key(obj_info):
+    variable = obj_info.primary_vars[0]
+    # Don't try to resolve the id, it may not have been reloaded yet
+    if variable.get_lazy() is not None:
+        return None
+    return (obj_info.cls_info.cls, variable.get())
+
+
+def _get_table_name(table):
+    if isinstance(table, Table):
+        return table.name
+    if not isinstance(table, basestring):
+        table = getattr(table, '__storm_table__', None)
+    return table if isinstance(table, basestring) else None
+
+
+def _get_changed_table(statement):
+    # The table changed by a statement that doesn't go through the
+    # objects, like an UPDATE or DELETE executed directly
+    if isinstance(statement, (Update, Delete)):
+        table = statement.table
+        if table is Undef:
+            table = statement.default_table
+        return _get_table_name(table)
+    elif isinstance(statement, basestring):
+        match = _CHANGE_STATEMENT_RE.match(statement)
+        return match and match.group(1)
+    return None
+
+
+def _autoreload(objs, skip_store=None, skip_dirty=False):
+    count = 0
+    for alive in objs:
+        store = Store.of(alive)
+        if store is None or store is skip_store or store.obsolete:
+            continue
+
+        # Just to make sure its not modified before reloading it, otherwise,
+        # we would lose the changes
+        if store._is_dirty(get_obj_info(alive)):
+            assert skip_dirty
+            continue
+        store.autoreload(alive)
+        count += 1
+    return count
 
 
 def autoreload_object(obj):
     """Autoreload object in any other existing store.
 
-    This will go through every open store and see if the object is alive in the
-    store. If it is, it will be marked for autoreload the next time its used.
+    This will go through every open store where the object is alive.
+    It will be marked for autoreload the next time its used.
     """
-    for store in _stores:
-        if Store.of(obj) is store:
-            continue
+    _autoreload(_alive_index.get((type(obj), obj.id)),
+                skip_store=Store.of(obj))
+
 
-        alive = store._alive.get((obj.__class__, (obj.id,)))
-        if alive:
-            # Just to make sure its not modified before reloading it, otherwise,
-            # we would lose the changes
-            assert not store._is_dirty(get_obj_info(obj))
-            store.autoreload(alive)
+def get_commit_stats():
+    """Get statistics about the commits of all the stores
+
+    :returns: a dict with the number of ``commits`` and the number of
+      objects ``created``, ``updated`` and ``deleted`` by them, and
+      the number of objects ``autoreloaded`` on other stores
+    """
+    stats = dict.fromkeys(['commits', 'created', 'updated', 'deleted',
+                           'autoreloaded'], 0)
+    stats.update(_commit_stats)
+    return stats
 
 
 class StoqlibResultSet(ResultSet):
@@ -91,6 +229,38 @@ class StoqlibResultSet(ResultSet):
         # ResultSet.avg() is not used because storm returns it as a float
         return self._aggregate(Avg, attribute)
 
+    def set(self, *args, **kwargs):
+        # The rows are changed without going through the objects, so
+        # the commit cannot know which ones to reload on the other stores
+        self._store._add_changed_table(
+            self._find_spec.default_cls_info.table)
+        super(StoqlibResultSet, self).set(*args, **kwargs)
+
+    def remove(self):
+        self._store._add_changed_table(
+            self._find_spec.default_cls_info.table)
+        return super(StoqlibResultSet, self).remove()
+
+    def __iter__(self):
+        viewable = getattr(self, '_viewable', None)
+        if viewable is None or not viewable.deferred_attributes:
+            for obj in super(StoqlibResultSet, self).__iter__():
+                yield obj
+            return
+
+        # Load a whole batch of rows before yielding them, so that the ids
+        # of all of them are already on the loader when the caller accesses
+        # a deferred attribute on the first one
+        batch = []
+        for obj in super(StoqlibResultSet, self).__iter__():
+            batch.append(obj)
+            if len(batch) >= DEFERRED_BATCH_SIZE:
+                for item in batch:
+                    yield item
+                batch = []
+        for item in batch:
+            yield item
+
     def set_viewable(self, viewable):
         """Configures this result set to load the results as instances of the
         given viewable.
@@ -99,8 +269,9 @@ class StoqlibResultSet(ResultSet):
         """
         self._viewable = viewable
 
-        # ResultSet needs this to create the query correctly
-        self._tables = viewable.tables
+        # ResultSet needs this to create the query correctly. The tables
+        # of the viewable are only compiled once, see statements.py
+        self._tables = CompiledTables(viewable)
         if viewable.group_by:
             self.group_by(*viewable.group_by)
 
@@ -116,12 +287,47 @@ class StoqlibResultSet(ResultSet):
             if type(value) is Identifier:
                 identifiers.append(value)
             setattr(instance, attr, value)
-        branch = getattr(instance, 'branch', None)
-        if branch:
-            for i in identifiers:
-                i.prefix = branch.acronym or ''
+
+        deferred = self._viewable.deferred_attributes
+        if deferred:
+            loader = getattr(self, '_deferred_loader', None)
+            if loader is None:
+                loader = self._deferred_loader = DeferredLoader(self._store)
+            instance._deferred_loader = loader
+            for attr, value in deferred.items():
+                loader.add(value.cls, instance.__dict__.get(attr))
+
+        if identifiers:
+            if deferred and 'branch' in deferred:
+                # Don't load the branch of every row just for its acronym
+                acronym = self._get_branch_acronym(
+                    deferred['branch'].cls, instance.__dict__.get('branch'))
+            else:
+                branch = getattr(instance, 'branch', None)
+                acronym = (branch.acronym or '') if branch else None
+            if acronym is not None:
+                for i in identifiers:
+                    i.prefix = acronym
         return instance
 
+    def _get_branch_acronym(self, branch_cls, branch_id):
+        if branch_id is None:
+            return None
+        acronyms = getattr(self, '_branch_acronyms', None)
+        if acronyms is None or branch_id not in acronyms:
+            # There are only a few branches, get all of them at once
+            acronyms = self._branch_acronyms = dict(self._store.find(
+                (branch_cls.id, branch_cls.acronym)))
+        if branch_id not in acronyms:
+            return None
+        return acronyms[branch_id] or u''
+
+    def _get_select(self):
+        select = super(StoqlibResultSet, self)._get_select()
+        if hasattr(self, '_viewable') and self._select is Undef:
+            select.columns = CompiledColumns(self._viewable, select.columns)
+        return select
+
     def _load_objects(self, result, values):
         # Overwrite the default _load_objects so we can convert the results to
         # viewable instances (if necessary)
@@ -167,19 +373,61 @@ class StoqlibResultSet(ResultSet):
         else:
             return objects[0]
 
-    def fast_iter(self):
+    def _get_named_tuple(self, cls, columns):
+        fields = tuple(c.name for c in columns)
+        nt = _named_tuples.get(cls)
+        if nt is None or nt._fields != fields:
+            nt = _named_tuples[cls] = namedtuple(cls.__name__, fields)
+        return nt
+
+    def _iter_cursor(self, select, itersize):
+        connection = self._store._connection
+        name = 'stoq_cursor_%d' % (next(_cursor_ids), )
+        connection.execute(DeclareCursor(name, select))
+        fetch = 'FETCH FORWARD %d FROM %s' % (itersize, name)
+        try:
+            while True:
+                rows = connection.execute(fetch).get_all()
+                for row in rows:
+                    yield row
+                if len(rows) < itersize:
+                    break
+        except GeneratorExit:
+            # The iteration was interrupted, the cursor would stay
+            # open until the end of the transaction
+            connection.execute('CLOSE %s' % (name, ))
+            raise
+        connection.execute('CLOSE %s' % (name, ))
+
+    def fast_iter(self, itersize=None):
+        """Iterate over the results without creating storm objects
+
+        Each object on the find spec will be a named tuple with its columns,
+        or a viewable if this is a viewable result set.
+
+        :param itersize: if not ``None``, the results will be streamed from a
+          server side cursor, fetching *itersize* rows at a time. Otherwise
+          all the rows will be loaded in memory by the database driver before
+          the first one is returned. Note that, when streaming, the results
+          must be consumed before the store is committed or rolled back.
+        """
         # First build all named tuples
         named_tuples = []
         for is_expr, info in self._find_spec._cls_spec_info:
             if is_expr:
                 named_tuples.append(None)
             else:
-                named_tuples.append(namedtuple(info.cls.__name__,
-                                               [i.name for i in info.columns]))
+                named_tuples.append(self._get_named_tuple(info.cls,
+                                                          info.columns))
+
+        if itersize is None:
+            rows = self._store._connection.execute(self._get_select())
+        else:
+            rows = self._iter_cursor(self._get_select(), itersize)
 
         is_viewable = hasattr(self, '_viewable')
         # Then interate over the results bypassing storm object creation
-        for values in self._store._connection.execute(self._get_select()):
+        for values in rows:
             value = self._load_fast_object(named_tuples, values)
             if is_viewable:
                 value = self._load_viewable(value)
@@ -230,13 +478,22 @@ class StoqlibStore(Store):
         self._committing = False
         self._savepoints = []
         self._pending_count = [0]
+        # The objects flushed in this transaction, obj_info -> (obj, key, kind)
+        self._flushed = {}
+        # The objects flushed since the last time the before-commited
+        # event was emitted
+        self._flushed_pending = collections.OrderedDict()
+        # The tables changed by statements instead of by the objects
+        self._changed_tables = set()
         self.retval = True
         self.obsolete = False
+        #: the number of objects ``created``, ``updated``, ``deleted``
+        #: and ``autoreloaded`` on other stores by the last commit
+        self.last_commit_stats = None
 
         if database is None:
             database = get_default_store().get_database()
         Store.__init__(self, database=database, cache=cache)
-        _stores.add(self)
         trace('transaction_create', self)
         self._setup_application_name()
 
@@ -254,6 +511,54 @@ class StoqlibStore(Store):
         self._pending_count[-1] += 1
         super(StoqlibStore, self)._set_dirty(obj_info)
 
+    def _flush_one(self, obj_info):
+        # Keep track of the flushed objects, so that commit only needs to
+        # care about them and not about everything in the cache.
+        # The obj is kept here so it will be alive until the commit
+        pending = obj_info.get("pending")
+        if pending is None and not self._get_changes_map(obj_info):
+            super(StoqlibStore, self)._flush_one(obj_info)
+            return
+
+        obj = obj_info.get_obj()
+        self._flushed_pending[obj_info] = None
+        if pending is PENDING_ADD:
+            self._flushed[obj_info] = (obj, None, 'created')
+        else:
+            key = _get_alive_key(obj_info)
+            kind = self._flushed.get(obj_info, (None, None, 'updated'))[2]
+            if pending is PENDING_REMOVE:
+                kind = 'deleted'
+            self._flushed[obj_info] = (obj, key, kind)
+
+        super(StoqlibStore, self)._flush_one(obj_info)
+
+    def _add_changed_table(self, table):
+        table = _get_table_name(table)
+        if table is not None:
+            self._changed_tables.add(table)
+
+    def _add_to_alive(self, obj_info):
+        super(StoqlibStore, self)._add_to_alive(obj_info)
+        key = _get_alive_key(obj_info)
+        obj = obj_info.get_obj()
+        if key is not None and obj is not None:
+            _alive_index.add(key, obj)
+
+    def _remove_from_alive(self, obj_info):
+        key = _get_alive_key(obj_info)
+        obj = obj_info.get_obj()
+        if key is not None and obj is not None:
+            _alive_index.remove(key, obj)
+        super(StoqlibStore, self)._remove_from_alive(obj_info)
+
+    def execute(self, statement, params=None, noresult=False):
+        table = _get_changed_table(statement)
+        if table is not None:
+            self._changed_tables.add(table)
+        return super(StoqlibStore, self).execute(statement, params=params,
+                                                 noresult=noresult)
+
     def find(self, cls_spec, *args, **kwargs):
         # Overwrite the default find method so we can support querying our own
         # viewables. If the cls_spec is a Viewable, we first get the real
@@ -431,23 +736,40 @@ class StoqlibStore(Store):
         self._check_obsolete()
         self._committing = True
 
-        # the cache will be cleared when commiting, so store them here
-        # and autoreload them after commit
-        touched_objs = []
-        for obj_info in self._cache.get_cached():
-            obj = obj_info.get_obj()
-            if obj is not None:
-                touched_objs.append(obj)
-
         super(StoqlibStore, self).commit()
         trace('transaction_commit', self)
 
+        flushed = self._flushed
+        changed_tables = self._changed_tables
+        self._flushed = {}
+        self._flushed_pending = collections.OrderedDict()
+        self._changed_tables = set()
         self._pending_count = [0]
         self._savepoints = []
 
-        # Reload objects on all other opened stores
-        for obj in touched_objs:
-            autoreload_object(obj)
+        # Reload the objects flushed by this commit on all other opened
+        # stores. Created objects cannot be alive on other stores.
+        stats = collections.Counter(kind for obj, key, kind in
+                                    flushed.values())
+        for obj, key, kind in flushed.values():
+            if key is not None:
+                stats['autoreloaded'] += _autoreload(
+                    _alive_index.get(key), skip_store=self)
+        # The tables changed directly by statements have all their
+        # objects reloaded, except the ones with unflushed changes
+        for table in changed_tables:
+            stats['autoreloaded'] += _autoreload(
+                _alive_index.get_by_table(table), skip_store=self,
+                skip_dirty=True)
+        commit_caches()
+
+        self.last_commit_stats = dict(created=stats['created'],
+                                      updated=stats['updated'],
+                                      deleted=stats['deleted'],
+                                      autoreloaded=stats['autoreloaded'])
+        _commit_stats.update(self.last_commit_stats)
+        _commit_stats['commits'] += 1
+        log.debug('commit of %r: %r' % (self, self.last_commit_stats))
 
         if close:
             self.close()
@@ -462,13 +784,18 @@ class StoqlibStore(Store):
         will execute the sql on the transaction, but only will be
         commited when :meth:`.commit` is called.
         """
+        self._allocate_te_ids()
         super(StoqlibStore, self).flush()
 
         # We only call 'before-commited' when flush is being called by commit
         if not self._committing:
             return
 
-        for obj_info in self._cache.get_cached():
+        # Only the objects flushed since the last time can have
+        # pending hooks, see Domain.__storm_pre_flush__
+        flushed_pending = self._flushed_pending
+        self._flushed_pending = collections.OrderedDict()
+        for obj_info in flushed_pending:
             obj_info.event.emit("before-commited")
 
         # If objs got dirty when calling the hooks, flush again
@@ -493,6 +820,9 @@ class StoqlibStore(Store):
             # If we rollback completely, we need to clear all savepoints
             self._savepoints = []
             self._pending_count = [0]
+            self._flushed = {}
+            self._flushed_pending = collections.OrderedDict()
+            self._changed_tables = set()
 
         # Rolling back resets the application name.
         self._setup_application_name()
@@ -611,14 +941,45 @@ class StoqlibStore(Store):
     #  Private
     #
 
+    def _allocate_te_ids(self):
+        # The te_id default on the tables, new_te(), runs a plpgsql
+        # function for each created row. Instead, reserve the ids of all
+        # the objects that are going to be created with a single nextval()
+        # and insert their entries with a single statement
+        objs = []
+        for obj_info in self._dirty:
+            if obj_info.get("pending") is not PENDING_ADD:
+                continue
+            column = getattr(obj_info.cls_info.cls, 'te_id', None)
+            variable = obj_info.variables.get(column)
+            if variable is None or variable.get_lazy() is not AutoReload:
+                continue
+            objs.append(obj_info.get_obj())
+
+        # A single one is as well served by the default
+        if len(objs) < 2:
+            return
+
+        te_ids = [row[0] for row in self._connection.execute(
+            "SELECT nextval('transaction_entry_id_seq') "
+            "FROM generate_series(1, ?)", (len(objs), ))]
+        self._connection.execute(
+            "INSERT INTO transaction_entry (id, te_time, dirty) VALUES " +
+            ', '.join(["(?, STATEMENT_TIMESTAMP(), true)"] * len(te_ids)),
+            te_ids, noresult=True)
+        for obj, te_id in zip(objs, te_ids):
+            obj.te_id = te_id
+
     def _setup_application_name(self):
         """Sets a friendly name for postgres connection
 
         This name will appear when selecting from pg_stat_activity, for instance,
         and will allow to better debug the queries (specially when there is a deadlock)
         """
-        self.execute("SET application_name = 'stoq - %s - %s'" %
-                     (get_hostname(), os.getpid()))
+        # Pooled connections already have it as their session default
+        if isinstance(self._database, PooledPostgres):
+            return
+        self.execute("SET application_name = '%s'" % (get_application_name(), ))
 
     def _check_obsolete(self):
         if self.obsolete:
@@ -640,6 +1001,10 @@ def get_default_store():
         # We intentionally leave this open, it's the default
         # store and should only be closed when we close the
         # application
+        database = _default_store.get_database()
+        if isinstance(database, PooledPostgres):
+            # Have a connection ready for the first new_store()
+            database.warm()
     return _default_store
 
 
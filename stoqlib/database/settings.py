@@ -26,6 +26,7 @@
 """Settings required to access the database, hostname, username etc
 """
 import logging
+import multiprocessing
 import os
 import platform
 import re
@@ -38,6 +39,9 @@ from storm.database import create_database
 from storm.uri import URI
 
 from stoqlib.database.exceptions import OperationalError, SQLError
+from stoqlib.database.pool import (DEFAULT_POOL_SIZE, clear_pools,
+                                   get_pooled_database)
+from stoqlib.database.statements import set_statement_cache_enabled
 from stoqlib.exceptions import ConfigError, DatabaseError
 from stoqlib.lib.message import warning
 from stoqlib.lib.osutils import get_username
@@ -63,6 +67,16 @@ _REQUIRED_EXTENSIONS = [
 #: We only allow alpha-numeric and underscores in database names
 DB_NAME_RE = re.compile('^[a-zA-Z0-9_]+$')
 
+#: Tables storing big binary data, which is already compressed most of
+#: the time, see the ``blobs`` parameter of
+#: :meth:`DatabaseSettings.dump_database`
+BLOB_TABLES = ['attachment', 'image']
+# What pg_dump and pg_restore --verbose output when they start copying
+# the data of a table
+_TABLE_DATA_RE = re.compile(
+    r'(?:dumping contents|processing data) (?:of|for) table '
+    r'"?(?:\w+\.)?(\w+)"?')
+
 
 def _fix_storm():  # pragma nocover
     # FIXME: This is a workaround for this bug: https://bugs.launchpad.net/storm/+bug/1170063
@@ -229,6 +243,34 @@ def test_local_database():
         return None
 
 
+def get_dump_jobs():
+    """Get the number of jobs used to dump and restore databases in parallel
+
+    :returns: the number of processors of this machine
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _run_with_progress(args, total, progress):
+    # pg_dump and pg_restore are run with --verbose, so that we can count
+    # the tables they processed
+    log.debug('executing %s' % (' '.join(args), ))
+    proc = Process(args, stderr=PIPE)
+    done = 0
+    for line in iter(proc.stderr.readline, ''):
+        if _TABLE_DATA_RE.search(line):
+            done += 1
+            log.info("%d of %d tables processed" % (done, total))
+            if progress is not None:
+                progress(done, total)
+        elif 'error' in line.lower():
+            log.warning(line.rstrip())
+    return proc.wait()
+
+
 def get_database_version(store):
     """Gets the database version as a tuple
 
@@ -247,10 +289,18 @@ class DatabaseSettings(object):
 
     It also provides helpers on top of ORMObject to return a database
     connection using the settings inside the object.
+
+    The connections of the stores are pooled (see :mod:`stoqlib.database.pool`),
+    *pool_size* is the maximum number of idle connections kept by the pool.
+    ``0`` disables the pooling.
+
+    *statement_cache* enables the cache of the sql of the viewables and
+    the prepared statements, see :mod:`stoqlib.database.statements`.
     """
 
     def __init__(self, rdbms=None, address=None, port=None,
-                 dbname=None, username=None, password=''):
+                 dbname=None, username=None, password='',
+                 pool_size=DEFAULT_POOL_SIZE, statement_cache=True):
         if not rdbms:
             rdbms = 'postgres'
         if rdbms == 'postgres':
@@ -268,6 +318,8 @@ class DatabaseSettings(object):
         self.dbname = dbname
         self.username = username
         self.password = password
+        self.pool_size = pool_size
+        self.statement_cache = statement_cache
         self.first = True
 
     def __repr__(self):
@@ -327,7 +379,12 @@ class DatabaseSettings(object):
                 uri.host = pair[0]
                 uri.port = int(pair[1])
             self._log_connect(uri)
-            store = StoqlibStore(create_database(uri))
+            set_statement_cache_enabled(self.statement_cache)
+            if self.pool_size:
+                database = get_pooled_database(uri, size=self.pool_size)
+            else:
+                database = create_database(uri)
+            store = StoqlibStore(database)
         except OperationalError as e:
             log.info('OperationalError: %s' % e)
             raise DatabaseError(e.args[0])
@@ -339,6 +396,100 @@ class DatabaseSettings(object):
                   "and try again.") % (DEFAULT_RDBMS, value))
         return store
 
+    def _get_table_count(self, exclude=()):
+        store = self.create_store()
+        tables = [row[0] for row in store.execute(
+            "SELECT tablename FROM pg_tables "
+            "WHERE schemaname = 'public'").get_all()]
+        store.close()
+        return len([t for t in tables if t not in exclude])
+
+    def _list_table_data(self, dump):
+        # pg_restore --list prints an entry like this for each table data:
+        # 3218; 0 17934 TABLE DATA public sale stoq
+        args = ['pg_restore', '--list', dump]
+        log.debug('executing %s' % (' '.join(args), ))
+        proc = Process(args, stdout=PIPE, stderr=PIPE)
+        stdout, stderr = proc.communicate()
+        if proc.returncode != 0:
+            log.warning("Could not list %s: %s" % (dump, stderr))
+            return None
+        tables = []
+        for line in stdout.split('\n'):
+            if line.startswith(';') or ' TABLE DATA ' not in line:
+                continue
+            tables.append(line.split(' TABLE DATA ', 1)[1].split()[1])
+        return tables
+
+    def _verify_dump(self, dump, count):
+        tables = self._list_table_data(dump)
+        if tables is None or len(tables) < count:
+            log.warning("Dump %s is incomplete, it has data for %s of "
+                        "%d tables" % (dump, tables and len(tables), count))
+            return False
+        return True
+
+    def _restore(self, args, dump, total=0, progress=None):
+        if _run_with_progress(args, total, progress) != 0:
+            raise DatabaseError(
+                _("Could not restore %s, pg_restore returned an error") % (
+                    dump, ))
+
+    def _dump_database(self, filename, schema_only, gzip, format, jobs,
+                       blobs, progress, snapshot=None):
+        if jobs > 1:
+            format = 'directory'
+        args = ['pg_dump',
+                '--format=%s' % (format, ),
+                '--encoding=UTF-8']
+        if gzip:
+            args.append('--compress=9')
+        if schema_only:
+            args.append('--schema-only')
+        if jobs > 1:
+            args.append('--jobs=%d' % (jobs, ))
+        if snapshot is not None:
+            args.append('--snapshot=%s' % (snapshot, ))
+        if blobs != 'include':
+            for table in BLOB_TABLES:
+                args.append('--exclude-table-data=%s' % (table, ))
+        if filename is not None:
+            args.extend(['-f', filename])
+        args.extend(self.get_tool_args())
+        args.append(self.dbname)
+
+        if schema_only or filename is None:
+            log.debug('executing %s' % (' '.join(args), ))
+            proc = Process(args)
+            return proc.wait() == 0
+
+        args.append('--verbose')
+        total = self._get_table_count(exclude=(
+            BLOB_TABLES if blobs != 'include' else []))
+        if _run_with_progress(args, total, progress) != 0:
+            return False
+        if not self._verify_dump(filename, total):
+            return False
+
+        if blobs == 'separate':
+            # Most of the blobs are images and compressed files, it's
+            # a waste of time to compress them again
+            args = ['pg_dump', '--format=custom', '--encoding=UTF-8',
+                    '--data-only', '--compress=0',
+                    '-f', filename + '-blobs']
+            if snapshot is not None:
+                args.append('--snapshot=%s' % (snapshot, ))
+            for table in BLOB_TABLES:
+                args.append('--table=%s' % (table, ))
+            args.extend(self.get_tool_args())
+            args.append(self.dbname)
+            log.debug('executing %s' % (' '.join(args), ))
+            if Process(args).wait() != 0:
+                return False
+            return self._verify_dump(filename + '-blobs',
+                                     len(BLOB_TABLES))
+        return True
+
     # Public API
 
     def get_store_dsn(self, filter_password=False):
@@ -374,7 +525,9 @@ class DatabaseSettings(object):
                                 rdbms=self.rdbms,
                                 port=self.port,
                                 username=self.username,
-                                password=self.password)
+                                password=self.password,
+                                pool_size=self.pool_size,
+                                statement_cache=self.statement_cache)
 
     # FIXME: Remove/Rethink
     def check_database_address(self):
@@ -440,6 +593,8 @@ class DatabaseSettings(object):
 
         :param dbname: the name of the database to be dropped.
         """
+        # Postgres will not drop a database with open connections
+        clear_pools(dbname)
         super_store = self.create_super_store()
 
         try:
@@ -670,41 +825,72 @@ class DatabaseSettings(object):
             raise NotImplementedError(self.rdbms)
 
     def dump_database(self, filename, schema_only=False,
-                      gzip=False, format='custom'):
+                      gzip=False, format='custom', jobs=1, blobs='include',
+                      progress=None):
         """Dump the contents of the current database
 
+        When dumping with more than one job, the ``directory`` format is
+        used, since it's the only one pg_dump can write in parallel and
+        *filename* will be a directory.
+
         :param filename: filename to write the database dump to
         :param schema_only: If only the database schema will be dumped
         :param gzip: if the dump should be compressed using gzip -9
         :param format: database dump format, defaults to ``custom``
+        :param jobs: the number of tables dumped in parallel
+        :param blobs: what to do with the data of the :obj:`BLOB_TABLES`,
+          ``include`` it, ``skip`` it, or dump it ``separate``, without
+          compression, to *filename* plus ``-blobs``. Both dumps are
+          taken from the same snapshot of the database
+        :param progress: if not ``None``, a callable that will be called
+          with the number of tables dumped and the total number of tables
+          after each table is dumped
+        :returns: ``True`` if the dump was created and verified
+        :raises: :exc:`ValueError` if the blobs are dumped separately
+          and there's no *filename*
         """
         log.info("Dumping database to %s" % filename)
 
-        if self.rdbms == 'postgres':
-            args = ['pg_dump',
-                    '--format=%s' % (format, ),
-                    '--encoding=UTF-8']
-            if gzip:
-                args.append('--compress=9')
-            if schema_only:
-                args.append('--schema-only')
-            if filename is not None:
-                args.extend(['-f', filename])
-            args.extend(self.get_tool_args())
-            args.append(self.dbname)
+        if blobs == 'separate' and filename is None and not schema_only:
+            raise ValueError("The blobs can only be dumped separately "
+                             "to a file")
 
-            log.debug('executing %s' % (' '.join(args), ))
-            proc = Process(args)
-            return proc.wait() == 0
+        if self.rdbms == 'postgres':
+            if blobs == 'separate' and not schema_only:
+                # The transaction that exported the snapshot must be kept
+                # open until both dumps are done
+                store = self.create_store()
+                snapshot = store.execute(
+                    "SELECT pg_export_snapshot()").get_one()[0]
+                try:
+                    return self._dump_database(
+                        filename, schema_only, gzip, format, jobs, blobs,
+                        progress, snapshot=snapshot)
+                finally:
+                    store.rollback(close=True)
+            return self._dump_database(filename, schema_only, gzip, format,
+                                       jobs, blobs, progress)
         else:
             raise NotImplementedError(self.rdbms)
 
-    def restore_database(self, dump, new_name=None, clean_first=True):
+    def restore_database(self, dump, new_name=None, clean_first=True,
+                         jobs=1, progress=None):
         """Restores the current database.
 
+        If *dump* was created with the blobs dumped separately,
+        they will be restored as well. The constraints and indexes are
+        only created after the blobs are restored, since the other tables
+        reference them.
+
         :param dump: a database dump file to be used to restore the database.
         :param new_name: optional name for the new restored database.
         :param clean_first: if a clean_database will be performed before restoring.
+        :param jobs: the number of tables restored in parallel
+        :param progress: if not ``None``, a callable that will be called
+          with the number of tables restored and the total number of tables
+          after each table is restored
+        :returns: the name of the restored database
+        :raises: :exc:`DatabaseError` if pg_restore fails
         """
         log.info("Restoring database %s using %s" % (self.dbname, dump))
 
@@ -716,14 +902,24 @@ class DatabaseSettings(object):
             if clean_first:
                 self.clean_database(new_name)
 
-            args = ['pg_restore', '-d', new_name]
+            args = ['pg_restore', '-d', new_name, '--verbose']
+            if jobs > 1:
+                args.append('--jobs=%d' % (jobs, ))
             args.extend(self.get_tool_args())
-            args.append(dump)
 
-            log.debug('executing %s' % (' '.join(args), ))
-
-            proc = Process(args, stderr=PIPE)
-            proc.wait()
+            blobs = dump + '-blobs'
+            if not os.path.exists(blobs):
+                self._restore(args + [dump], dump,
+                              len(self._list_table_data(dump) or []),
+                              progress)
+                return new_name
+
+            self._restore(args + ['--section=pre-data', '--section=data',
+                                  dump], dump,
+                          len(self._list_table_data(dump) or []), progress)
+            self._restore(['pg_restore', '-d', new_name, '--data-only'] +
+                          self.get_tool_args() + [blobs], blobs)
+            self._restore(args + ['--section=post-data', dump], dump)
             return new_name
         else:
             raise NotImplementedError(self.rdbms)
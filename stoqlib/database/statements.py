@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Caches the sql of viewables and prepares the statements executed often
+
+Viewables select dozens of columns from a tree of joins that is the same
+for every query, but storm compiles it again each time, which can take
+longer than running a short query like the ones of the point of sale.
+:class:`CompiledColumns` and :class:`CompiledTables` wrap the columns and
+the tables of a viewable and compile them only once, the ``WHERE`` and
+``ORDER BY`` of each query are still compiled as usual.
+
+Postgres also plans a query every time it is executed. The pooled
+connections (see :mod:`stoqlib.database.pool`) live long enough that
+it pays to ``PREPARE`` the ``SELECT`` statements executed often and then
+``EXECUTE`` them, see :class:`PreparedStatements`.
+
+Both are enabled by default and can be disabled with
+:func:`set_statement_cache_enabled`, or the ``statement_cache`` option
+of the ``Database`` section of the config file.
+"""
+
+import collections
+import logging
+import weakref
+
+import psycopg2
+from storm.expr import Expr, Undef, build_tables, compile as expr_compile
+
+log = logging.getLogger(__name__)
+
+#: Statements executed this many times on a connection are prepared
+PREPARE_THRESHOLD = 3
+#: The maximum number of statements prepared on each connection
+MAX_PREPARED_STATEMENTS = 256
+# The maximum number of statements counted on each connection
+_MAX_COUNTED_STATEMENTS = 4096
+
+_enabled = True
+_stats = collections.Counter()
+# viewable -> {(compile, kind): (source, size, sql, parameters)}
+_compiled = weakref.WeakKeyDictionary()
+
+
+def set_statement_cache_enabled(enabled):
+    """Enables or disables the statement cache
+
+    :param enabled: ``False`` to compile all the queries again and
+      stop preparing statements
+    """
+    global _enabled
+    _enabled = enabled
+    if not enabled:
+        _compiled.clear()
+
+
+def is_statement_cache_enabled():
+    return _enabled
+
+
+def get_statement_stats():
+    """Get statistics about the statement cache
+
+    :returns: a dict with the number of ``compiled_hits`` and
+      ``compiled_misses`` of the compiled sql of the viewables,
+      the number of statements ``prepared``, of ``prepared_executions``
+      and of statements that could not be prepared, ``prepare_failures``
+    """
+    stats = dict.fromkeys(['compiled_hits', 'compiled_misses', 'prepared',
+                           'prepared_executions', 'prepare_failures'], 0)
+    stats.update(_stats)
+    return stats
+
+
+def reset_statement_stats():
+    _stats.clear()
+
+
+def _compile_cached(compile, viewable, kind, source, state, build):
+    cache = _compiled.get(viewable)
+    if cache is None:
+        cache = _compiled[viewable] = {}
+    entry = cache.get((compile, kind))
+    # Compare the size too, in case a list of tables was changed in place
+    if (entry is not None and entry[0] is source and
+            entry[1] == len(source)):
+        _stats['compiled_hits'] += 1
+        state.parameters.extend(entry[3])
+        return entry[2]
+
+    _stats['compiled_misses'] += 1
+    state.push('parameters', [])
+    try:
+        sql = build()
+        parameters = state.parameters
+    finally:
+        state.pop()
+    state.parameters.extend(parameters)
+    cache[(compile, kind)] = (source, len(source), sql, parameters)
+    return sql
+
+
+class CompiledColumns(Expr):
+    """The columns selected by a viewable, compiled only once
+
+    :param viewable: the viewable class
+    :param columns: the columns of its find spec
+    """
+    __slots__ = ('viewable', 'columns')
+
+    def __init__(self, viewable, columns):
+        self.viewable = viewable
+        self.columns = columns
+
+
+@expr_compile.when(CompiledColumns)
+def compile_compiled_columns(compile, expr, state):
+    build = lambda: compile(expr.columns, state)
+    if not _enabled:
+        return build()
+    return _compile_cached(compile, expr.viewable, 'columns',
+                           expr.viewable.cls_spec, state, build)
+
+
+class CompiledTables(Expr):
+    """The tables of a viewable, compiled only once
+
+    :param viewable: the viewable class
+    """
+    __slots__ = ('viewable', )
+
+    def __init__(self, viewable):
+        self.viewable = viewable
+
+
+@expr_compile.when(CompiledTables)
+def compile_compiled_tables(compile, expr, state):
+    tables = expr.viewable.tables
+    build = lambda: build_tables(compile, tables, Undef, state)
+    if not _enabled:
+        return build()
+    return _compile_cached(compile, expr.viewable, 'tables', tables,
+                           state, build)
+
+
+def _get_prepared_sql(statement, n_params):
+    # psycopg2 marks the parameters with %s, which needs to be $n on
+    # PREPARE. Statements with literals or other % are not worth the risk
+    # of replacing the wrong thing.
+    if "'" in statement or '%' in statement.replace('%s', ''):
+        return None
+    parts = statement.split('%s')
+    if len(parts) - 1 != n_params:
+        return None
+    return parts[0] + ''.join('$%d%s' % (i, part)
+                              for i, part in enumerate(parts[1:], 1))
+
+
+class PreparedStatements(object):
+    """The statements prepared on a raw connection
+
+    A ``SELECT`` is prepared after being executed :obj:`PREPARE_THRESHOLD`
+    times with parameters of the same types. The statement is prepared and
+    executed for the first time inside a savepoint, so that if postgres
+    cannot infer the types of the parameters it's just executed as usual.
+    """
+
+    def __init__(self):
+        # (statement, parameter types) -> name
+        self._names = {}
+        self._counts = collections.Counter()
+        self._failed = set()
+
+    def accept(self, statement, params):
+        """Checks if a statement should be executed by :meth:`.execute`
+
+        :param statement: the statement, with the parameters marked as %s
+        :param params: the parameters
+        :returns: the key of the statement to pass to :meth:`.execute`
+          or ``None`` if it should be executed as usual
+        """
+        if not statement.startswith('SELECT'):
+            return None
+
+        key = (statement, tuple(type(p) for p in params))
+        if key in self._names:
+            return key
+        if key in self._failed or len(self._names) >= MAX_PREPARED_STATEMENTS:
+            return None
+
+        if len(self._counts) >= _MAX_COUNTED_STATEMENTS:
+            self._counts.clear()
+        self._counts[key] += 1
+        if self._counts[key] < PREPARE_THRESHOLD:
+            return None
+        del self._counts[key]
+
+        if _get_prepared_sql(statement, len(params)) is None:
+            self._failed.add(key)
+            return None
+        return key
+
+    def execute(self, raw_cursor, key, params):
+        """Executes a statement accepted by :meth:`.accept`
+
+        The statement is prepared first if it was not prepared yet.
+
+        :param raw_cursor: a cursor of the connection
+        :param key: the key returned by :meth:`.accept`
+        :param params: the parameters, converted to the database
+        """
+        statement = key[0]
+        markers = ', '.join(['%s'] * len(params))
+        name = self._names.get(key)
+        if name is not None:
+            raw_cursor.execute('EXECUTE %s (%s)' % (name, markers), params)
+            _stats['prepared_executions'] += 1
+            return
+
+        name = 'stoq_stmt_%d' % (len(self._names) + len(self._failed), )
+        sql = _get_prepared_sql(statement, len(params))
+        # The savepoint is handled by another cursor, raw_cursor needs to
+        # keep the results of the EXECUTE
+        cursor = raw_cursor.connection.cursor()
+        cursor.execute('SAVEPOINT stoq_prepare')
+        try:
+            cursor.execute('PREPARE %s AS %s' % (name, sql))
+            raw_cursor.execute('EXECUTE %s (%s)' % (name, markers), params)
+        except psycopg2.Error as e:
+            log.info('Could not prepare %r: %s' % (statement, e))
+            cursor.execute('ROLLBACK TO SAVEPOINT stoq_prepare')
+            self._failed.add(key)
+            _stats['prepare_failures'] += 1
+        else:
+            self._names[key] = name
+            _stats['prepared'] += 1
+            _stats['prepared_executions'] += 1
+        finally:
+            cursor.execute('RELEASE SAVEPOINT stoq_prepare')
+            cursor.close()
+
+        if key in self._failed:
+            raw_cursor.execute(statement, params)
@@ -49,6 +49,7 @@ _tables = [
     ('parameter', ["ParameterData"]),
     ('account', ['Account',
                  'AccountTransaction',
+                 'AccountBalanceCheckpoint',
                  'BankAccount',
                  'BillOption']),
     ('profile', ["UserProfile", "ProfileSettings"]),
@@ -73,7 +74,8 @@ _tables = [
                 "ClientCategory",
                 "ClientSalaryHistory",
                 "CreditCheckHistory",
-                "UserBranchAccess"]),
+                "UserBranchAccess",
+                "ClientCreditLedger"]),
     ('synchronization', ["BranchSynchronization"]),
     ('station', ["BranchStation"]),
     ('till', ["Till", "TillEntry"]),
@@ -90,7 +92,8 @@ _tables = [
     ('sale', ["SaleItem",
               "Delivery",
               "Sale",
-              'SaleComment']),
+              'SaleComment',
+              'SaleSummary']),
     ('returnedsale', ["ReturnedSale",
                       "ReturnedSaleItem"]),
     ('sellable', ["SellableUnit",
@@ -113,7 +116,8 @@ _tables = [
                  "ProductAttribute",
                  "ProductOptionMap",
                  "Storable",
-                 'StorableBatch']),
+                 'StorableBatch',
+                 'ProductStockSummary']),
     ('purchase', ["PurchaseOrder",
                   "Quotation",
                   "PurchaseItem",
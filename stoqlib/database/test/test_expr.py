@@ -26,9 +26,9 @@
 
 import datetime
 
-from storm.expr import Cast
+from storm.expr import Cast, Sum
 
-from stoqlib.database.expr import Case, Between, GenerateSeries, Field
+from stoqlib.database.expr import Case, Between, GenerateSeries, Field, Over
 from stoqlib.domain.event import Event
 from stoqlib.domain.test.domaintest import DomainTest
 
@@ -113,3 +113,19 @@ class ViewableTest(DomainTest):
                     result=None, else_=False)
         data = list(self.store.using(series).find(case))
         self.assertEquals(data, [None, False, None, None, None, None])
+
+    def test_over(self):
+        series = GenerateSeries(1, 4)
+        value = Field('generate_series', 'generate_series')
+        data = list(self.store.using(series).find(
+            (value, Over(Sum(value), order_by=[value]))).order_by(value))
+        self.assertEquals(data, [(1, 1), (2, 3), (3, 6), (4, 10)])
+
+        data = list(self.store.using(series).find(
+            (value, Over(Sum(value), partition_by=[value % 2],
+                         order_by=[value]))).order_by(value))
+        self.assertEquals(data, [(1, 1), (2, 2), (3, 4), (4, 6)])
+
+        data = list(self.store.using(series).find(
+            Over(Sum(value))))
+        self.assertEquals(data, [10, 10, 10, 10])
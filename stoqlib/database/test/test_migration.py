@@ -0,0 +1,297 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.database.migration`"""
+
+import os
+import shutil
+import tempfile
+
+import mock
+from kiwi.environ import environ
+
+from stoqlib.database.exceptions import SQLError
+from stoqlib.database.migration import Patch, PatchRunner, split_sql
+from stoqlib.database.runtime import new_store
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class PatchTest(DomainTest):
+
+    def setUp(self):
+        super(PatchTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+
+    def _create_patch(self, data):
+        filename = os.path.join(self.tempdir, 'patch-99-01.sql')
+        with open(filename, 'w') as fh:
+            fh.write(data)
+        migration = mock.Mock()
+        migration.generate_sql_for_patch.return_value = 'SELECT 1'
+        return Patch(filename, migration)
+
+    def test_split_sql(self):
+        self.assertEqual(split_sql(
+            "-- A comment; with a semicolon\n"
+            "CREATE TABLE foo (bar text DEFAULT 'a;''b');\n"
+            "/* ; */ CREATE FUNCTION foo() RETURNS int AS $$\n"
+            "BEGIN RETURN 1; END;\n"
+            "$$ LANGUAGE plpgsql;\n"
+            "SELECT $tag$;$tag$, \"a;b\""),
+            [(2, "CREATE TABLE foo (bar text DEFAULT 'a;''b')"),
+             (3, "CREATE FUNCTION foo() RETURNS int AS $$\n"
+                 "BEGIN RETURN 1; END;\n"
+                 "$$ LANGUAGE plpgsql"),
+             (6, 'SELECT $tag$;$tag$, "a;b"')])
+
+    def test_split_sql_escape_string(self):
+        self.assertEqual(split_sql(
+            "SELECT E'a\\';b', e'\\\\', 'c\\';\n"
+            "SELECT 1;"),
+            [(1, "SELECT E'a\\';b', e'\\\\', 'c\\'"),
+             (2, "SELECT 1")])
+
+    def test_split_sql_psql(self):
+        self.assertEqual(split_sql(
+            "\\set FOO 1 -- a comment; with a semicolon\n"
+            "COPY foo (bar) FROM stdin;\n"
+            "a;b\n"
+            "\\.\n"
+            "SELECT :FOO;\n"),
+            [(1, "\\set FOO 1 -- a comment; with a semicolon"),
+             (2, "COPY foo (bar) FROM stdin;\na;b\n"),
+             (5, "SELECT :FOO")])
+
+    def test_apply(self):
+        patch = self._create_patch(
+            "-- Question marks are not parameters\n"
+            "SELECT '?';\n"
+            "SELECT 1;\n")
+        store = new_store()
+        try:
+            patch.apply(store)
+        finally:
+            store.rollback()
+
+    def test_apply_psql(self):
+        patch = self._create_patch(
+            "\\set TYPE_SALE 2 -- sale\n"
+            "CREATE TEMP TABLE foo (bar text, baz int);\n"
+            "COPY foo (bar, baz) FROM stdin;\n"
+            "a;\t1\n"
+            ":TYPE_SALE\t3\n"
+            "\\.\n"
+            "INSERT INTO foo (bar, baz) VALUES ('c', :TYPE_SALE::int);\n")
+        store = new_store()
+        try:
+            patch.apply(store)
+            self.assertEqual(
+                store.execute("SELECT bar, baz FROM foo "
+                              "ORDER BY baz").get_all(),
+                [(u'a;', 1), (u'c', 2), (u':TYPE_SALE', 3)])
+        finally:
+            store.rollback()
+
+    def test_apply_psql_shipped_patches(self):
+        # These patches use \set and COPY ... FROM stdin, which used to be
+        # handled by psql
+        patch = Patch(environ.get_resource_filename(
+            'stoq', 'sql', 'patch-04-20.sql'), mock.Mock())
+        statements = [s for lineno, s in patch.get_statements()]
+        self.assertFalse([s for s in statements if ':TYPE_' in s])
+        self.assertIn('UPDATE stock_transaction_history SET object_id = NULL\n'
+                      '  WHERE "type" in (0, 15)', statements)
+
+        patch = Patch(environ.get_resource_filename(
+            'stoq', 'sql', 'patch-03-16.sql'), mock.Mock())
+        [(lineno, copy)] = [(lineno, s) for lineno, s in patch.get_statements()
+                            if s.startswith('COPY')]
+        self.assertEqual(lineno, 19)
+        n_rows = copy.count('\n') - 2
+
+        store = new_store()
+        try:
+            # The temporary table hides the real one, the rows of the
+            # patch are not the ones of the current schema
+            store.execute("CREATE TEMP TABLE city_location (country text, "
+                          "state_code int, state text, city_code int, "
+                          "city text)")
+            patch._execute(store, lineno, copy)
+            self.assertEqual(store.execute(
+                "SELECT COUNT(*) FROM pg_temp.city_location").get_one(),
+                (n_rows, ))
+        finally:
+            store.rollback()
+
+    def test_apply_error_line(self):
+        patch = self._create_patch(
+            "SELECT 1;\n"
+            "\n"
+            "SELECT id,\n"
+            "       foobar\n"
+            "  FROM sellable;\n")
+        store = new_store()
+        try:
+            with self.assertRaisesRegexp(SQLError, r'^patch-99-01.sql:4: '):
+                patch.apply(store)
+        finally:
+            store.rollback()
+
+
+class PatchRunnerTest(DomainTest):
+
+    def setUp(self):
+        super(PatchRunnerTest, self).setUp()
+        self.tempdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tempdir)
+        self.addCleanup(self._drop_tables)
+        self.migration = mock.Mock()
+        self.migration.generate_sql_for_patch.return_value = 'SELECT 1'
+
+    def _drop_tables(self):
+        # The runner commits the patches
+        store = new_store()
+        store.execute("DROP TABLE IF EXISTS patch_runner_test")
+        store.execute("DELETE FROM schema_deferred_index "
+                      "WHERE filename LIKE 'patch-99-%'")
+        store.commit(close=True)
+
+    def _create_patch(self, level, data):
+        filename = os.path.join(self.tempdir, 'patch-99-%02d.sql' % level)
+        with open(filename, 'w') as fh:
+            fh.write(data)
+        return Patch(filename, self.migration)
+
+    def _create_table(self):
+        store = new_store()
+        store.execute("CREATE TABLE patch_runner_test (id integer)")
+        store.commit(close=True)
+
+    def _query(self, query):
+        store = new_store()
+        try:
+            return store.execute(query).get_all()
+        finally:
+            store.rollback(close=True)
+
+    def test_apply_error(self):
+        patches = [
+            self._create_patch(1, "CREATE TABLE patch_runner_test (id integer);\n"
+                                  "INSERT INTO patch_runner_test VALUES (1);\n"),
+            self._create_patch(2, "INSERT INTO patch_runner_test VALUES (2);\n"
+                                  "SELECT foobar FROM patch_runner_test;\n"),
+            self._create_patch(3, "INSERT INTO patch_runner_test VALUES (3);\n")]
+        applied = []
+        runner = PatchRunner(self.migration)
+        with self.assertRaisesRegexp(SQLError, r'^patch-99-02.sql:2: '):
+            runner.apply(patches, on_patch=lambda i, p: applied.append(i))
+
+        # The patches before the failed one are committed, the failed one
+        # is rolled back and the ones after it are not applied
+        self.assertEqual(applied, [0, 1])
+        self.assertEqual(self._query("SELECT id FROM patch_runner_test"),
+                         [(1, )])
+
+    def test_apply_dry_run(self):
+        self._create_table()
+        patches = [
+            self._create_patch(1, "INSERT INTO patch_runner_test VALUES (1);\n"
+                                  "CREATE INDEX patch_runner_test_idx "
+                                  "ON patch_runner_test (id);\n")]
+        runner = PatchRunner(self.migration, dry_run=True)
+        runner.apply(patches)
+
+        self.assertEqual(self._query("SELECT id FROM patch_runner_test"), [])
+        self.assertEqual(self._query(
+            "SELECT 1 FROM pg_class WHERE relname = 'patch_runner_test_idx'"),
+            [])
+        self.assertEqual(runner.timings[0][0], 'patch-99-01.sql')
+
+    @mock.patch.object(PatchRunner, '_create_index_concurrently')
+    def test_apply_concurrent_index(self, create_index):
+        self._create_table()
+        committed = []
+        create_index.side_effect = lambda *args: committed.append(
+            self._query("SELECT id FROM patch_runner_test"))
+
+        patches = [
+            self._create_patch(1, "INSERT INTO patch_runner_test VALUES (1);\n"
+                                  "CREATE INDEX patch_runner_test_idx "
+                                  "ON patch_runner_test (id);\n")]
+        runner = PatchRunner(self.migration)
+        runner.apply(patches)
+
+        # The index is only created once the patch was committed
+        create_index.assert_called_once_with(
+            mock.ANY, u'patch-99-01.sql', 2,
+            u'CREATE INDEX patch_runner_test_idx ON patch_runner_test (id)')
+        self.assertEqual(committed, [[(1, )]])
+        self.assertEqual(self._query(
+            "SELECT 1 FROM schema_deferred_index "
+            "WHERE filename LIKE 'patch-99-%'"), [])
+
+        # Not when the patches reference the table after it
+        create_index.reset_mock()
+        runner.apply([
+            self._create_patch(2, "CREATE INDEX patch_runner_test_id2_idx "
+                                  "ON patch_runner_test (id);\n"),
+            self._create_patch(3, "SELECT id FROM patch_runner_test;\n")])
+        self.assertFalse(create_index.called)
+        self.assertEqual(self._query(
+            "SELECT 1 FROM pg_class "
+            "WHERE relname = 'patch_runner_test_id2_idx'"), [(1, )])
+
+    @mock.patch.object(PatchRunner, '_create_index_concurrently')
+    def test_apply_concurrent_index_error(self, create_index):
+        self._create_table()
+        create_index.side_effect = SQLError('patch-99-01.sql:1: error')
+        patches = [
+            self._create_patch(1, "INSERT INTO patch_runner_test VALUES (1);\n"
+                                  "CREATE INDEX patch_runner_test_idx "
+                                  "ON patch_runner_test (id);\n")]
+        runner = PatchRunner(self.migration)
+        runner.apply(patches)
+
+        # The patch is still committed and the index is kept to be
+        # created on the next update
+        self.assertEqual(runner.failed_indexes, ['patch_runner_test_idx'])
+        self.assertEqual(self._query("SELECT id FROM patch_runner_test"),
+                         [(1, )])
+        self.assertEqual(self._query(
+            "SELECT filename, lineno FROM schema_deferred_index "
+            "WHERE filename LIKE 'patch-99-%'"), [(u'patch-99-01.sql', 2)])
+
+        create_index.side_effect = None
+        create_index.reset_mock()
+        runner = PatchRunner(self.migration)
+        runner.apply([])
+
+        self.assertEqual(runner.failed_indexes, [])
+        create_index.assert_called_once_with(
+            mock.ANY, u'patch-99-01.sql', 2,
+            u'CREATE INDEX patch_runner_test_idx ON patch_runner_test (id)')
+        self.assertEqual(self._query(
+            "SELECT 1 FROM schema_deferred_index "
+            "WHERE filename LIKE 'patch-99-%'"), [])
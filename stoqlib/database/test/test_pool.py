@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.database.pool`"""
+
+import mock
+import psycopg2
+from storm.databases.postgres import Postgres
+from storm.uri import URI
+
+from stoqlib.database.pool import PooledPostgres
+from stoqlib.database.runtime import new_store
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class _FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+        self.broken = False
+        self.executed = []
+
+    def cursor(self):
+        cursor = mock.Mock()
+
+        def execute(query):
+            if self.broken:
+                raise psycopg2.OperationalError('connection not open')
+            self.executed.append(query)
+        cursor.execute = execute
+        return cursor
+
+    def rollback(self):
+        if self.broken:
+            raise psycopg2.OperationalError('connection not open')
+
+    def commit(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class PooledPostgresTest(DomainTest):
+
+    def setUp(self):
+        super(PooledPostgresTest, self).setUp()
+        self.database = PooledPostgres(URI('postgres://user@localhost/db'),
+                                       size=2)
+        patcher = mock.patch.object(Postgres, 'raw_connect',
+                                    side_effect=_FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_reuse(self):
+        conn = self.database.raw_connect()
+        self.database.release_raw_connection(conn)
+        self.assertEqual(conn.executed,
+                         ['RESET ALL', 'UNLISTEN *', 'DISCARD TEMP'])
+        self.assertIs(self.database.raw_connect(), conn)
+
+        stats = self.database.get_stats()
+        self.assertEqual(stats['created'], 1)
+        self.assertEqual(stats['reused'], 1)
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['idle'], 0)
+
+    def test_size(self):
+        conns = [self.database.raw_connect() for i in range(3)]
+        for conn in conns:
+            self.database.release_raw_connection(conn)
+        self.assertTrue(conns[2].closed)
+
+        stats = self.database.get_stats()
+        self.assertEqual(stats['idle'], 2)
+        self.assertEqual(stats['discarded'], 1)
+
+    def test_health_check(self):
+        conn = self.database.raw_connect()
+        self.database.release_raw_connection(conn)
+        conn.broken = True
+
+        with mock.patch('stoqlib.database.pool.HEALTH_CHECK_INTERVAL', 0):
+            new_conn = self.database.raw_connect()
+        self.assertIsNot(new_conn, conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(
+            self.database.get_stats()['health_check_failures'], 1)
+
+    def test_broken_on_release(self):
+        conn = self.database.raw_connect()
+        conn.broken = True
+        self.database.release_raw_connection(conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(self.database.get_stats()['idle'], 0)
+
+    def test_raw_connect_unpooled(self):
+        conn = self.database.raw_connect_unpooled()
+        self.assertIsNot(self.database.raw_connect(), conn)
+        self.assertEqual(self.database.get_stats()['created'], 1)
+
+    def test_warm_and_clear(self):
+        self.database.warm(5)
+        self.assertEqual(self.database.get_stats()['idle'], 2)
+        self.database.clear()
+        self.assertEqual(self.database.get_stats()['idle'], 0)
+
+
+class StorePoolTest(DomainTest):
+
+    def setUp(self):
+        super(StorePoolTest, self).setUp()
+        if not isinstance(self.store.get_database(), PooledPostgres):
+            self.skipTest("The stores are not pooled")
+
+    def test_new_store(self):
+        store = new_store()
+        raw_connection = store._connection._raw_connection
+        store.close()
+        store = new_store()
+        self.assertIs(store._connection._raw_connection, raw_connection)
+        store.close()
+
+    def test_new_store_reset(self):
+        store = new_store()
+        timeout = store.execute("SHOW statement_timeout").get_one()
+        store.execute("SET statement_timeout = 123456")
+        store.execute("LISTEN stoq_pool_test")
+        store.execute("CREATE TEMP TABLE pool_test (id integer)")
+        store.commit()
+        raw_connection = store._connection._raw_connection
+        store.close()
+
+        store = new_store()
+        self.assertIs(store._connection._raw_connection, raw_connection)
+        self.assertEqual(store.execute("SHOW statement_timeout").get_one(),
+                         timeout)
+        self.assertEqual(store.execute(
+            "SELECT count(*) FROM pg_listening_channels()").get_one(), (0, ))
+        self.assertEqual(store.execute(
+            "SELECT count(*) FROM pg_tables "
+            "WHERE tablename = 'pool_test'").get_one(), (0, ))
+        store.close()
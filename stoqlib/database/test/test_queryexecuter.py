@@ -76,3 +76,15 @@ class QueryExecuterTest(DomainTest):
         self.assertEquals(self._search_string_not(u'stone 110').count(), 2)
         self.assertEquals(self._search_string_not(u'eye').count(), 0)
         self.assertEquals(self._search_string_not(u'moon 120').count(), 1)
+
+    def test_string_query_wildcards(self):
+        self.create_client_category(u'DISCOUNT 10%')
+        self.create_client_category(u'DISCOUNT 100')
+        self.create_client_category(u'SPECIAL_CLIENT')
+        self.create_client_category(u'SPECIAL CLIENT')
+
+        self.assertEquals(self._search_string_all(u'10%').count(), 1)
+        self.assertEquals(self._search_string_all(u'discount 10').count(), 2)
+        self.assertEquals(self._search_string_all(u'special_').count(), 1)
+        self.assertEquals(self._search_string_all(u'eye eye').count(), 0)
+        self.assertEquals(self._search_string_not(u'%').count(), 3)
@@ -26,7 +26,7 @@
 
 from stoqlib.database.exceptions import InterfaceError
 from stoqlib.database.properties import UnicodeCol
-from stoqlib.database.runtime import new_store
+from stoqlib.database.runtime import new_store, _alive_index
 from stoqlib.domain.base import Domain
 from stoqlib.domain.person import Person, Client, ClientView
 from stoqlib.domain.test.domaintest import DomainTest
@@ -160,6 +160,91 @@ class StoqlibStoreTest(DomainTest):
         self.assertTrue(obj.te.dirty)
         store.close()
 
+    def test_te_allocation(self):
+        store = new_store()
+        objs = [WillBeCommitted(store=store) for i in range(3)]
+        with self.count_tracer() as tracer:
+            store.flush()
+        # The ids, the entries and one insert for each object
+        self.assertEqual(tracer.count, 5)
+
+        te_ids = set(obj.te_id for obj in objs)
+        self.assertEqual(len(te_ids), 3)
+        for obj in objs:
+            self.assertTrue(obj.te.dirty)
+            self.assertIsNotNone(obj.te.te_time)
+
+        # The default is used when creating a single object
+        obj = WillBeCommitted(store=store)
+        store.flush()
+        self.assertNotIn(obj.te_id, te_ids)
+        self.assertTrue(obj.te.dirty)
+        store.rollback()
+
+    def test_commit_autoreload(self):
+        store = new_store()
+        obj = WillBeCommitted(store=store, test_var=u'XXX')
+        store.commit()
+        self.assertEqual(store.last_commit_stats,
+                         dict(created=1, updated=0, deleted=0,
+                              autoreloaded=0))
+
+        other_store = new_store()
+        other_obj = other_store.get(WillBeCommitted, obj.id)
+        self.assertEqual(other_obj.test_var, u'XXX')
+
+        obj.test_var = u'YYY'
+        store.commit()
+        self.assertEqual(store.last_commit_stats,
+                         dict(created=0, updated=1, deleted=0,
+                              autoreloaded=1))
+        self.assertEqual(other_obj.test_var, u'YYY')
+
+        # Nothing changed, nothing to autoreload
+        store.commit()
+        self.assertEqual(store.last_commit_stats,
+                         dict(created=0, updated=0, deleted=0,
+                              autoreloaded=0))
+
+        # The object and its transaction entry
+        store.remove(obj)
+        store.commit()
+        self.assertEqual(store.last_commit_stats['deleted'], 2)
+
+        other_store.close()
+        store.close()
+
+    def test_commit_autoreload_statements(self):
+        store = new_store()
+        obj = WillBeCommitted(store=store, test_var=u'XXX')
+        store.commit()
+        other_store = new_store()
+        other_obj = other_store.get(WillBeCommitted, obj.id)
+        self.assertEqual(other_obj.test_var, u'XXX')
+
+        # Flushing an object many times doesn't index it again
+        for value in [u'a', u'b', u'c']:
+            obj.test_var = value
+            store.flush()
+        self.assertEqual(
+            len(_alive_index.get((WillBeCommitted, obj.id))), 2)
+        store.commit()
+        self.assertEqual(store.last_commit_stats['autoreloaded'], 1)
+        self.assertEqual(other_obj.test_var, u'c')
+
+        # Rows changed without going through the objects are reloaded too
+        store.find(WillBeCommitted, id=obj.id).set(test_var=u'YYY')
+        store.commit()
+        self.assertEqual(other_obj.test_var, u'YYY')
+
+        store.execute("UPDATE will_be_committed SET test_var = 'ZZZ' "
+                      "WHERE id = ?", (obj.id, ))
+        store.commit()
+        self.assertEqual(other_obj.test_var, u'ZZZ')
+
+        other_store.close()
+        store.close()
+
     def test_rollback_to_savepoint(self):
         obj = WillBeCommitted(store=self.store, test_var=u'XXX')
         obj2 = WillBeCommitted(store=self.store, test_var=u'foo')
@@ -349,3 +434,32 @@ class TestStoqlibResultSet(DomainTest):
         for obj, tpl in zip(results, results.fast_iter()):
             for prop in ['name', 'status', 'cpf']:
                 self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
+
+    def test_fast_iter_itersize(self):
+        results = self.store.find(Person).order_by(Person.te_id)
+        # Make sure there are more results than the itersize
+        assert results.count() > 2
+        objs = list(results)
+        tpls = list(results.fast_iter(itersize=2))
+        self.assertEqual([o.id for o in objs], [t.id for t in tpls])
+
+        # Interrupting the iteration closes the cursor
+        tpls = results.fast_iter(itersize=2)
+        self.assertEqual(next(tpls).id, objs[0].id)
+        tpls.close()
+        self.assertEqual(len(list(results.fast_iter(itersize=1))), len(objs))
+
+    def test_fast_iter_viewable_itersize(self):
+        results = self.store.find(ClientView).order_by(Client.te_id)
+        # Make sure there are results so the test makes sense
+        assert results.count()
+
+        for obj, tpl in zip(results, results.fast_iter(itersize=1)):
+            for prop in ['name', 'status', 'cpf']:
+                self.assertEqual(getattr(obj, prop), getattr(tpl, prop))
+
+    def test_fast_iter_named_tuples(self):
+        results = self.store.find(Person)
+        tpl1 = next(results.fast_iter())
+        tpl2 = next(results.fast_iter())
+        self.assertIs(type(tpl1), type(tpl2))
@@ -30,6 +30,7 @@ import mock
 
 from stoqlib.database.settings import DatabaseSettings, get_database_version
 from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.exceptions import DatabaseError
 
 
 class _FakeResults(object):
@@ -155,3 +156,127 @@ class DatabaseSettingsTest(DomainTest):
                           ['-U', 'username',
                            '-h', 'address',
                            '-p', '12345'])
+
+    @mock.patch('stoqlib.database.settings.Process')
+    def test_dump_database_jobs(self, Process):
+        proc = Process.return_value
+        proc.wait.return_value = 0
+        proc.stderr.readline.side_effect = [
+            'pg_dump: dumping contents of table public.sale\n',
+            'pg_dump: dumping contents of table "public.sale_item"\n',
+            '']
+        proc.returncode = 0
+        proc.communicate.return_value = (
+            ';\n'
+            '3218; 0 17934 TABLE DATA public sale stoq\n'
+            '3219; 0 17935 TABLE DATA public sale_item stoq\n', '')
+
+        settings = DatabaseSettings(address='address',
+                                    username='username',
+                                    port='12345')
+        progress = []
+        with mock.patch.object(settings, '_get_table_count',
+                               return_value=2):
+            self.assertTrue(settings.dump_database(
+                '/tmp/dump', jobs=4, blobs='skip',
+                progress=lambda done, total: progress.append((done, total))))
+        self.assertEqual(progress, [(1, 2), (2, 2)])
+        self.assertEqual(Process.call_args_list[0][0][0],
+                         ['pg_dump', '--format=directory', '--encoding=UTF-8',
+                          '--jobs=4',
+                          '--exclude-table-data=attachment',
+                          '--exclude-table-data=image',
+                          '-f', '/tmp/dump',
+                          '-U', 'username', '-h', 'address', '-p', '12345',
+                          'stoq', '--verbose'])
+        self.assertEqual(Process.call_args_list[1][0][0],
+                         ['pg_restore', '--list', '/tmp/dump'])
+
+        # The dump is missing the data of a table
+        proc.stderr.readline.side_effect = ['']
+        with mock.patch.object(settings, '_get_table_count',
+                               return_value=3):
+            self.assertFalse(settings.dump_database('/tmp/dump', jobs=4))
+
+    @mock.patch('stoqlib.database.settings.Process')
+    def test_dump_database_blobs(self, Process):
+        proc = Process.return_value
+        proc.wait.return_value = 0
+        proc.stderr.readline.return_value = ''
+        proc.returncode = 0
+        proc.communicate.return_value = (
+            '3218; 0 17934 TABLE DATA public attachment stoq\n'
+            '3219; 0 17935 TABLE DATA public image stoq\n', '')
+
+        settings = DatabaseSettings(address='address',
+                                    username='username',
+                                    port='12345')
+        store = mock.Mock()
+        store.execute.return_value.get_one.return_value = ('00000003-1', )
+        with mock.patch.object(settings, '_get_table_count',
+                               return_value=2):
+            with mock.patch.object(settings, 'create_store',
+                                   return_value=store):
+                self.assertTrue(settings.dump_database(
+                    '/tmp/dump', blobs='separate'))
+
+        # Both dumps use the snapshot exported by the store, which is
+        # only closed after them
+        store.execute.assert_called_once_with("SELECT pg_export_snapshot()")
+        store.rollback.assert_called_once_with(close=True)
+        tool_args = ['-U', 'username', '-h', 'address', '-p', '12345']
+        args = [call[0][0] for call in Process.call_args_list]
+        self.assertEqual(args[0],
+                         ['pg_dump', '--format=custom', '--encoding=UTF-8',
+                          '--snapshot=00000003-1',
+                          '--exclude-table-data=attachment',
+                          '--exclude-table-data=image',
+                          '-f', '/tmp/dump'] + tool_args +
+                         ['stoq', '--verbose'])
+        self.assertEqual(args[2],
+                         ['pg_dump', '--format=custom', '--encoding=UTF-8',
+                          '--data-only', '--compress=0',
+                          '-f', '/tmp/dump-blobs', '--snapshot=00000003-1',
+                          '--table=attachment', '--table=image'] +
+                         tool_args + ['stoq'])
+
+        # There's nowhere to dump the blobs to
+        with self.assertRaises(ValueError):
+            settings.dump_database(None, blobs='separate')
+
+    @mock.patch('stoqlib.database.settings.os.path.exists')
+    @mock.patch('stoqlib.database.settings.Process')
+    def test_restore_database_blobs(self, Process, exists):
+        exists.return_value = True
+        proc = Process.return_value
+        proc.wait.return_value = 0
+        proc.stderr.readline.return_value = ''
+        proc.returncode = 0
+        proc.communicate.return_value = (
+            '3218; 0 17934 TABLE DATA public sale stoq\n', '')
+
+        settings = DatabaseSettings(address='address',
+                                    username='username',
+                                    port='12345')
+        with mock.patch.object(settings, 'clean_database'):
+            self.assertEqual(
+                settings.restore_database('/tmp/dump', new_name='restored'),
+                'restored')
+
+        # The constraints referencing the blobs are only created after
+        # the blobs are restored
+        tool_args = ['-U', 'username', '-h', 'address', '-p', '12345']
+        self.assertEqual(
+            [call[0][0] for call in Process.call_args_list],
+            [['pg_restore', '--list', '/tmp/dump'],
+             ['pg_restore', '-d', 'restored', '--verbose'] + tool_args +
+             ['--section=pre-data', '--section=data', '/tmp/dump'],
+             ['pg_restore', '-d', 'restored', '--data-only'] + tool_args +
+             ['/tmp/dump-blobs'],
+             ['pg_restore', '-d', 'restored', '--verbose'] + tool_args +
+             ['--section=post-data', '/tmp/dump']])
+
+        proc.wait.return_value = 1
+        with mock.patch.object(settings, 'clean_database'):
+            with self.assertRaises(DatabaseError):
+                settings.restore_database('/tmp/dump', new_name='restored')
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.database.statements`"""
+
+from storm.expr import State
+
+from stoqlib.database.pool import PooledPostgres
+from stoqlib.database.statements import (get_statement_stats,
+                                         reset_statement_stats,
+                                         set_statement_cache_enabled,
+                                         _get_prepared_sql)
+from stoqlib.domain.sale import Sale, SaleView
+from stoqlib.domain.test.domaintest import DomainTest
+
+
+class StatementsTest(DomainTest):
+
+    def setUp(self):
+        super(StatementsTest, self).setUp()
+        reset_statement_stats()
+        self.addCleanup(set_statement_cache_enabled, True)
+
+    def _compile(self, resultset):
+        compile = self.store.get_database().connection_factory.compile
+        state = State()
+        return compile(resultset._get_select(), state), state.parameters
+
+    def test_compiled(self):
+        sale = self.create_sale()
+        resultset = self.store.find(SaleView, Sale.id == sale.id)
+
+        set_statement_cache_enabled(False)
+        expected, expected_params = self._compile(resultset)
+        self.assertEqual(get_statement_stats()['compiled_misses'], 0)
+
+        set_statement_cache_enabled(True)
+        for i in range(2):
+            statement, params = self._compile(resultset)
+            self.assertEqual(statement, expected)
+            self.assertEqual([p.get() for p in params],
+                             [p.get() for p in expected_params])
+
+        stats = get_statement_stats()
+        self.assertEqual(stats['compiled_misses'], 2)
+        self.assertEqual(stats['compiled_hits'], 2)
+
+        view = resultset.one()
+        self.assertEqual(view.id, sale.id)
+
+    def test_get_prepared_sql(self):
+        self.assertEqual(
+            _get_prepared_sql('SELECT a FROM t WHERE b = %s AND c = %s', 2),
+            'SELECT a FROM t WHERE b = $1 AND c = $2')
+        self.assertIsNone(
+            _get_prepared_sql("SELECT a FROM t WHERE b = '%s'", 0))
+        self.assertIsNone(
+            _get_prepared_sql("SELECT a FROM t WHERE b LIKE %s || '%%'", 1))
+        self.assertIsNone(_get_prepared_sql('SELECT a FROM t WHERE b = %s', 2))
+
+    def test_prepared(self):
+        if not isinstance(self.store.get_database(), PooledPostgres):
+            return
+
+        sale = self.create_sale()
+        for i in range(4):
+            view = self.store.find(SaleView, Sale.id == sale.id).one()
+            self.assertEqual(view.id, sale.id)
+
+        # The statement may have been prepared on this connection already
+        stats = get_statement_stats()
+        self.assertLessEqual(stats['prepared'], 1)
+        self.assertGreaterEqual(stats['prepared_executions'], 2)
+        self.assertEqual(stats['prepare_failures'], 0)
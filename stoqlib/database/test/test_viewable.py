@@ -26,16 +26,19 @@
 
 import datetime
 
+import mock
+
+from storm.exceptions import CompileError
 from storm.expr import LeftJoin, Sum
 
-from stoqlib.database.viewable import Viewable
+from stoqlib.database.viewable import Deferred, DeferredLoader, Viewable
 from stoqlib.domain.account import AccountTransaction
 from stoqlib.domain.commission import Commission
 from stoqlib.domain.payment.method import CheckData
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.payment.views import OutPaymentView
 from stoqlib.domain.person import Person, Client, Individual
-from stoqlib.domain.sale import Sale
+from stoqlib.domain.sale import Sale, SaleView
 from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.domain.till import TillEntry
 
@@ -57,6 +60,19 @@ class ClientView(Viewable):
     group_by = [Person, Client, person_name]
 
 
+class DeferredClientView(Viewable):
+    person = Deferred(Person)
+    client = Deferred(Client)
+
+    id = Client.id
+    person_name = Person.name
+
+    tables = [
+        Client,
+        LeftJoin(Person, Person.id == Client.person_id),
+    ]
+
+
 class ViewableTest(DomainTest):
 
     def test_sync(self):
@@ -141,6 +157,43 @@ class ViewableTest(DomainTest):
         item = self.store.find(ClientView, Client.id == client.id).one()
         self.assertFalse(hasattr(item, 'cpf'))
 
+    def test_extend_viewable_cached(self):
+        new_attrs = dict(cpf=Individual.cpf)
+        viewable = ClientView.extend_viewable(
+            new_attrs=new_attrs,
+            new_joins=[LeftJoin(Individual, Individual.person_id == Person.id)])
+
+        # The joins are compared by their sql, not by their identity
+        self.assertIs(ClientView.extend_viewable(
+            new_attrs=dict(cpf=Individual.cpf),
+            new_joins=[LeftJoin(Individual, Individual.person_id == Person.id)]),
+            viewable)
+
+        self.assertIsNot(ClientView.extend_viewable(
+            new_attrs=dict(birth_date=Individual.birth_date),
+            new_joins=[LeftJoin(Individual, Individual.person_id == Person.id)]),
+            viewable)
+        self.assertIsNot(ClientView.extend_viewable(new_attrs=new_attrs),
+                         viewable)
+
+        # Expressions that cannot be compiled are not cached
+        with mock.patch('stoqlib.database.viewable.expr_compile',
+                        side_effect=CompileError):
+            uncached = ClientView.extend_viewable(new_attrs=new_attrs)
+            self.assertTrue(issubclass(uncached, ClientView))
+            self.assertIsNot(ClientView.extend_viewable(new_attrs=new_attrs),
+                             uncached)
+
+    def test_derive_viewable(self):
+        create = mock.Mock(side_effect=lambda: type('Derived', (ClientView, ), {}))
+        viewable = ClientView.derive_viewable('test', create)
+        self.assertTrue(issubclass(viewable, ClientView))
+        self.assertIs(ClientView.derive_viewable('test', create), viewable)
+        self.assertEqual(create.call_count, 1)
+
+        self.assertIsNot(ClientView.derive_viewable('other', create), viewable)
+        self.assertEqual(create.call_count, 2)
+
     def test_viewable_without_id(self):
 
         class SimpleViewable(Viewable):
@@ -152,3 +205,93 @@ class ViewableTest(DomainTest):
 
         # And we still can hash the object
         assert hash(items[0])
+
+    def test_deferred(self):
+        self.assertIs(DeferredClientView.client, Client)
+        self.assertIn(Client.id, DeferredClientView.cls_spec)
+        self.assertNotIn(Client, DeferredClientView.cls_spec)
+
+        clients = [self.create_client(name=u'Client %d' % i)
+                   for i in range(3)]
+        ids = [c.id for c in clients]
+        views = list(self.store.find(DeferredClientView,
+                                     Client.id.is_in(ids)).order_by(Client.id))
+        self.assertEqual(len(views), 3)
+        self.assertEqual(views[0].__dict__['client'], clients[0].id)
+
+        # Accessing the client of a row loads the clients of all the rows
+        self.assertEqual(views[0].client, clients[0])
+        loader = views[0]._deferred_loader
+        for client in clients:
+            self.assertIn(client.id, loader._objects[Client])
+        self.assertNotIn(Person, loader._objects)
+
+        self.assertEqual([v.client for v in views], clients)
+        self.assertEqual([v.person for v in views],
+                         [c.person for c in clients])
+
+    def test_deferred_iter(self):
+        clients = [self.create_client(name=u'Client %d' % i)
+                   for i in range(3)]
+        ids = [c.id for c in clients]
+        views = self.store.find(DeferredClientView,
+                                Client.id.is_in(ids)).order_by(Client.id)
+
+        # The rows are accessed while iterating, but all the clients are
+        # still loaded together when the first one is needed
+        loaded = []
+        for view in views:
+            if not loaded:
+                self.assertEqual(view.client, clients[0])
+                loaded = list(view._deferred_loader._objects[Client])
+        self.assertEqual(sorted(loaded), sorted(ids))
+
+    def test_deferred_branch_identifier(self):
+        branches = [self.create_branch(u'Branch %d' % i) for i in range(2)]
+        branches[0].acronym = u'AA'
+        branches[1].acronym = None
+        sales = [self.create_sale(branch=branches[i % 2]) for i in range(4)]
+        results = self.store.find(
+            SaleView, SaleView.id.is_in([s.id for s in sales])).order_by(
+                SaleView.identifier)
+
+        # Only the rows and the acronyms of the branches are queried,
+        # even with the branches alternating between the rows
+        with self.count_tracer() as tracer:
+            identifiers = [str(view.identifier) for view in results]
+        self.assertEqual(tracer.count, 2)
+        self.assertEqual(identifiers,
+                         ['%s%05d' % (('AA', '')[i % 2], s.identifier)
+                          for i, s in enumerate(sales)])
+
+    def test_deferred_loader_order(self):
+        loader = DeferredLoader(self.store)
+        clients = [self.create_client(name=u'Client %d' % i)
+                   for i in range(3)]
+        for client in clients:
+            loader.add(Client, client.id)
+
+        # The ids are loaded in the order they were added
+        with mock.patch('stoqlib.database.viewable.DEFERRED_BATCH_SIZE', 2):
+            self.assertEqual(loader.get(Client, clients[0].id), clients[0])
+        self.assertIn(clients[1].id, loader._objects[Client])
+        self.assertNotIn(clients[2].id, loader._objects[Client])
+
+    def test_deferred_loader_window(self):
+        loader = DeferredLoader(self.store)
+        clients = [self.create_client(name=u'Client %d' % i)
+                   for i in range(4)]
+
+        # Only the last ids are kept, and only the last batch loaded
+        with mock.patch('stoqlib.database.viewable.DEFERRED_BATCH_SIZE', 2):
+            for client in clients:
+                loader.add(Client, client.id)
+            self.assertEqual(list(loader._pending[Client]),
+                             [clients[2].id, clients[3].id])
+
+            self.assertEqual(loader.get(Client, clients[0].id), clients[0])
+            self.assertEqual(sorted(loader._objects[Client]),
+                             sorted([clients[0].id, clients[2].id]))
+            self.assertEqual(loader.get(Client, clients[3].id), clients[3])
+            self.assertEqual(list(loader._objects[Client]), [clients[3].id])
+        self.assertEqual(len(loader._pending[Client]), 0)
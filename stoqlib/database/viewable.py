@@ -82,6 +82,20 @@ will be fetched, but the whole Client and Person objects will be also fetched
 (on the same sql select), and the objects will be added to the cache, so you can
 use them later, without going to the database for another query.
 
+When the objects are only needed after the user selects a row, wrap their
+classes in :class:`Deferred`. Only their ids will be selected and the objects
+will be loaded on the first access, together with the ones of all the other
+rows already fetched, in a single query:
+
+    >>> from stoqlib.database.viewable import Deferred
+    >>> class ClientView(Viewable):
+    ...     client = Deferred(Client)
+    ...
+    ...     name = Person.name
+    ...
+    ...     tables = [Client,
+    ...               LeftJoin(Person, Person.id == Client.person_id)]
+
 Another interesting feature is the possiblity to use aggregates in the viewable.
 Lets consider this sales table:
 
@@ -119,16 +133,144 @@ Now we can create this viewable:
 
 """
 
+import collections
 import inspect
+import threading
 import warnings
 
 from kiwi.python import ClassInittableObject
-from storm.expr import Expr
+from storm.exceptions import CompileError
+from storm.expr import Expr, State, compile as expr_compile
 from storm.properties import PropertyColumn
 
 from stoqlib.database.orm import ORMObject
 
 
+#: The maximum number of deferred objects loaded by a single query
+DEFERRED_BATCH_SIZE = 1000
+
+# (base viewable, key) -> derived viewable, see Viewable.derive_viewable
+_derived_viewables = {}
+_derived_lock = threading.Lock()
+
+
+def _get_expr_key(value):
+    # Expressions overload ==, so they cannot be used as dict keys. Their
+    # sql is used instead, so that the same join built again on each call
+    # still gets the same key
+    if isinstance(value, Deferred):
+        return ('deferred', value.cls)
+    if not isinstance(value, (Expr, PropertyColumn)):
+        return value
+    state = State()
+    try:
+        sql = expr_compile(value, state)
+        params = tuple(p.get() for p in state.parameters)
+        hash(params)
+    except (CompileError, TypeError):
+        # Keying it by its id would keep the viewable on the cache forever,
+        # since the same expression is usually built again on each call
+        raise ValueError("%r cannot be used as a key" % (value, ))
+    return (sql, params)
+
+
+class Deferred(object):
+    """A reference to a domain object that is loaded when first accessed
+
+    Only the id of the object is selected by the viewable. When the
+    attribute is accessed on a row, the object is loaded, together with
+    the objects of the same class of the other rows of the result set
+    that were not loaded yet, see :class:`DeferredLoader`.
+
+    On the viewable class, the attribute is still the domain class, so
+    it can be used on queries as before.
+
+    :param cls: the domain class
+    """
+
+    def __init__(self, cls):
+        self.cls = cls
+        # Set by Viewable.__class_init__
+        self.name = None
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.cls
+
+        value = instance.__dict__.get(self.name)
+        if value is None or isinstance(value, self.cls):
+            return value
+
+        loader = instance.__dict__.get('_deferred_loader')
+        if loader is None:
+            obj = instance._store.get(self.cls, value)
+        else:
+            obj = loader.get(self.cls, value)
+        instance.__dict__[self.name] = obj
+        return obj
+
+    def __set__(self, instance, value):
+        instance.__dict__[self.name] = value
+
+
+class DeferredLoader(object):
+    """Loads the :class:`Deferred` objects of the rows of a result set
+
+    The ids of the rows are added as they are fetched and, when an object
+    is needed, the pending ids of its class are loaded with a single
+    ``IN`` query, up to :obj:`DEFERRED_BATCH_SIZE` at a time.
+
+    Only the last :obj:`DEFERRED_BATCH_SIZE` pending ids and the last
+    loaded batch of each class are kept, so that streaming a large
+    result set doesn't use more memory as it goes. The rows keep the
+    objects they already accessed.
+
+    :param store: the store of the result set
+    """
+
+    def __init__(self, store):
+        self.store = store
+        # cls -> ids not loaded yet, in the order they were added
+        self._pending = {}
+        # cls -> {id: object} of the last batch loaded
+        self._objects = {}
+
+    def add(self, cls, obj_id):
+        """Adds the id of an object that may be needed later
+
+        :param cls: the domain class
+        :param obj_id: the id of the object
+        """
+        if obj_id is None or obj_id in self._objects.get(cls, ()):
+            return
+        pending = self._pending.setdefault(cls, collections.OrderedDict())
+        pending[obj_id] = None
+        if len(pending) > DEFERRED_BATCH_SIZE:
+            # The row of the oldest one will load it by itself, if needed
+            pending.popitem(last=False)
+
+    def get(self, cls, obj_id):
+        """Gets an object, loading it with the other pending ones
+
+        :param cls: the domain class
+        :param obj_id: the id of the object
+        :returns: the object or ``None`` if it doesn't exist anymore
+        """
+        obj = self._objects.get(cls, {}).get(obj_id)
+        if obj is not None:
+            return obj
+
+        pending = self._pending.get(cls, collections.OrderedDict())
+        pending.pop(obj_id, None)
+        ids = [obj_id]
+        while pending and len(ids) < DEFERRED_BATCH_SIZE:
+            ids.append(pending.popitem(last=False)[0])
+
+        objects = self._objects[cls] = dict(
+            (obj.id, obj) for obj in self.store.find(cls, cls.id.is_in(ids)))
+        return objects.get(obj_id)
+
+
 class Viewable(ClassInittableObject):
     # This is only used by query executer, and can be removed once all viewables
     # are converted to the new api
@@ -160,6 +302,10 @@ class Viewable(ClassInittableObject):
     #: still be possible to filter by.
     hidden_columns = []
 
+    #: The :class:`Deferred` attributes of the viewable, by their names.
+    #: Will be created when the viewable class is created.
+    deferred_attributes = {}
+
     @property
     def store(self):
         warnings.warn("Dont use self.store - get it from some other object)",
@@ -187,6 +333,7 @@ class Viewable(ClassInittableObject):
     def __class_init__(cls, new_attrs):
         cls_spec = []
         attributes = []
+        deferred = {}
 
         # We can ignore the last two items, since they are the Viewable class
         # and ``object``
@@ -197,6 +344,13 @@ class Viewable(ClassInittableObject):
                 if attr in cls.hidden_columns:
                     continue
 
+                if isinstance(value, Deferred):
+                    value.name = attr
+                    deferred[attr] = value
+                    attributes.append(attr)
+                    cls_spec.append(value.cls.id)
+                    continue
+
                 try:
                     is_domain = issubclass(value, ORMObject)
                 except TypeError:
@@ -215,6 +369,7 @@ class Viewable(ClassInittableObject):
 
         cls.cls_spec = tuple(cls_spec)
         cls.cls_attributes = attributes
+        cls.deferred_attributes = deferred
 
     @classmethod
     def extend_viewable(cls, new_attrs, new_joins=None):
@@ -227,7 +382,54 @@ class Viewable(ClassInittableObject):
           to the new viewable
         :param new_joins: A list of new joins that should be appended to the new
           viewable
+        :returns: the new viewable, the same class when called again with
+          the same attributes and joins, see :meth:`.derive_viewable`.
+          A new class is always created when they cannot be compiled
+        """
+        try:
+            key = ('extend',
+                   tuple(sorted((name, _get_expr_key(value))
+                                for name, value in new_attrs.items())),
+                   tuple(_get_expr_key(join) for join in new_joins or []))
+        except ValueError:
+            # Not cached, a new viewable is created on each call
+            return cls._extend_viewable(new_attrs, new_joins)
+        return cls.derive_viewable(
+            key, lambda: cls._extend_viewable(new_attrs, new_joins))
+
+    @classmethod
+    def derive_viewable(cls, key, create):
+        """Get a viewable derived from this one, creating it only once
+
+        Creating a viewable class is expensive and storm keeps information
+        about each class it queries, so viewables created at runtime should
+        be created only once and reused::
+
+            def create():
+                class BranchViewable(cls):
+                    tables = cls.tables + [...]
+                return BranchViewable
+
+            viewable = cls.derive_viewable('branch', create)
+
+        :param key: identifies what is changed on the derived viewable,
+          it must be hashable
+        :param create: a callable returning the derived viewable, called
+          the first time it is needed
+        :returns: the derived viewable, the same class for the same key
         """
+        full_key = (cls, key)
+        viewable = _derived_viewables.get(full_key)
+        if viewable is not None:
+            return viewable
+        with _derived_lock:
+            viewable = _derived_viewables.get(full_key)
+            if viewable is None:
+                viewable = _derived_viewables[full_key] = create()
+        return viewable
+
+    @classmethod
+    def _extend_viewable(cls, new_attrs, new_joins):
         # Create a new viewable as a subclass of the original viewable, that
         # inclues the new tables
         tables = cls.tables + (new_joins or [])
@@ -238,13 +440,20 @@ class Viewable(ClassInittableObject):
         cls_spec = list(cls.cls_spec)
         group_by = cls.group_by[:]
 
+        deferred = cls.deferred_attributes.copy()
+
         for key, value in new_attrs.items():
             setattr(new_table, key, value)
             cls_attributes.append(key)
+            if isinstance(value, Deferred):
+                value.name = key
+                deferred[key] = value
+                value = value.cls.id
             cls_spec.append(value)
             group_by.append(value)
 
         new_table.cls_attributes = cls_attributes
+        new_table.deferred_attributes = deferred
         new_table.cls_spec = tuple(cls_spec)
         if cls.group_by:
             new_table.group_by = group_by
@@ -39,12 +39,15 @@ the financial application to efficiently display a ledger.
 import datetime
 
 from kiwi.currency import currency
-from storm.expr import And, LeftJoin, Or
+from storm.expr import (And, Alias, Coalesce, Join, LeftJoin, Neg, Or,
+                        Select, Sum)
 from storm.info import ClassAlias
 from storm.references import Reference
 from zope.interface import implementer
 
-from stoqlib.database.expr import TransactionTimestamp, Date
+from stoqlib.database.expr import (Case, Concat, DateTrunc, Field, Over,
+                                   TransactionTimestamp, UnionAll)
+from stoqlib.database.orm import ORMObject
 from stoqlib.database.properties import (DateTimeCol, EnumCol, IdCol,
                                          IntCol, PriceCol, UnicodeCol)
 from stoqlib.database.viewable import Viewable
@@ -253,6 +256,8 @@ class Account(Domain):
     def get_total_for_interval(self, start, end):
         """Fetch total value for a given interval
 
+        The transactions of the whole days of start and end are included.
+
         :param datetime start: beginning of interval
         :param datetime end: of interval
         :returns: total value or one
@@ -264,8 +269,13 @@ class Account(Domain):
             raise TypeError("end must be a datetime.datetime, not %s" % (
                 type(end), ))
 
-        query = And(Date(AccountTransaction.date) >= start,
-                    Date(AccountTransaction.date) <= end,
+        # Compare the dates themselves instead of Date(date), so that the
+        # indexes on (account_id, date) and (source_account_id, date) are used
+        start = datetime.datetime.combine(start.date(), datetime.time())
+        end = (datetime.datetime.combine(end.date(), datetime.time()) +
+               datetime.timedelta(days=1))
+        query = And(AccountTransaction.date >= start,
+                    AccountTransaction.date < end,
                     AccountTransaction.source_account_id != AccountTransaction.account_id)
 
         transactions = self.store.find(AccountTransaction, query)
@@ -610,3 +620,216 @@ class AccountTransactionView(Viewable):
             return self.value
         else:
             return -self.value
+
+
+def _get_ledger_entries(account_id, other_account_id, value, side):
+    # The entries of the transactions on the ledger of one of their
+    # accounts. side makes the id of the entries unique, since a
+    # transaction has an entry on the ledger of each of its accounts
+    return Select(
+        columns=[Alias(Concat(AccountTransaction.id, side), 'id'),
+                 Alias(AccountTransaction.id, 'transaction_id'),
+                 Alias(account_id, 'account_id'),
+                 Alias(other_account_id, 'other_account_id'),
+                 Alias(AccountTransaction.date, 'date'),
+                 Alias(DateTrunc(u'month', AccountTransaction.date), 'month'),
+                 Alias(value, 'value')],
+        tables=[AccountTransaction])
+
+
+_value = Coalesce(AccountTransaction.value, 0)
+# A transaction that was not adjusted has the source equals to the
+# destination account, it's shown twice, see AccountTransactionView.get_value
+_is_unadjusted = AccountTransaction.account_id == AccountTransaction.source_account_id
+_value_by_type = Case(AccountTransaction.operation_type == AccountTransaction.TYPE_IN,
+                      _value, Neg(_value))
+
+_AccountLedgerEntry = Alias(UnionAll(
+    _get_ledger_entries(AccountTransaction.account_id,
+                        AccountTransaction.source_account_id,
+                        Case(_is_unadjusted, _value_by_type, _value),
+                        u'-1'),
+    _get_ledger_entries(AccountTransaction.source_account_id,
+                        AccountTransaction.account_id,
+                        Case(_is_unadjusted, Neg(_value_by_type), Neg(_value)),
+                        u'-0')), '_account_ledger_entry')
+
+
+def _entry(name):
+    return Field('_account_ledger_entry', name)
+
+
+# The entries with the sum of the values of their month up to each of them.
+# Only the account and the month are used in the windows, so that filtering
+# the ledger by them doesn't change the sums
+_AccountLedger = Alias(Select(
+    columns=[_entry('id'), _entry('transaction_id'), _entry('account_id'),
+             _entry('other_account_id'), _entry('month'), _entry('value'),
+             Alias(Over(Sum(_entry('value')),
+                        partition_by=[_entry('account_id'), _entry('month')],
+                        order_by=[_entry('date'), _entry('id')]),
+                   'month_balance'),
+             Alias(Over(Sum(_entry('value')),
+                        partition_by=[_entry('account_id'), _entry('month')]),
+                   'month_total')],
+    tables=[_AccountLedgerEntry]), '_account_ledger')
+
+
+# AccountBalanceCheckpoint inherits from ORMObject to avoid having te_id
+# for a table which is only derived from account_transaction.
+class AccountBalanceCheckpoint(ORMObject):
+    """The balance of an |account| at the end of a month
+
+    There's a checkpoint for each month where the |account| has
+    |accounttransactions|, kept up to date by triggers on
+    account_transaction (see functions.sql). The running balance of a
+    transaction is the checkpoint of its month minus the transactions
+    after it on that month, so it doesn't depend on all the transactions
+    before it, see :class:`AccountLedgerView`.
+    """
+
+    __storm_table__ = 'account_balance_checkpoint'
+    __storm_primary__ = 'account_id', 'month'
+
+    #: the id of the |account|
+    account_id = IdCol()
+
+    #: the first day of the month
+    month = DateTimeCol()
+
+    #: the balance of the account at the end of the month
+    balance = PriceCol(default=0)
+
+    @classmethod
+    def find_inconsistencies(cls, store):
+        """Find the checkpoints that don't match the transactions
+
+        :param store: a store
+        :returns: a list of tuples containing the (account id, month),
+          the expected balance and the checkpointed one
+        """
+        account_id = _entry('account_id')
+        month = _entry('month')
+        query = Select(
+            columns=[account_id, month,
+                     Over(Sum(Sum(_entry('value'))), partition_by=[account_id],
+                          order_by=[month])],
+            tables=[_AccountLedgerEntry],
+            group_by=[account_id, month],
+            order_by=[account_id, month])
+        # account id -> [(month, balance)], ordered by month
+        expected = {}
+        for account_id, month, balance in store.execute(query):
+            expected.setdefault(account_id, []).append((month, balance))
+        checkpoints = dict(
+            ((account_id, month), balance) for account_id, month, balance in
+            store.execute(Select(columns=[cls.account_id, cls.month, cls.balance],
+                                 tables=[cls])))
+
+        retval = []
+        for account_id, months in expected.items():
+            for month, balance in months:
+                found = checkpoints.pop((account_id, month), None)
+                if found != balance:
+                    retval.append(((account_id, month), balance, found))
+
+        # The months whose transactions were all removed keep their
+        # checkpoints, which must have the balance of the months before them
+        for (account_id, month), found in checkpoints.items():
+            balance = 0
+            for expected_month, expected_balance in expected.get(account_id, []):
+                if expected_month > month:
+                    break
+                balance = expected_balance
+            if found != balance:
+                retval.append(((account_id, month), balance, found))
+        return retval
+
+    @classmethod
+    def rebuild(cls, store):
+        """Rebuild the checkpoints of all the accounts from their transactions
+
+        :param store: a store
+        """
+        store.execute('SELECT rebuild_account_balance_checkpoint()')
+
+
+class AccountLedgerView(Viewable):
+    """The ledger of an |account|, with the running balance of each entry
+
+    Each |accounttransaction| is an entry on the ledger of its source
+    and of its destination account, and unadjusted transactions are
+    shown twice on the same ledger, see :meth:`AccountTransactionView.get_value`.
+
+    The running balance is computed by the database from the
+    :class:`AccountBalanceCheckpoint` of the month of the entry, so the
+    ledger can be filtered and loaded page by page and the balances are
+    still the ones of the whole account. Use :meth:`.find_by_account`
+    to query it.
+    """
+
+    Account_Other = ClassAlias(Account, 'account_other')
+
+    transaction = AccountTransaction
+
+    #: the id of the entry, the transaction id followed by -1 on the
+    #: ledger of the destination account or -0 on the source one
+    id = Field('_account_ledger', 'id')
+
+    #: the id of the |account| of this ledger
+    account_id = Field('_account_ledger', 'account_id')
+
+    code = AccountTransaction.code
+    description = AccountTransaction.description
+    date = AccountTransaction.date
+    month = Field('_account_ledger', 'month')
+    dest_account_id = AccountTransaction.account_id
+    source_account_id = AccountTransaction.source_account_id
+
+    #: the description of the other |account| of the transaction
+    account = Account_Other.description
+
+    #: the value of the transaction for this account, negative if the
+    #: account is the source
+    value = Field('_account_ledger', 'value')
+
+    #: the balance of the account after this entry
+    total = (Coalesce(AccountBalanceCheckpoint.balance, 0) -
+             Field('_account_ledger', 'month_total') +
+             Field('_account_ledger', 'month_balance'))
+
+    tables = [
+        _AccountLedger,
+        Join(AccountTransaction,
+             AccountTransaction.id == Field('_account_ledger', 'transaction_id')),
+        LeftJoin(Account_Other,
+                 Account_Other.id == Field('_account_ledger', 'other_account_id')),
+        LeftJoin(AccountBalanceCheckpoint,
+                 And(AccountBalanceCheckpoint.account_id ==
+                     Field('_account_ledger', 'account_id'),
+                     AccountBalanceCheckpoint.month ==
+                     Field('_account_ledger', 'month'))),
+    ]
+
+    @classmethod
+    def find_by_account(cls, store, account, start=None, end=None):
+        """Find the entries of the ledger of an |account|
+
+        :param store: a store
+        :param account: the |account|
+        :param start: if not ``None``, the first day of the entries
+        :param end: if not ``None``, the last day of the entries
+        :returns: a result set of the entries, in the order of the balances
+        """
+        # The filters on the month are redundant, but the database can
+        # apply them before computing the balances
+        query = [cls.account_id == account.id]
+        if start is not None:
+            start = datetime.datetime(start.year, start.month, start.day)
+            query.extend([cls.month >= start.replace(day=1),
+                          AccountTransaction.date >= start])
+        if end is not None:
+            end = datetime.datetime(end.year, end.month, end.day)
+            query.extend([cls.month <= end.replace(day=1),
+                          AccountTransaction.date < end + datetime.timedelta(days=1)])
+        return store.find(cls, And(*query)).order_by(cls.date, cls.id)
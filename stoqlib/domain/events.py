@@ -101,6 +101,18 @@ class ProductStockUpdateEvent(Event):
     """
 
 
+@public(since="1.10.0")
+class ProductStockBulkUpdateEvent(Event):
+    """
+    This event is emitted after the stock of several |products| was
+    in/decreased at once, for instance when confirming a |sale|.
+    :class:`ProductStockUpdateEvent` is still emitted for each one of them.
+
+    :param branch: the |branch| on which the stock was modified
+    :param updates: a list of (|product|, old_quantity, new_quantity)
+    """
+
+
 #
 # Service events
 #
@@ -25,15 +25,17 @@
 
 # pylint: enable=E1101
 
+import collections
 from decimal import Decimal
 
-from storm.expr import And, Eq, Cast, Join, LeftJoin, Or, Coalesce
+from storm.expr import (And, Eq, Cast, Join, LeftJoin, Or, Coalesce, Ne,
+                        Insert, Select)
 from storm.references import Reference, ReferenceSet
 
 from stoqlib.database.properties import (QuantityCol, PriceCol, DateTimeCol,
                                          IntCol, UnicodeCol, IdentifierCol,
                                          IdCol, BoolCol, EnumCol)
-from stoqlib.database.expr import StatementTimestamp
+from stoqlib.database.expr import Case, StatementTimestamp
 from stoqlib.database.viewable import Viewable
 from stoqlib.domain.base import Domain
 from stoqlib.domain.fiscal import FiscalBookEntry
@@ -347,18 +349,18 @@ class Inventory(Domain):
             raise AssertionError("You can not close an inventory which is "
                                  "already closed!")
 
-        for item in self.inventory_items:
-            if (item.actual_quantity is None or
-                item.recorded_quantity == item.actual_quantity):
-                continue
-
-            # FIXME: We are setting this here because, when generating a
-            # sintegra file, even if this item wasn't really adjusted (e.g.
-            # adjustment_qty bellow is 0) it needs to be specified and not
-            # setting this would result on self.get_cost returning 0.  Maybe
-            # we should resolve this in another way
-            # We don't call item.adjust since it needs an invoice number
-            item.is_adjusted = True
+        # FIXME: We are setting this here because, when generating a
+        # sintegra file, even if this item wasn't really adjusted (e.g.
+        # adjustment_qty bellow is 0) it needs to be specified and not
+        # setting this would result on self.get_cost returning 0.  Maybe
+        # we should resolve this in another way
+        # We don't call item.adjust since it needs an invoice number
+        # This is done with a single UPDATE, storm will also update the
+        # items that are already loaded
+        self.inventory_items.find(
+            And(Ne(InventoryItem.actual_quantity, None),
+                InventoryItem.actual_quantity !=
+                InventoryItem.recorded_quantity)).set(is_adjusted=True)
 
         self.close_date = StatementTimestamp()
         self.status = Inventory.STATUS_CLOSED
@@ -476,15 +478,7 @@ class Inventory(Domain):
         if extra_query:
             query = And(query, extra_query)
 
-        tables = [Sellable,
-                  Join(Product, Product.sellable_id == Sellable.id),
-                  Join(Storable, Storable.product_id == Product.id),
-                  LeftJoin(StorableBatch, StorableBatch.storable_id == Storable.id),
-                  LeftJoin(ProductStockItem,
-                           And(ProductStockItem.storable_id == Storable.id,
-                               Or(ProductStockItem.batch_id == StorableBatch.id,
-                                  Eq(ProductStockItem.batch_id, None)))),
-                  ]
+        tables = cls._get_inventory_tables()
         return store.using(*tables).find(
             (Sellable, Product, Storable, StorableBatch, ProductStockItem),
             query)
@@ -501,23 +495,57 @@ class Inventory(Domain):
                         branch=branch,
                         responsible=responsible)
 
-        for data in cls.get_sellables_for_inventory(store, branch, query):
-            sellable, product, storable, batch, stock_item = data
-            quantity = stock_item and stock_item.quantity or 0
-            if storable.is_batch:
-                # This used to test 'stock_item.quantity > 0' too to avoid
-                # creating inventory items for old batches not used anymore.
-                # We can't do that since that would make it impossible to
-                # adjust a batch that was wrongly set to 0. We need to find a
-                # way to mark the batches as "not used anymore" because they
-                # tend to grow to very large proportions and we are duplicating
-                # everyone here
-                if batch and stock_item:
-                    inventory.add_storable(storable, quantity, batch=batch)
-            else:
-                inventory.add_storable(storable, quantity)
+        # The items are created with a single INSERT ... SELECT, since there
+        # may be hundreds of thousands of them. The batches are validated
+        # (see Domain.validate_batch) by the query itself: a batch is always
+        # from the storable because of the join, storables that are not
+        # controlled by batches never get one and the ones that are only get
+        # an item for the batches that have a stock item.
+        # This used to also require the batch's stock to be > 0 to avoid
+        # creating inventory items for old batches not used anymore.
+        # We can't do that since that would make it impossible to
+        # adjust a batch that was wrongly set to 0. We need to find a
+        # way to mark the batches as "not used anymore" because they
+        # tend to grow to very large proportions and we are duplicating
+        # everyone here
+        is_batch = Eq(Storable.is_batch, True)
+        columns = collections.OrderedDict([
+            (InventoryItem.inventory_id, inventory.id),
+            (InventoryItem.product_id, Product.id),
+            (InventoryItem.batch_id, Case(is_batch, StorableBatch.id)),
+            (InventoryItem.product_cost, Sellable.cost),
+            (InventoryItem.recorded_quantity,
+             Coalesce(ProductStockItem.quantity, 0)),
+            (InventoryItem.reason, u''),
+        ])
+
+        clause = And(ProductStockItem.branch_id == branch.id,
+                     Or(Eq(Storable.is_batch, False),
+                        Ne(StorableBatch.id, None)))
+        if query:
+            clause = And(clause, query)
+
+        select = Select(columns.values(), where=clause,
+                        tables=cls._get_inventory_tables())
+        store.execute(Insert(columns, table=InventoryItem, values=select))
         return inventory
 
+    #
+    # Private
+    #
+
+    @classmethod
+    def _get_inventory_tables(cls):
+        return [Sellable,
+                Join(Product, Product.sellable_id == Sellable.id),
+                Join(Storable, Storable.product_id == Product.id),
+                LeftJoin(StorableBatch, StorableBatch.storable_id == Storable.id),
+                LeftJoin(ProductStockItem,
+                         And(ProductStockItem.storable_id == Storable.id,
+                             Or(ProductStockItem.batch_id == StorableBatch.id,
+                                Eq(ProductStockItem.batch_id, None)))),
+                ]
+
 
 class InventoryItemsView(Viewable):
     """Holds information about |inventoryitems|
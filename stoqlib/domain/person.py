@@ -60,14 +60,15 @@ import operator
 
 from kiwi.currency import currency
 from kiwi.datatypes import converter
-from storm.expr import (And, Coalesce, Eq, Join, LeftJoin, Or, Update, Select,
-                        Alias, Sum)
+from storm.expr import (And, Coalesce, Eq, Join, LeftJoin, Ne, Or, Update,
+                        Select, Alias, Sum)
 from storm.info import ClassAlias
 from storm.references import Reference, ReferenceSet
 from zope.interface import implementer
 
 from stoqlib.database.expr import (Age, Case, Concat, Date, DateTrunc, Interval,
-                                   Field, NotIn, StoqNormalizeString)
+                                   Field, FullJoin, NotIn, StoqNormalizeString)
+from stoqlib.database.orm import ORMObject
 from stoqlib.database.properties import (BoolCol, DateTimeCol,
                                          IntCol, PercentCol,
                                          PriceCol, EnumCol,
@@ -1037,16 +1038,19 @@ class Client(Domain):
         if max_date:
             return max_date.date()
 
+    def _get_credit_ledger(self):
+        # Query the values instead of getting the ledger object, since
+        # it's changed by the triggers and the cached one could be stale
+        ledger = self.store.find(
+            (ClientCreditLedger.credit_received -
+             ClientCreditLedger.credit_spent,
+             ClientCreditLedger.store_credit_debit),
+            ClientCreditLedger.person_id == self.person_id).one()
+        return ledger or (0, 0)
+
     @property
     def remaining_store_credit(self):
-        from stoqlib.domain.payment.views import InPaymentView
-        status_query = Or(InPaymentView.status == Payment.STATUS_PENDING,
-                          InPaymentView.status == Payment.STATUS_CONFIRMED)
-        query = And(InPaymentView.person_id == self.person.id,
-                    status_query,
-                    InPaymentView.method_name == u'store_credit')
-
-        debit = self.store.find(InPaymentView, query).sum(InPaymentView.value) or currency('0.0')
+        debit = self._get_credit_ledger()[1]
         return currency(self.credit_limit - debit)
 
     def get_credit_transactions(self):
@@ -1080,16 +1084,7 @@ class Client(Domain):
         """Returns a client's credit balance.
 
         :returns: The client's credit balance."""
-        transactions = self.get_credit_transactions()
-
-        balance = 0
-        for payment in transactions:
-            if payment.payment_type == payment.TYPE_OUT:
-                balance += payment.paid_value
-            else:
-                balance -= payment.paid_value
-
-        return currency(balance)
+        return currency(self._get_credit_ledger()[0])
 
     @property
     def salary(self):
@@ -1959,6 +1954,98 @@ class UserBranchAccess(Domain):
         return store.find(cls, user=user, branch=branch).one() is not None
 
 
+# ClientCreditLedger inherits from ORMObject to avoid having te_id for a
+# table which is only derived from payment.
+class ClientCreditLedger(ORMObject):
+    """The running totals of the credit of a |person|
+
+    This has the same information as summing the credit and store credit
+    |payments| of the person, but it's kept up to date by triggers on
+    payment and payment_group (see functions.sql) when a payment is paid,
+    cancelled and so on. That way the credit of a |client| is a lookup by
+    its primary key, no matter how many payments it has.
+
+    There's no ledger for persons that never had a credit or store
+    credit |payment|.
+    """
+
+    __storm_table__ = 'client_credit_ledger'
+
+    #: the id of the |person| paying the payments
+    person_id = IdCol(primary=True)
+
+    #: the sum of the paid value of the paid outgoing credit payments,
+    #: that is, the credit given to the person
+    credit_received = PriceCol(default=0)
+
+    #: the sum of the paid value of the paid incoming credit payments,
+    #: that is, the credit used by the person
+    credit_spent = PriceCol(default=0)
+
+    #: the sum of the value of the pending and confirmed incoming store
+    #: credit payments, that is, what the person still owes
+    store_credit_debit = PriceCol(default=0)
+
+    @classmethod
+    def find_inconsistencies(cls, store):
+        """Find the ledgers that don't match the payments
+
+        :param store: a store
+        :returns: a list of tuples containing the person id, the expected
+          (credit_received, credit_spent, store_credit_debit) and the
+          one in the ledger
+        """
+        is_paid_credit = And(PaymentMethod.method_name == u'credit',
+                             Payment.status == Payment.STATUS_PAID)
+        is_store_credit_debit = And(
+            PaymentMethod.method_name == u'store_credit',
+            Payment.payment_type == Payment.TYPE_IN,
+            Or(Payment.status == Payment.STATUS_PENDING,
+               Payment.status == Payment.STATUS_CONFIRMED))
+        expected = Alias(Select(
+            columns=[Alias(PaymentGroup.payer_id, 'person_id'),
+                     Alias(Coalesce(Sum(Case(
+                         And(is_paid_credit,
+                             Payment.payment_type == Payment.TYPE_OUT),
+                         Payment.paid_value)), 0), 'credit_received'),
+                     Alias(Coalesce(Sum(Case(
+                         And(is_paid_credit,
+                             Payment.payment_type == Payment.TYPE_IN),
+                         Payment.paid_value)), 0), 'credit_spent'),
+                     Alias(Coalesce(Sum(Case(
+                         is_store_credit_debit, Payment.value)), 0),
+                         'store_credit_debit')],
+            tables=[Payment,
+                    Join(PaymentGroup, PaymentGroup.id == Payment.group_id),
+                    Join(PaymentMethod, PaymentMethod.id == Payment.method_id)],
+            where=Ne(PaymentGroup.payer_id, None),
+            group_by=[PaymentGroup.payer_id]), '_expected')
+        query = Select(
+            columns=[Coalesce(cls.person_id, Field('_expected', 'person_id')),
+                     Coalesce(Field('_expected', 'credit_received'), 0),
+                     Coalesce(Field('_expected', 'credit_spent'), 0),
+                     Coalesce(Field('_expected', 'store_credit_debit'), 0),
+                     Coalesce(cls.credit_received, 0),
+                     Coalesce(cls.credit_spent, 0),
+                     Coalesce(cls.store_credit_debit, 0)],
+            tables=[expected,
+                    FullJoin(cls, cls.person_id == Field('_expected', 'person_id'))])
+        retval = []
+        for row in store.execute(query):
+            person_id, expected, found = row[0], row[1:4], row[4:7]
+            if expected != found:
+                retval.append((person_id, expected, found))
+        return retval
+
+    @classmethod
+    def rebuild(cls, store):
+        """Rebuild the credit ledger of all persons from the payments
+
+        :param store: a store
+        """
+        store.execute('SELECT rebuild_client_credit_ledger()')
+
+
 #
 # Views
 #
@@ -2380,26 +2467,6 @@ class ClientSalaryHistoryView(Viewable):
         return resultset
 
 
-_InPaymentSummary = Select(
-    columns=[PaymentGroup.payer_id,
-             Alias(Sum(Payment.paid_value), 'paid_value')],
-    tables=[Payment,
-            Join(PaymentGroup, PaymentGroup.id == Payment.group_id),
-            Join(PaymentMethod, PaymentMethod.id == Payment.method_id)],
-    where=And(Payment.payment_type == Payment.TYPE_IN,
-              PaymentMethod.method_name == u'credit',
-              Payment.status == Payment.STATUS_PAID),
-    group_by=[PaymentGroup.payer_id])
-
-_OutPaymentSummary = Select(
-    columns=_InPaymentSummary.columns,
-    tables=_InPaymentSummary.tables,
-    group_by=_InPaymentSummary.group_by,
-    where=And(Payment.payment_type == Payment.TYPE_OUT,
-              PaymentMethod.method_name == u'credit',
-              Payment.status == Payment.STATUS_PAID))
-
-
 class ClientsWithCreditView(Viewable):
     """A view that displays client with credit
     """
@@ -2412,8 +2479,8 @@ class ClientsWithCreditView(Viewable):
 
     cnpj = Company.cnpj
 
-    credit_received = Field('_out_summary', 'paid_value')
-    credit_spent = Coalesce(Field('_in_summary', 'paid_value'), 0)
+    credit_received = ClientCreditLedger.credit_received
+    credit_spent = ClientCreditLedger.credit_spent
     remaining_credit = credit_received - credit_spent
 
     tables = [
@@ -2421,10 +2488,7 @@ class ClientsWithCreditView(Viewable):
         Join(Person, Person.id == Client.person_id),
         LeftJoin(Individual, Individual.person_id == Person.id),
         LeftJoin(Company, Company.person_id == Person.id),
-        LeftJoin(Alias(_InPaymentSummary, '_in_summary'),
-                 Field('_in_summary', 'payer_id') == Person.id),
-        LeftJoin(Alias(_OutPaymentSummary, '_out_summary'),
-                 Field('_out_summary', 'payer_id') == Person.id),
+        Join(ClientCreditLedger, ClientCreditLedger.person_id == Person.id),
     ]
 
     clause = Or(credit_spent > 0, credit_received > 0)
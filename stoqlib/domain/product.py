@@ -86,11 +86,13 @@ from decimal import Decimal
 
 from kiwi.currency import currency
 from storm.references import Reference, ReferenceSet
-from storm.expr import (And, Eq, LeftJoin, Alias, Sum, Coalesce, Select, Join, Cast)
+from storm.expr import (And, Eq, LeftJoin, Alias, Sum, Coalesce, Select, Join, Cast,
+                        In)
 from zope.interface import implementer
 
-from stoqlib.database.expr import (Field, TransactionTimestamp,
+from stoqlib.database.expr import (Field, FullJoin, TransactionTimestamp,
                                    ArrayAgg, Contains, IsContainedBy)
+from stoqlib.database.orm import ORMObject
 from stoqlib.database.properties import (BoolCol, DateTimeCol, DecimalCol,
                                          EnumCol, IdCol, IntCol, PercentCol,
                                          PriceCol, QuantityCol, UnicodeCol)
@@ -98,7 +100,8 @@ from stoqlib.database.runtime import get_current_user
 from stoqlib.database.viewable import Viewable
 from stoqlib.domain.base import Domain
 from stoqlib.domain.events import (ProductCreateEvent, ProductEditEvent,
-                                   ProductRemoveEvent, ProductStockUpdateEvent)
+                                   ProductRemoveEvent, ProductStockUpdateEvent,
+                                   ProductStockBulkUpdateEvent)
 from stoqlib.domain.interfaces import IDescribable
 from stoqlib.domain.person import Person, Branch
 from stoqlib.domain.sellable import Sellable
@@ -889,6 +892,82 @@ class ProductStockItem(Domain):
         self.stock_cost = total_cost / total_items
 
 
+# ProductStockSummary inherits from ORMObject to avoid having te_id for a
+# table which is only derived from product_stock_item.
+class ProductStockSummary(ORMObject):
+    """The stock of a |storable| on a |branch|, summing all its batches
+
+    There's one summary for each |storable| and |branch| combination,
+    even if there was never stock for it there, so that views filtering
+    by a branch can still show all the products.
+
+    This is kept up to date by triggers on storable, branch and
+    product_stock_item (see functions.sql), so that the views don't need
+    to aggregate all the stock items every time they are queried.
+    """
+
+    __storm_table__ = 'product_stock_summary'
+    __storm_primary__ = 'storable_id', 'branch_id'
+
+    #: the id of the |storable|
+    storable_id = IdCol()
+
+    #: the id of the |branch|
+    branch_id = IdCol()
+
+    #: the sum of the quantity of all stock items
+    stock = QuantityCol(default=0)
+
+    #: the sum of quantity * stock_cost of all stock items
+    total_stock_cost = DecimalCol(default=0)
+
+    @classmethod
+    def find_inconsistencies(cls, store):
+        """Find the summaries that don't match the stock items
+
+        :param store: a store
+        :returns: a list of tuples containing the (storable id, branch id),
+          the expected (stock, total_stock_cost) and the summarized one
+        """
+        expected = Alias(Select(
+            columns=[Alias(Storable.id, 'storable_id'),
+                     Alias(Branch.id, 'branch_id'),
+                     Alias(Coalesce(Sum(ProductStockItem.quantity), 0), 'stock'),
+                     Alias(Coalesce(Sum(ProductStockItem.quantity *
+                                        ProductStockItem.stock_cost), 0),
+                           'total_stock_cost')],
+            tables=[Storable,
+                    # This is equivalent to a cross join
+                    Join(Branch, And(True)),
+                    LeftJoin(ProductStockItem,
+                             And(ProductStockItem.branch_id == Branch.id,
+                                 ProductStockItem.storable_id == Storable.id))],
+            group_by=[Storable.id, Branch.id]), '_expected')
+        query = Select(
+            columns=[Coalesce(cls.storable_id, Field('_expected', 'storable_id')),
+                     Coalesce(cls.branch_id, Field('_expected', 'branch_id')),
+                     Field('_expected', 'stock'),
+                     Field('_expected', 'total_stock_cost'),
+                     cls.stock, cls.total_stock_cost],
+            tables=[expected,
+                    FullJoin(cls, And(cls.storable_id == Field('_expected', 'storable_id'),
+                                      cls.branch_id == Field('_expected', 'branch_id')))])
+        retval = []
+        for row in store.execute(query):
+            key, expected, summarized = row[0:2], row[2:4], row[4:6]
+            if expected != summarized:
+                retval.append((key, expected, summarized))
+        return retval
+
+    @classmethod
+    def rebuild(cls, store):
+        """Rebuild the stock summary of all storables from the stock items
+
+        :param store: a store
+        """
+        store.execute('SELECT rebuild_product_stock_summary()')
+
+
 class Storable(Domain):
     '''Storable represents the stock of a |product|.
 
@@ -996,7 +1075,7 @@ class Storable(Domain):
                                      stock_item.quantity)
 
     def decrease_stock(self, quantity, branch, type, object_id,
-                       cost_center=None, batch=None):
+                       cost_center=None, batch=None, stock_cache=None):
         """When receiving a product, update the stock reference for the sold item
         this on a specific |branch|. Returns the stock item that was
         decreased.
@@ -1010,6 +1089,8 @@ class Storable(Domain):
             related, if any
         :param batch: The batch of the storable. Should be not ``None`` if
             self.is_batch is ``True``
+        :param stock_cache: a :class:`StockCache` for *branch*, used when
+            decreasing the stock of several storables at once
         """
         # FIXME: Put this back once 1.6 is released
         # assert isinstance(type, int)
@@ -1019,7 +1100,13 @@ class Storable(Domain):
         if branch is None:
             raise ValueError(u"branch cannot be None")
 
-        stock_item = self.get_stock_item(branch, batch)
+        if stock_cache is not None:
+            assert stock_cache.branch == branch
+            stock_item = stock_cache.get_stock_item(self, batch)
+            responsible = stock_cache.responsible
+        else:
+            stock_item = self.get_stock_item(branch, batch)
+            responsible = get_current_user(self.store)
         if stock_item is None or quantity > stock_item.quantity:
             raise StockError(
                 _('Quantity to sell is greater than the available stock.'))
@@ -1031,7 +1118,7 @@ class Storable(Domain):
             product_stock_item=stock_item,
             quantity=-quantity,
             stock_cost=stock_item.stock_cost,
-            responsible=get_current_user(self.store),
+            responsible=responsible,
             type=type,
             object_id=object_id,
             store=self.store)
@@ -1041,6 +1128,9 @@ class Storable(Domain):
 
         ProductStockUpdateEvent.emit(self.product, branch, old_quantity,
                                      stock_item.quantity)
+        if stock_cache is not None:
+            stock_cache.updates.append((self.product, old_quantity,
+                                        stock_item.quantity))
 
         return stock_item
 
@@ -1455,6 +1545,107 @@ class StockTransactionHistory(Domain):
         return self.types[self.type] % number
 
 
+class StockCache(object):
+    """The stock information needed to change the stock of several
+    |sellables| at once
+
+    The |products|, |storables| and stock items of all the sellables
+    are fetched with one query each, instead of one per sellable, and the
+    current user is only fetched once. Only the reads are batched: the
+    :class:`StockTransactionHistory` of each change is still created as a
+    domain object and inserted on its own when the store is flushed.
+    Pass it to :meth:`Storable.decrease_stock` and call
+    :meth:`.emit_updates` when done::
+
+        stock_cache = StockCache(store, branch, sellables)
+        for item in items:
+            storable = stock_cache.get_storable(item.sellable)
+            storable.decrease_stock(..., stock_cache=stock_cache)
+        stock_cache.emit_updates()
+
+    :param store: a store
+    :param branch: the |branch| where the stock will be changed
+    :param sellables: the |sellables| whose stock will be changed
+    """
+
+    def __init__(self, store, branch, sellables):
+        self.store = store
+        self.branch = branch
+        #: the current user, responsible for the stock changes
+        self.responsible = get_current_user(store)
+        #: a list of (|product|, old_quantity, new_quantity), see
+        #: :class:`stoqlib.domain.events.ProductStockBulkUpdateEvent`
+        self.updates = []
+
+        sellable_ids = set(sellable.id for sellable in sellables)
+        self._products = {}
+        self._storables = {}
+        self._stock_items = {}
+        if not sellable_ids:
+            return
+
+        tables = [Product,
+                  LeftJoin(Storable, Storable.product_id == Product.id)]
+        for product, storable in store.using(*tables).find(
+                (Product, Storable), In(Product.sellable_id, list(sellable_ids))):
+            self._products[product.sellable_id] = product
+            self._storables[product.sellable_id] = storable
+
+        storable_ids = [s.id for s in self._storables.values() if s]
+        if not storable_ids:
+            return
+        for stock_item in store.find(
+                ProductStockItem,
+                And(ProductStockItem.branch_id == branch.id,
+                    In(ProductStockItem.storable_id, storable_ids))):
+            key = (stock_item.storable_id, stock_item.batch_id)
+            self._stock_items[key] = stock_item
+
+    #
+    #  Public API
+    #
+
+    def get_product(self, sellable):
+        """Get the |product| of a |sellable|
+
+        :returns: the |product| or ``None`` if the sellable is not one
+        """
+        return self._products.get(sellable.id)
+
+    def get_storable(self, sellable):
+        """Get the |storable| of a |sellable|
+
+        :returns: the |storable| or ``None`` if the sellable doesn't
+          have one
+        """
+        return self._storables.get(sellable.id)
+
+    def get_stock_item(self, storable, batch):
+        """Get the stock item of a |storable| and |batch|
+
+        This works like :meth:`Storable.get_stock_item`, but without
+        querying the database.
+
+        :param storable: the |storable|
+        :param batch: the |batch| or ``None``
+        :returns: the stock item or ``None`` if there's no stock item for them
+        """
+        # The product and sellable are already on the store's cache
+        storable.validate_batch(batch, sellable=storable.product.sellable,
+                                storable=storable)
+        return self._stock_items.get((storable.id, batch and batch.id))
+
+    def emit_updates(self):
+        """Emits :class:`stoqlib.domain.events.ProductStockBulkUpdateEvent`
+        for the updates done since the last call, if any.
+        """
+        if not self.updates:
+            return
+        updates = self.updates
+        self.updates = []
+        ProductStockBulkUpdateEvent.emit(self.branch, updates)
+
+
 class ProductComponent(Domain):
     """A |product| and it's related |component| eg other product
 
@@ -40,14 +40,15 @@ from storm.info import ClassAlias
 from storm.references import Reference, ReferenceSet
 from zope.interface import implementer
 
-from stoqlib.database.expr import (Concat, Date, Distinct, Field, NullIf,
-                                   TransactionTimestamp)
+from stoqlib.database.expr import (Concat, Date, Distinct, Field, FullJoin,
+                                   NullIf, TransactionTimestamp)
+from stoqlib.database.orm import ORMObject
 from stoqlib.database.properties import (UnicodeCol, DateTimeCol, IntCol,
                                          PriceCol, QuantityCol, IdentifierCol,
                                          IdCol, BoolCol, EnumCol)
 from stoqlib.database.runtime import (get_current_user,
                                       get_current_branch)
-from stoqlib.database.viewable import Viewable
+from stoqlib.database.viewable import Deferred, Viewable
 from stoqlib.domain.address import Address, CityLocation
 from stoqlib.domain.base import Domain
 from stoqlib.domain.costcenter import CostCenter
@@ -65,7 +66,8 @@ from stoqlib.domain.person import (Person, Client, Branch, LoginUser,
                                    SalesPerson, Company, Individual,
                                    ClientCategory)
 from stoqlib.domain.product import (Product, ProductHistory, Storable,
-                                    StockTransactionHistory, StorableBatch)
+                                    StockCache, StockTransactionHistory,
+                                    StorableBatch)
 from stoqlib.domain.returnedsale import ReturnedSale, ReturnedSaleItem
 from stoqlib.domain.sellable import Sellable, SellableCategory
 from stoqlib.domain.service import Service
@@ -248,7 +250,13 @@ class SaleItem(Domain):
     #  Public API
     #
 
-    def sell(self, branch):
+    def sell(self, branch, stock_cache=None):
+        """Sell this item, decreasing its stock
+
+        :param branch: the |branch| where the item was sold
+        :param stock_cache: a :class:`stoqlib.domain.product.StockCache`
+            for *branch*, used when selling several items at once
+        """
         store = self.store
         if not (branch and
                 branch.id == get_current_branch(store).id):
@@ -267,13 +275,17 @@ class SaleItem(Domain):
         SaleItemBeforeDecreaseStockEvent.emit(self)
 
         quantity_to_decrease = self.quantity - self.quantity_decreased
-        storable = self.sellable.product_storable
+        if stock_cache is not None:
+            storable = stock_cache.get_storable(self.sellable)
+        else:
+            storable = self.sellable.product_storable
         if storable and quantity_to_decrease:
             try:
                 item = storable.decrease_stock(
                     quantity_to_decrease, branch,
                     StockTransactionHistory.TYPE_SELL, self.id,
-                    cost_center=self.sale.cost_center, batch=self.batch)
+                    cost_center=self.sale.cost_center, batch=self.batch,
+                    stock_cache=stock_cache)
             except StockError as err:
                 raise SellError(str(err))
 
@@ -969,11 +981,20 @@ class Sale(Domain):
         # FIXME: We should use self.branch, but it's not supported yet
         store = self.store
         branch = get_current_branch(store)
-        for item in self.get_items():
-            self.validate_batch(item.batch, sellable=item.sellable)
-            if item.sellable.product:
+        # Fetch the sellables and the stock information of all the items
+        # at once, instead of doing it for each one
+        items = [item for item, sellable in store.find(
+            (SaleItem, Sellable), And(SaleItem.sale_id == self.id,
+                                      Sellable.id == SaleItem.sellable_id))]
+        stock_cache = StockCache(store, branch,
+                                 [item.sellable for item in items])
+        for item in items:
+            self.validate_batch(item.batch, sellable=item.sellable,
+                                storable=stock_cache.get_storable(item.sellable))
+            if stock_cache.get_product(item.sellable):
                 ProductHistory.add_sold_item(store, branch, item)
-            item.sell(branch)
+            item.sell(branch, stock_cache=stock_cache)
+        stock_cache.emit_updates()
 
         self.total_amount = self.get_total_sale_amount()
 
@@ -1848,6 +1869,66 @@ _SaleItemSummary = Select(columns=[SaleItem.sale_id,
 SaleItemSummary = Alias(_SaleItemSummary, '_sale_item')
 
 
+# SaleSummary inherits from ORMObject to avoid having te_id for a table
+# which is only derived from sale_item.
+class SaleSummary(ORMObject):
+    """The summary of the |saleitems| of a |sale|
+
+    This is the same information as :obj:`SaleItemSummary`, but instead
+    of aggregating the whole sale_item table every time it is queried, it
+    is kept up to date by triggers on sale_item and invoice_item_ipi
+    (see functions.sql), which makes the views using it a lot cheaper.
+    """
+
+    __storm_table__ = 'sale_summary'
+
+    #: the id of the |sale| this summary is for
+    sale_id = IdCol(primary=True)
+
+    #: the sum of quantity * price of all the sale items
+    subtotal = PriceCol(default=0)
+
+    #: the sum of the quantity of all the sale items
+    total_quantity = QuantityCol(default=0)
+
+    #: the sum of the ipi value of all the sale items
+    v_ipi = PriceCol(default=0)
+
+    @classmethod
+    def find_inconsistencies(cls, store):
+        """Find the sales where the summary doesn't match the sale items
+
+        :param store: a store
+        :returns: a list of tuples containing the sale id, the expected
+          (subtotal, total_quantity, v_ipi) and the summarized one
+        """
+        query = Select(
+            columns=[Coalesce(SaleSummary.sale_id, Field('_sale_item', 'sale_id')),
+                     Coalesce(Field('_sale_item', 'subtotal'), 0),
+                     Coalesce(Field('_sale_item', 'total_quantity'), 0),
+                     Coalesce(Field('_sale_item', 'v_ipi'), 0),
+                     Coalesce(SaleSummary.subtotal, 0),
+                     Coalesce(SaleSummary.total_quantity, 0),
+                     Coalesce(SaleSummary.v_ipi, 0)],
+            tables=[SaleItemSummary,
+                    FullJoin(SaleSummary,
+                             SaleSummary.sale_id == Field('_sale_item', 'sale_id'))])
+        retval = []
+        for row in store.execute(query):
+            sale_id, expected, summarized = row[0], row[1:4], row[4:7]
+            if expected != summarized:
+                retval.append((sale_id, expected, summarized))
+        return retval
+
+    @classmethod
+    def rebuild(cls, store):
+        """Rebuild the summary of all the sales from their items
+
+        :param store: a store
+        """
+        store.execute('SELECT rebuild_sale_summary()')
+
+
 class SaleView(Viewable):
     """Stores general informatios about sales
     """
@@ -1857,13 +1938,13 @@ class SaleView(Viewable):
     Person_SalesPerson = ClassAlias(Person, 'person_sales_person')
 
     #: the |sale| of the view
-    sale = Sale
+    sale = Deferred(Sale)
 
     #: the |client| of the view
-    client = Client
+    client = Deferred(Client)
 
     #: The branch this sale was sold
-    branch = Branch
+    branch = Deferred(Branch)
 
     #: the id of the sale table
     id = Sale.id
@@ -1926,21 +2007,21 @@ class SaleView(Viewable):
     branch_name = Coalesce(NullIf(Company.fancy_name, u''), Person_Branch.name)
 
     # Summaries
-    v_ipi = Coalesce(Field('_sale_item', 'v_ipi'), 0)
+    v_ipi = Coalesce(SaleSummary.v_ipi, 0)
 
     #: the sum of all items in the sale
-    _subtotal = Coalesce(Field('_sale_item', 'subtotal'), 0) + v_ipi
+    _subtotal = Coalesce(SaleSummary.subtotal, 0) + v_ipi
 
     #: the items total quantity for the sale
-    total_quantity = Coalesce(Field('_sale_item', 'total_quantity'), 0)
+    total_quantity = Coalesce(SaleSummary.total_quantity, 0)
 
     #: the subtotal - discount + charge
-    _total = Coalesce(Field('_sale_item', 'subtotal'), 0) - \
+    _total = Coalesce(SaleSummary.subtotal, 0) - \
         Sale.discount_value + Sale.surcharge_value + v_ipi
 
     tables = [
         Sale,
-        LeftJoin(SaleItemSummary, Field('_sale_item', 'sale_id') == Sale.id),
+        LeftJoin(SaleSummary, SaleSummary.sale_id == Sale.id),
         LeftJoin(Branch, Sale.branch_id == Branch.id),
         LeftJoin(Client, Sale.client_id == Client.id),
         LeftJoin(SalesPerson, Sale.salesperson_id == SalesPerson.id),
@@ -2249,7 +2330,7 @@ class SalesPersonSalesView(Viewable):
 
     # aggregates
     total_amount = Sum(Sale.total_amount)
-    total_quantity = Sum(Field('_sale_item', 'total_quantity'))
+    total_quantity = Sum(SaleSummary.total_quantity)
     total_sales = Count(Sale.id)
     #paid_value = Field('_paid_sale', 'paid_value')
 
@@ -2258,7 +2339,7 @@ class SalesPersonSalesView(Viewable):
     tables = [
         SalesPerson,
         LeftJoin(Sale, Sale.salesperson_id == SalesPerson.id),
-        LeftJoin(SaleItemSummary, Field('_sale_item', 'sale_id') == Sale.id),
+        LeftJoin(SaleSummary, SaleSummary.sale_id == Sale.id),
         LeftJoin(Person, Person.id == SalesPerson.person_id),
         #LeftJoin(PaidSale, Field('_paid_sale', 'salesperson_id') == SalesPerson.id),
     ]
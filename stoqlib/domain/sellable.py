@@ -35,7 +35,9 @@ or a |service|.
 
 # pylint: enable=E1101
 
+import datetime
 from decimal import Decimal
+import time
 
 from kiwi.currency import currency
 from stoqdrivers.enum import TaxType, UnitType
@@ -51,6 +53,7 @@ from stoqlib.domain.events import CategoryCreateEvent, CategoryEditEvent
 from stoqlib.domain.interfaces import IDescribable
 from stoqlib.domain.image import Image
 from stoqlib.exceptions import SellableError, TaxError
+from stoqlib.lib.barcode import parse_barcode
 from stoqlib.lib.defaults import quantize
 from stoqlib.lib.dateutils import localnow
 from stoqlib.lib.parameters import sysparam
@@ -960,3 +963,245 @@ class Sellable(Domain):
 
         query = cls.get_unblocked_sellables_query(store)
         return And(query, Or(*queries))
+
+
+class SellableLookup(object):
+    """Finds |sellables| by their barcode, code or batch number
+
+    This is what is used when the user types something on a barcode entry.
+    The barcode has precedence over the code, which has precedence over
+    the batch number, since there might be a product with a code equal to
+    another product's barcode. The comparisons are case insensitive.
+
+    The barcodes, codes and batch numbers of all sellables can be kept in
+    memory after calling :meth:`.warm`, they will be refreshed from time to
+    time using the transaction entries of the modified sellables and batches.
+    Everything found in memory is checked against the database objects,
+    and anything not found there is queried with a single indexed query.
+    The memory is process wide, use the :obj:`sellable_lookup` instance.
+    """
+
+    (BARCODE,
+     CODE,
+     BATCH_NUMBER) = range(3)
+
+    #: Refresh the warm index at most once in this many seconds
+    REFRESH_INTERVAL = 30
+
+    # Modifications done by transactions that were still open when the index
+    # was refreshed have a te_time prior to the refresh, so look behind
+    # this many seconds to get them on the next one
+    _REFRESH_MARGIN = 600
+
+    _QUERY = """
+        SELECT 0, sellable.id, NULL::uuid
+          FROM sellable
+         WHERE lower(sellable.barcode) = ?
+        UNION ALL
+        SELECT 1, sellable.id, NULL::uuid
+          FROM sellable
+         WHERE lower(sellable.code) = ?
+        UNION ALL
+        SELECT 2, product.sellable_id, storable_batch.id
+          FROM storable_batch
+          JOIN storable ON storable.id = storable_batch.storable_id
+          JOIN product ON product.id = storable.product_id
+         WHERE lower(storable_batch.batch_number) = ?
+         ORDER BY 1"""
+
+    _SELLABLES_QUERY = """
+        SELECT sellable.id, lower(sellable.barcode), lower(sellable.code)
+          FROM sellable
+        %s"""
+
+    _BATCHES_QUERY = """
+        SELECT storable_batch.id, lower(storable_batch.batch_number),
+               product.sellable_id
+          FROM storable_batch
+          JOIN storable ON storable.id = storable_batch.storable_id
+          JOIN product ON product.id = storable.product_id
+        %s"""
+
+    _MODIFIED_CLAUSE = """
+          JOIN transaction_entry ON transaction_entry.id = %s.te_id
+         WHERE transaction_entry.te_time > ?"""
+
+    def __init__(self):
+        # text -> set of (kind, sellable_id, batch_id)
+        self._index = None
+        # sellable_id or batch_id -> the texts it's indexed by
+        self._keys = {}
+        self._last_sync = None
+        self._last_refresh = 0
+
+    #
+    #  Public API
+    #
+
+    def warm(self, store):
+        """Loads the barcodes, codes and batch numbers into memory
+
+        If they are already in memory, they will just be refreshed.
+
+        :param store: a store
+        """
+        if self._index is not None:
+            self.refresh(store)
+            return
+
+        self._index = {}
+        self._keys = {}
+        self._sync(store, None)
+
+    def refresh(self, store, force=False):
+        """Updates the memory with the sellables and batches modified
+        since the last refresh. This does nothing if :meth:`.warm` was
+        not called.
+
+        :param store: a store
+        :param force: if ``False``, only refresh if the last refresh was
+          more than :attr:`.REFRESH_INTERVAL` seconds ago
+        """
+        if self._index is None:
+            return
+        if (not force and
+                time.time() - self._last_refresh < self.REFRESH_INTERVAL):
+            return
+        self._sync(store, self._last_sync)
+
+    def clear(self):
+        """Frees the memory used by :meth:`.warm`"""
+        self._index = None
+        self._keys = {}
+        self._last_sync = None
+
+    def find(self, store, text, accept=None, scale_barcode_format=None):
+        """Find a sellable given a code, barcode or batch number
+
+        :param store: a store
+        :param text: the code, barcode or batch_number
+        :param accept: if not ``None``, a callable that receives a
+          |sellable| and a |batch| (or ``None``) and returns if they can be
+          used. Otherwise the next match will be tried
+        :param scale_barcode_format: if not ``None``, one of the
+          :class:`stoqlib.lib.barcode.BarcodeInfo` options.
+          *text* will be parsed to check if it's a barcode from a scale.
+        :returns: a tuple with the |sellable|, the |batch| and the
+          :class:`stoqlib.lib.barcode.BarcodeInfo` if it was a barcode from
+          a scale. Any of them may be ``None``
+        """
+        barinfo = None
+        if scale_barcode_format is not None:
+            barinfo = parse_barcode(text, scale_barcode_format)
+            if barinfo:
+                text = barinfo.code
+
+        text = text.lower()
+        matches = None
+        if self._index is not None:
+            self.refresh(store)
+            matches = self._index.get(text)
+
+        if matches:
+            result = self._resolve(store, text, matches, accept)
+            if result is not None:
+                return result + (barinfo, )
+
+        # Not found in memory, or the memory was outdated
+        matches = set(store.execute(self._QUERY, (text, text, text)))
+        if self._index is not None:
+            self._set_matches(text, matches)
+        result = self._resolve(store, text, matches, accept)
+        if result is None:
+            return None, None, barinfo
+        return result + (barinfo, )
+
+    #
+    #  Private
+    #
+
+    def _resolve(self, store, text, matches, accept):
+        from stoqlib.domain.product import StorableBatch
+
+        # Returns (sellable, batch) for the first accepted match,
+        # (None, None) if no match was accepted or None if any of
+        # them do not match the database anymore
+        result = (None, None)
+        for kind, sellable_id, batch_id in sorted(matches):
+            sellable = store.get(Sellable, sellable_id)
+            if sellable is None:
+                return None
+
+            batch = None
+            if kind == self.BARCODE:
+                value = sellable.barcode
+            elif kind == self.CODE:
+                value = sellable.code
+            else:
+                batch = store.get(StorableBatch, batch_id)
+                if batch is None:
+                    return None
+                value = batch.batch_number
+            if not value or value.lower() != text:
+                return None
+
+            if result == (None, None) and (accept is None or
+                                           accept(sellable, batch)):
+                result = (sellable, batch)
+        return result
+
+    def _set_matches(self, text, matches):
+        old_matches = self._index.pop(text, set())
+        for kind, sellable_id, batch_id in old_matches:
+            self._keys.get(batch_id or sellable_id, set()).discard(text)
+        for match in matches:
+            self._add(text, match)
+
+    def _add(self, text, match):
+        if not text:
+            return
+        self._index.setdefault(text, set()).add(match)
+        kind, sellable_id, batch_id = match
+        self._keys.setdefault(batch_id or sellable_id, set()).add(text)
+
+    def _remove(self, obj_id):
+        for text in self._keys.pop(obj_id, []):
+            matches = self._index.get(text, set())
+            for match in list(matches):
+                if (match[2] or match[1]) == obj_id:
+                    matches.discard(match)
+            if not matches:
+                self._index.pop(text, None)
+
+    def _sync(self, store, since):
+        now = store.execute(
+            "SELECT STATEMENT_TIMESTAMP()::timestamp").get_one()[0]
+        if since is None:
+            sellables_query = self._SELLABLES_QUERY % ''
+            batches_query = self._BATCHES_QUERY % ''
+            args = ()
+        else:
+            sellables_query = self._SELLABLES_QUERY % (
+                self._MODIFIED_CLAUSE % 'sellable', )
+            batches_query = self._BATCHES_QUERY % (
+                self._MODIFIED_CLAUSE % 'storable_batch', )
+            args = (since, )
+
+        for sellable_id, barcode, code in store.execute(sellables_query,
+                                                        args):
+            self._remove(sellable_id)
+            self._add(barcode, (self.BARCODE, sellable_id, None))
+            self._add(code, (self.CODE, sellable_id, None))
+        for batch_id, batch_number, sellable_id in store.execute(batches_query,
+                                                                 args):
+            self._remove(batch_id)
+            self._add(batch_number,
+                      (self.BATCH_NUMBER, sellable_id, batch_id))
+
+        self._last_sync = now - datetime.timedelta(
+            seconds=self._REFRESH_MARGIN)
+        self._last_refresh = time.time()
+
+
+#: The process wide :class:`SellableLookup`
+sellable_lookup = SellableLookup()
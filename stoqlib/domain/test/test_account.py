@@ -29,7 +29,8 @@ from storm.exceptions import OrderLoopError
 
 from stoqlib.domain.account import (Account, AccountTransaction,
                                     AccountTransactionView,
-                                    BillOption)
+                                    AccountBalanceCheckpoint,
+                                    AccountLedgerView, BillOption)
 from stoqlib.domain.purchase import PurchaseOrder
 from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.domain.interfaces import IDescribable
@@ -445,3 +446,118 @@ class TestAccountTransactionView(DomainTest):
 
         views = AccountTransactionView.get_for_account(a, self.store)
         self.assertEquals(views[0].transaction, t)
+
+
+class TestAccountBalanceCheckpoint(DomainTest):
+    def _get_balance(self, account, month):
+        checkpoint = self.store.get(AccountBalanceCheckpoint,
+                                    (account.id, month))
+        if checkpoint is None:
+            return None
+        self.store.autoreload(checkpoint)
+        return checkpoint.balance
+
+    def test_triggers(self):
+        source = self.create_account()
+        account = self.create_account()
+        january = datetime.datetime(2013, 1, 1)
+        march = datetime.datetime(2013, 3, 1)
+
+        t1 = self.create_account_transaction(account, value=100, source=source)
+        t1.date = datetime.datetime(2013, 3, 10)
+        self.store.flush()
+        self.assertEquals(self._get_balance(account, march), 100)
+        self.assertEquals(self._get_balance(source, march), -100)
+
+        # A transaction on a month before updates the months after it
+        t2 = self.create_account_transaction(account, value=50, source=source)
+        t2.date = datetime.datetime(2013, 1, 20)
+        self.store.flush()
+        self.assertEquals(self._get_balance(account, january), 50)
+        self.assertEquals(self._get_balance(account, march), 150)
+
+        t2.value = 10
+        self.store.flush()
+        self.assertEquals(self._get_balance(account, january), 10)
+        self.assertEquals(self._get_balance(account, march), 110)
+
+        # Moving it to another month keeps the old checkpoint
+        t2.date = datetime.datetime(2013, 3, 1)
+        self.store.flush()
+        self.assertEquals(self._get_balance(account, january), 0)
+        self.assertEquals(self._get_balance(account, march), 110)
+
+        AccountTransaction.delete(t1.id, store=self.store)
+        self.store.flush()
+        self.assertEquals(self._get_balance(account, march), 10)
+        self.assertEquals(self._get_balance(source, march), -10)
+
+    def test_find_inconsistencies(self):
+        account = self.create_account()
+        transaction = self.create_account_transaction(account, value=100)
+        transaction.date = datetime.datetime(2013, 2, 5)
+        self.store.flush()
+        self.assertEquals(
+            AccountBalanceCheckpoint.find_inconsistencies(self.store), [])
+
+        self.store.execute("UPDATE account_balance_checkpoint SET balance = 1 "
+                           "WHERE account_id = '%s'" % (account.id, ))
+        [((account_id, month), expected, found)] = (
+            AccountBalanceCheckpoint.find_inconsistencies(self.store))
+        self.assertEquals(unicode(account_id), account.id)
+        self.assertEquals(month, datetime.datetime(2013, 2, 1))
+        self.assertEquals(expected, 100)
+        self.assertEquals(found, 1)
+
+        AccountBalanceCheckpoint.rebuild(self.store)
+        self.assertEquals(
+            AccountBalanceCheckpoint.find_inconsistencies(self.store), [])
+
+
+class TestAccountLedgerView(DomainTest):
+    def test_find_by_account(self):
+        source = self.create_account()
+        source.description = u"Source"
+        account = self.create_account()
+        for i, (day, value) in enumerate([(datetime.datetime(2013, 1, 5), 100),
+                                          (datetime.datetime(2013, 2, 5), 20),
+                                          (datetime.datetime(2013, 2, 10), 5),
+                                          (datetime.datetime(2013, 3, 1), 1)]):
+            transaction = self.create_account_transaction(
+                account, value=value, source=source)
+            transaction.date = day
+            transaction.description = u"Transaction %d" % (i, )
+        self.store.flush()
+
+        views = list(AccountLedgerView.find_by_account(self.store, account))
+        self.assertEquals([v.value for v in views], [100, 20, 5, 1])
+        self.assertEquals([v.total for v in views], [100, 120, 125, 126])
+        self.assertEquals(views[0].account, u"Source")
+
+        views = list(AccountLedgerView.find_by_account(self.store, source))
+        self.assertEquals([v.value for v in views], [-100, -20, -5, -1])
+        self.assertEquals([v.total for v in views], [-100, -120, -125, -126])
+
+        # The balances are still the ones of the whole account when
+        # the ledger is filtered
+        views = list(AccountLedgerView.find_by_account(
+            self.store, account, start=datetime.date(2013, 2, 7),
+            end=datetime.date(2013, 3, 1)))
+        self.assertEquals([v.total for v in views], [125, 126])
+
+        views = AccountLedgerView.find_by_account(self.store, account).find(
+            AccountLedgerView.description == u"Transaction 1")
+        self.assertEquals([v.total for v in views], [120])
+
+    def test_unadjusted_transaction(self):
+        account = self.create_account()
+        transaction = self.create_account_transaction(account, value=100,
+                                                      incoming=True)
+        transaction.source_account = account
+        self.store.flush()
+
+        views = list(AccountLedgerView.find_by_account(self.store, account))
+        self.assertEquals([v.value for v in views], [-100, 100])
+        self.assertEquals([v.total for v in views], [-100, 0])
+        self.assertEquals(set(v.transaction for v in views), set([transaction]))
+        self.assertNotEquals(views[0].id, views[1].id)
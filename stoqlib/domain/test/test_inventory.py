@@ -89,6 +89,12 @@ class TestInventory(DomainTest):
                          set([storable1.product,
                               storable3.product,
                               storable4.product]))
+        self.assertEqual(
+            set((i.product, i.batch, i.recorded_quantity, i.is_adjusted)
+                for i in items),
+            set([(storable1.product, None, 10, False),
+                 (storable3.product, batch1, 3, False),
+                 (storable4.product, batch2, 0, False)]))
 
         # Use this examples to also test get_inventory_data
         data = list(inventory.get_inventory_data())
@@ -48,7 +48,8 @@ from stoqlib.domain.fiscal import CfopData
 from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.person import (Branch, Client, ClientCategory,
-                                   ClientSalaryHistory, Company,
+                                   ClientCreditLedger, ClientSalaryHistory,
+                                   Company,
                                    Employee, EmployeeRole,
                                    EmployeeRoleHistory, Individual,
                                    LoginUser, Person, SalesPerson, Supplier,
@@ -1141,6 +1142,81 @@ class TestClientSalaryHistory(DomainTest):
         self.assertEquals(last_salary_history.new_salary, 20)
 
 
+class TestClientCreditLedger(DomainTest):
+    def _get_ledger(self, person):
+        ledger = self.store.get(ClientCreditLedger, person.id)
+        self.store.autoreload(ledger)
+        return (ledger.credit_received, ledger.credit_spent,
+                ledger.store_credit_debit)
+
+    def test_triggers(self):
+        credit = self.store.find(PaymentMethod, method_name=u'credit').one()
+        client = self.create_client()
+        group = self.create_payment_group(payer=client.person)
+
+        received = self.create_payment(payment_type=Payment.TYPE_OUT,
+                                       value=100, method=credit, group=group)
+        received.set_pending()
+        self.store.flush()
+        self.assertIsNone(self.store.get(ClientCreditLedger, client.person.id))
+
+        received.pay()
+        spent = self.create_payment(payment_type=Payment.TYPE_IN,
+                                    value=30, method=credit, group=group)
+        spent.set_pending()
+        spent.pay()
+        self.store.flush()
+        self.assertEquals(self._get_ledger(client.person), (100, 30, 0))
+        self.assertEquals(client.credit_account_balance, 70)
+
+        store_credit = self.store.find(PaymentMethod,
+                                       method_name=u'store_credit').one()
+        debit = self.create_payment(payment_type=Payment.TYPE_IN, value=20,
+                                    method=store_credit, group=group)
+        debit.set_pending()
+        client.credit_limit = 50
+        self.store.flush()
+        self.assertEquals(self._get_ledger(client.person), (100, 30, 20))
+        self.assertEquals(client.remaining_store_credit, 30)
+
+        debit.pay()
+        spent.cancel()
+        self.store.flush()
+        self.assertEquals(self._get_ledger(client.person), (100, 0, 0))
+        self.assertEquals(client.credit_account_balance, 100)
+        self.assertEquals(client.remaining_store_credit, 50)
+
+        other = self.create_client()
+        group.payer = other.person
+        self.store.flush()
+        self.assertEquals(self._get_ledger(client.person), (0, 0, 0))
+        self.assertEquals(self._get_ledger(other.person), (100, 0, 0))
+
+    def test_find_inconsistencies(self):
+        credit = self.store.find(PaymentMethod, method_name=u'credit').one()
+        client = self.create_client()
+        payment = self.create_payment(
+            payment_type=Payment.TYPE_OUT, value=100, method=credit,
+            group=self.create_payment_group(payer=client.person))
+        payment.set_pending()
+        payment.pay()
+        self.store.flush()
+        self.assertEquals(
+            ClientCreditLedger.find_inconsistencies(self.store), [])
+
+        self.store.execute("UPDATE client_credit_ledger SET credit_spent = 1 "
+                           "WHERE person_id = '%s'" % (client.person.id, ))
+        [(person_id, expected, found)] = (
+            ClientCreditLedger.find_inconsistencies(self.store))
+        self.assertEquals(unicode(person_id), client.person.id)
+        self.assertEquals(expected, (100, 0, 0))
+        self.assertEquals(found, (100, 1, 0))
+
+        ClientCreditLedger.rebuild(self.store)
+        self.assertEquals(
+            ClientCreditLedger.find_inconsistencies(self.store), [])
+
+
 class TestClientView(DomainTest):
     def test_get_active_clients(self):
         client1 = self.create_client()
@@ -34,7 +34,7 @@ from stoqlib.domain.events import (ProductCreateEvent, ProductEditEvent,
 from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.payment import Payment
 from stoqlib.domain.product import (ProductSupplierInfo, Product,
-                                    ProductStockItem,
+                                    ProductStockItem, ProductStockSummary,
                                     ProductHistory, ProductComponent,
                                     ProductQualityTest, Storable,
                                     StorableBatch, StorableBatchView,
@@ -1527,3 +1527,60 @@ class TestStorableBatchView(DomainTest):
                  StorableBatchView.find_available_by_storable(
                      self.store, storable, branch=branch2)]),
             set([(u'123', 20)]))
+
+
+class TestProductStockSummary(DomainTest):
+    def _get_summary(self, storable, branch):
+        self.store.flush()
+        summary = self.store.get(ProductStockSummary, (storable.id, branch.id))
+        self.store.autoreload(summary)
+        return summary
+
+    def test_triggers(self):
+        branch = get_current_branch(self.store)
+        storable = self.create_storable()
+
+        summary = self._get_summary(storable, branch)
+        self.assertEquals(summary.stock, 0)
+        self.assertEquals(summary.total_stock_cost, 0)
+
+        storable.increase_stock(2, branch,
+                                StockTransactionHistory.TYPE_INITIAL,
+                                None, unit_cost=10)
+        summary = self._get_summary(storable, branch)
+        self.assertEquals(summary.stock, 2)
+        self.assertEquals(summary.total_stock_cost, 20)
+
+        storable.decrease_stock(1, branch,
+                                StockTransactionHistory.TYPE_INITIAL, None)
+        summary = self._get_summary(storable, branch)
+        self.assertEquals(summary.stock, 1)
+        self.assertEquals(summary.total_stock_cost, 10)
+
+        # A new branch has an empty summary for the existing storables
+        branch2 = self.create_branch()
+        summary = self._get_summary(storable, branch2)
+        self.assertEquals(summary.stock, 0)
+
+    def test_find_inconsistencies(self):
+        branch = get_current_branch(self.store)
+        storable = self.create_storable()
+        storable.increase_stock(2, branch,
+                                StockTransactionHistory.TYPE_INITIAL,
+                                None, unit_cost=10)
+        self.store.flush()
+        self.assertEquals(
+            ProductStockSummary.find_inconsistencies(self.store), [])
+
+        self.store.execute(
+            "UPDATE product_stock_summary SET stock = 5 "
+            "WHERE storable_id = '%s' AND branch_id = '%s'" % (
+                storable.id, branch.id))
+        [(key, expected, summarized)] = (
+            ProductStockSummary.find_inconsistencies(self.store))
+        self.assertEquals(expected, (2, 20))
+        self.assertEquals(summarized, (5, 20))
+
+        ProductStockSummary.rebuild(self.store)
+        self.assertEquals(
+            ProductStockSummary.find_inconsistencies(self.store), [])
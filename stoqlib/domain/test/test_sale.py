@@ -35,6 +35,8 @@ from stoqlib.api import api
 from stoqlib.database.runtime import get_current_branch
 from stoqlib.domain.commission import CommissionSource, Commission
 from stoqlib.domain.event import Event
+from stoqlib.domain.events import (ProductStockBulkUpdateEvent,
+                                   ProductStockUpdateEvent)
 from stoqlib.domain.fiscal import FiscalBookEntry
 from stoqlib.domain.payment.method import PaymentMethod
 from stoqlib.domain.payment.payment import Payment, PaymentChangeHistory
@@ -43,7 +45,7 @@ from stoqlib.domain.returnedsale import ReturnedSaleItem
 from stoqlib.domain.sale import (Sale, SalePaymentMethodView,
                                  ReturnedSaleItemsView, SaleItem,
                                  SaleView, SalesPersonSalesView,
-                                 ClientsWithSaleView)
+                                 ClientsWithSaleView, SaleSummary)
 from stoqlib.domain.sellable import Sellable
 from stoqlib.domain.till import TillEntry
 from stoqlib.domain.test.domaintest import DomainTest
@@ -505,6 +507,54 @@ class TestSale(DomainTest):
         self.assertEqual(storable3.get_balance_for_branch(branch),
                          stock3 - 10)
 
+    def test_confirm_stock_update_events(self):
+        sale = self.create_sale()
+        branch = sale.branch
+        sellable1 = self.add_product(sale, quantity=2)
+        sellable2 = self.add_product(sale, quantity=3)
+        sale.order()
+        self.add_payments(sale)
+        stock1 = sellable1.product_storable.get_balance_for_branch(branch)
+        stock2 = sellable2.product_storable.get_balance_for_branch(branch)
+
+        calls = []
+        bulk_calls = []
+
+        def callback(product, branch, old_quantity, new_quantity):
+            calls.append(product)
+
+        def bulk_callback(branch, updates):
+            bulk_calls.append((branch, updates))
+
+        ProductStockUpdateEvent.connect(callback)
+        ProductStockBulkUpdateEvent.connect(bulk_callback)
+        try:
+            sale.confirm()
+        finally:
+            ProductStockUpdateEvent.disconnect(callback)
+            ProductStockBulkUpdateEvent.disconnect(bulk_callback)
+
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(len(bulk_calls), 1)
+        self.assertEqual(bulk_calls[0][0], branch)
+        self.assertEqual(
+            sorted(bulk_calls[0][1]),
+            sorted([(sellable1.product, stock1, stock1 - 2),
+                    (sellable2.product, stock2, stock2 - 3)]))
+
+    def test_confirm_without_stock(self):
+        sale = self.create_sale()
+        sellable = self.add_product(sale, quantity=2)
+        sale.order()
+        self.add_payments(sale)
+        storable = sellable.product_storable
+        storable.decrease_stock(storable.get_balance_for_branch(sale.branch),
+                                sale.branch,
+                                StockTransactionHistory.TYPE_INITIAL, None)
+
+        with self.assertRaises(SellError):
+            sale.confirm()
+
     def test_pay(self):
         sale = self.create_sale()
         self.failIf(sale.can_set_paid())
@@ -2423,6 +2473,64 @@ class TestSaleView(DomainTest):
         self.assertEquals(sale.get_first_sale_comment(), u'Foo bar')
 
 
+class TestSaleSummary(DomainTest):
+    def test_triggers(self):
+        item = self.create_sale_item(quantity=2)
+        item.ipi_info.v_ipi = 10
+        sale = item.sale
+        self.store.flush()
+
+        summary = self.store.get(SaleSummary, sale.id)
+        self.store.autoreload(summary)
+        self.assertEquals(summary.subtotal, 200)
+        self.assertEquals(summary.total_quantity, 2)
+        self.assertEquals(summary.v_ipi, 10)
+
+        self.create_sale_item(sale=sale)
+        item.ipi_info.v_ipi = 5
+        item.quantity = 3
+        self.store.flush()
+        self.store.autoreload(summary)
+        self.assertEquals(summary.subtotal, 400)
+        self.assertEquals(summary.total_quantity, 4)
+        self.assertEquals(summary.v_ipi, 5)
+
+        sale.remove_item(item)
+        self.store.flush()
+        self.store.autoreload(summary)
+        self.assertEquals(summary.subtotal, 100)
+        self.assertEquals(summary.total_quantity, 1)
+        self.assertEquals(summary.v_ipi, 0)
+
+    def test_subtotal_not_rounded(self):
+        item = self.create_sale_item(quantity=Decimal('1.333'))
+        item.price = Decimal('10.01')
+        self.store.flush()
+
+        # The subtotal keeps all the decimal places of price * quantity,
+        # like the aggregate over sale_item used to
+        summary = self.store.get(SaleSummary, item.sale.id)
+        self.store.autoreload(summary)
+        self.assertEquals(summary.subtotal, Decimal('13.34333'))
+        self.assertEquals(SaleSummary.find_inconsistencies(self.store), [])
+
+    def test_find_inconsistencies(self):
+        item = self.create_sale_item()
+        self.store.flush()
+        self.assertEquals(SaleSummary.find_inconsistencies(self.store), [])
+
+        self.store.execute("UPDATE sale_summary SET subtotal = 1 "
+                           "WHERE sale_id = '%s'" % (item.sale.id, ))
+        [(sale_id, expected, summarized)] = SaleSummary.find_inconsistencies(
+            self.store)
+        self.assertEquals(unicode(sale_id), item.sale.id)
+        self.assertEquals(expected, (100, 1, 0))
+        self.assertEquals(summarized, (1, 1, 0))
+
+        SaleSummary.rebuild(self.store)
+        self.assertEquals(SaleSummary.find_inconsistencies(self.store), [])
+
+
 class TestSalesPersonSalesView(DomainTest):
     def test_find_by_date(self):
         sale = self.create_sale()
@@ -36,7 +36,8 @@ from stoqlib.domain.sellable import (Sellable,
                                      SellableCategory,
                                      SellableUnit,
                                      SellableTaxConstant,
-                                     ClientCategoryPrice)
+                                     ClientCategoryPrice,
+                                     SellableLookup)
 from stoqlib.domain.taxes import ProductTaxTemplate, ProductIcmsTemplate
 from stoqlib.domain.test.domaintest import DomainTest
 from stoqlib.domain.views import (ProductFullStockView,
@@ -803,3 +804,47 @@ class TestSellable(DomainTest):
                                        "Tax Class.\n"
                                        "If you don't know what this means, contact "
                                        "the system administrator."))
+
+
+class TestSellableLookup(DomainTest):
+    def setUp(self):
+        super(TestSellableLookup, self).setUp()
+        self.lookup = SellableLookup()
+
+    def _find(self, text, **kwargs):
+        return self.lookup.find(self.store, text, **kwargs)
+
+    def _test_find(self):
+        sellable = self.create_sellable()
+        sellable.barcode = u'BarCode123'
+        sellable.code = u'Code123'
+        other = self.create_sellable()
+        other.code = u'barcode123'
+        storable = self.create_storable(product=sellable.product)
+        batch = self.create_storable_batch(storable, batch_number=u'Batch123')
+        self.store.flush()
+        self.lookup.refresh(self.store, force=True)
+
+        self.assertEqual(self._find(u'barcode123'), (sellable, None, None))
+        self.assertEqual(self._find(u'CODE123'), (sellable, None, None))
+        self.assertEqual(self._find(u'batch123'), (sellable, batch, None))
+        self.assertEqual(self._find(u'nothing'), (None, None, None))
+
+        # The barcode has precedence, unless it is not accepted
+        self.assertEqual(
+            self._find(u'barcode123', accept=lambda s, b: s is not sellable),
+            (other, None, None))
+
+        # Changes are seen even if the memory was not refreshed yet
+        sellable.barcode = u'NewBarcode'
+        self.store.flush()
+        self.assertEqual(self._find(u'barcode123'), (other, None, None))
+        self.assertEqual(self._find(u'newbarcode'), (sellable, None, None))
+
+    def test_find(self):
+        self._test_find()
+
+    def test_find_warm(self):
+        self.lookup.warm(self.store)
+        self._test_find()
+        self.lookup.clear()
@@ -314,6 +314,11 @@ class TestProductFullStockView(DomainTest):
         self.failUnless(list(results))
         self.assertEquals(len(list(results)), 1)
 
+        # The viewable queried is created only once
+        first = ProductFullStockView.find_by_branch(self.store, branch)
+        second = ProductFullStockView.find_by_branch(self.store, branch)
+        self.assertIs(first._viewable, second._viewable)
+
     def test_post_search_callback(self):
         self.clean_domain([StockTransactionHistory, ProductSupplierInfo, ProductStockItem,
                            Storable, Product])
@@ -31,7 +31,7 @@ from storm.info import ClassAlias
 
 from stoqlib.database.expr import (Case, Distinct, Field, NullIf,
                                    StatementTimestamp, Concat)
-from stoqlib.database.viewable import Viewable
+from stoqlib.database.viewable import Deferred, Viewable
 from stoqlib.domain.account import Account, AccountTransaction
 from stoqlib.domain.address import Address
 from stoqlib.domain.commission import CommissionSource
@@ -42,6 +42,7 @@ from stoqlib.domain.person import (Person, Supplier, Company, LoginUser,
                                    SalesPerson)
 from stoqlib.domain.product import (Product,
                                     ProductStockItem,
+                                    ProductStockSummary,
                                     ProductHistory,
                                     ProductManufacturer,
                                     ProductSupplierInfo,
@@ -75,21 +76,10 @@ _StockSummary = Alias(Select(
     tables=[ProductStockItem],
     group_by=[ProductStockItem.storable_id]), '_stock_summary')
 
-# This subselect will be used to filter by branch, so it should include all
-# possible (branch, storable) combinations so that all storables appear in the
-# results
-_StockBranchSummary = Alias(Select(
-    columns=[Alias(Storable.id, 'storable_id'),
-             Alias(Branch.id, 'branch_id'),
-             Alias(Sum(ProductStockItem.quantity), 'stock'),
-             Alias(Sum(ProductStockItem.quantity *
-                       ProductStockItem.stock_cost), 'total_stock_cost')],
-    tables=[Storable,
-            # This is equivalent to a cross join
-            Join(Branch, And(True)),
-            LeftJoin(ProductStockItem, And(ProductStockItem.branch_id == Branch.id,
-                                           ProductStockItem.storable_id == Storable.id))],
-    group_by=[Storable.id, Branch.id]), '_stock_summary')
+# This will be used to filter by branch, so it includes all possible
+# (branch, storable) combinations so that all storables appear in the
+# results. It is kept up to date by triggers, see ProductStockSummary
+_StockBranchSummary = ClassAlias(ProductStockSummary, '_stock_summary')
 
 _price_search = Case(condition=And(StatementTimestamp() >= Sellable.on_sale_start_date,
                                    StatementTimestamp() <= Sellable.on_sale_end_date),
@@ -114,8 +104,8 @@ class ProductFullStockView(Viewable):
     :cvar stock: the stock of the product
      """
 
-    sellable = Sellable
-    product = Product
+    sellable = Deferred(Sellable)
+    product = Deferred(Product)
 
     # Sellable
     id = Sellable.id
@@ -188,19 +178,21 @@ class ProductFullStockView(Viewable):
 
         # Highjack the class being queried, since we need to add the branch
         # on the ProductStockItem subselect to filter it later
-        class HighjackedViewable(cls):
-            tables = cls.tables[:]
-            tables[3] = LeftJoin(_StockBranchSummary,
-                                 Field('_stock_summary',
-                                       'storable_id') == Storable.id)
+        def create():
+            class HighjackedViewable(cls):
+                tables = cls.tables[:]
+                tables[3] = LeftJoin(_StockBranchSummary,
+                                     Field('_stock_summary',
+                                           'storable_id') == Storable.id)
 
-        HighjackedViewable.__name__ = "Highjacked%s" % cls.__name__
+            HighjackedViewable.__name__ = "Highjacked%s" % cls.__name__
+            return HighjackedViewable
 
         # Also show products that were never purchased.
         query = Or(Field('_stock_summary', 'branch_id') == branch.id,
                    Eq(Field('_stock_summary', 'branch_id'), None))
 
-        return store.find(HighjackedViewable, query)
+        return store.find(cls.derive_viewable('branch', create), query)
 
     def get_product_and_category_description(self):
         """Returns the product and the category description in one string.
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""CSV exporter"""
+
+import csv
+import datetime
+import decimal
+
+from stoqlib.exporters.streamexporter import StreamExporter
+
+
+class CSVExporter(StreamExporter):
+    """Exports to a comma separated values file, encoded in utf-8
+
+    The rows are written as they are added, see :class:`StreamExporter`.
+    """
+
+    suffix = '.csv'
+    mime_type = 'text/csv'
+
+    def start(self, fp):
+        self._writer = csv.writer(fp)
+
+    def write_row(self, fp, values, header=False):
+        self._writer.writerow([self._format(v) for v in values])
+
+    def _format(self, value):
+        if value is None:
+            return ''
+        elif isinstance(value, unicode):
+            return value.encode('utf-8')
+        elif isinstance(value, datetime.datetime):
+            return value.strftime('%Y-%m-%d %H:%M:%S')
+        elif isinstance(value, datetime.date):
+            return value.strftime('%Y-%m-%d')
+        elif isinstance(value, decimal.Decimal):
+            # currency formats itself with the currency symbol
+            return decimal.Decimal(value)
+        return value
@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""Base class for the exporters that write the rows as they come
+
+:class:`StreamExporter` subclasses write each row to a temporary file as
+soon as it is added, so that exporting a million rows from a result set
+uses as much memory as exporting a hundred::
+
+    exporter = CSVExporter()
+    exporter.add_from_results(search.columns, store.find(SoldItemView))
+    temporary = exporter.save('sold-items')
+
+:class:`ExportThread` does the same on a thread with a store of its own.
+"""
+
+import datetime
+import decimal
+import logging
+import os
+import tempfile
+import threading
+
+from kiwi.accessor import kgetattr
+from kiwi.currency import currency
+
+from stoqlib.database.runtime import DEFAULT_ITERSIZE
+
+log = logging.getLogger(__name__)
+
+#: Types that are exported as they are, instead of formatted by the column
+NUMERIC_TYPES = (int, long, float, decimal.Decimal, currency)
+DATE_TYPES = (datetime.date, datetime.datetime)
+
+
+def get_column_values(columns, obj):
+    """Get the values of the columns of an object, as they should be exported
+
+    Numbers and dates are kept as they are, so the spreadsheet can
+    sum and format them. The other values are formatted the same way
+    the column shows them.
+
+    :param columns: a list of kiwi columns
+    :param obj: the object, usually a viewable
+    :returns: a list of values
+    """
+    values = []
+    for column in columns:
+        value = kgetattr(obj, column.attribute, None)
+        if value is None:
+            values.append(None)
+        elif (column.data_type in NUMERIC_TYPES or
+              column.data_type in DATE_TYPES or
+              column.data_type is bool):
+            values.append(value)
+        else:
+            values.append(column.as_string(value, obj))
+    return values
+
+
+def iter_results(results, itersize=DEFAULT_ITERSIZE):
+    """Iterate over a result set without keeping it in memory
+
+    Viewables are streamed from a server side cursor,
+    see :meth:`StoqlibResultSet.fast_iter`.
+
+    :param results: a result set or any other iterable
+    :param itersize: how many rows are fetched at a time
+    :returns: an iterator for the objects
+    """
+    if hasattr(results, '_viewable'):
+        return results.fast_iter(itersize=itersize)
+    return iter(results)
+
+
+class StreamExporter(object):
+    """Base class for the exporters
+
+    Subclasses must implement :meth:`.write_row` and can implement
+    :meth:`.start` and :meth:`.finish`, which are called with the
+    temporary file open before the first row and before it's saved, and
+    :meth:`.package`, to create the exported file from the temporary one.
+
+    :cvar suffix: the suffix of the exported files
+    :cvar mime_type: the mime type of the exported files
+    """
+
+    suffix = None
+    mime_type = None
+
+    def __init__(self, name=None):
+        self.name = name
+        self.n_rows = 0
+        self._headers = None
+        self._column_types = None
+        self._started = False
+        self._fd, self.filename = tempfile.mkstemp(suffix=self.suffix)
+        self._fp = os.fdopen(self._fd, 'wb')
+
+    #
+    #  Hooks
+    #
+
+    def start(self, fp):
+        """Called before the first row is written
+
+        :param fp: the temporary file
+        """
+
+    def write_row(self, fp, values, header=False):
+        """Write a row
+
+        :param fp: the temporary file
+        :param values: the values of the row
+        :param header: if the row is the header
+        """
+        raise NotImplementedError
+
+    def finish(self, fp):
+        """Called after all the rows were written
+
+        :param fp: the temporary file
+        """
+
+    def package(self, temporary, filename):
+        """Creates the exported file
+
+        :param temporary: the name of the temporary file, already closed
+        :param filename: the name of the exported file
+        """
+        os.rename(temporary, filename)
+
+    #
+    #  Public API
+    #
+
+    def set_column_headers(self, headers):
+        self._headers = headers
+
+    def set_column_types(self, column_types):
+        self._column_types = column_types
+
+    def get_column_type(self, i):
+        if self._column_types is None:
+            return None
+        return self._column_types[i]
+
+    def add_row(self, values):
+        """Writes a row
+
+        :param values: the values of the row
+        """
+        if not self._started:
+            self._start()
+        self.write_row(self._fp, values)
+        self.n_rows += 1
+
+    def add_cells(self, cells):
+        """Writes many rows
+
+        :param cells: an iterable of lists of values
+        """
+        for values in cells:
+            self.add_row(values)
+
+    def add_from_object_list(self, objectlist):
+        columns = objectlist.get_visible_columns()
+        self.set_column_types([c.data_type for c in columns])
+        self.set_column_headers([
+            getattr(c, 'long_title', None) or c.title for c in columns])
+        self.add_cells(objectlist.get_cell_contents())
+
+    def add_from_results(self, columns, results, progress=None,
+                         cancelled=None):
+        """Writes the rows of a result set
+
+        The rows are read from the database as they are written, the
+        objects in *results* are never all in memory.
+
+        :param columns: the columns to export, the invisible ones are skipped
+        :param results: a result set
+        :param progress: if not ``None``, a callable called with the
+          number of rows written after every :obj:`DEFAULT_ITERSIZE` rows
+        :param cancelled: if not ``None``, a callable returning ``True``
+          if the export should be interrupted
+        """
+        columns = [c for c in columns if c.visible]
+        self.set_column_types([c.data_type for c in columns])
+        self.set_column_headers([
+            getattr(c, 'long_title', None) or c.title for c in columns])
+        if not self._started:
+            self._start()
+
+        for obj in iter_results(results):
+            self.add_row(get_column_values(columns, obj))
+            if self.n_rows % DEFAULT_ITERSIZE:
+                continue
+            if progress is not None:
+                progress(self.n_rows)
+            if cancelled is not None and cancelled():
+                break
+
+        if progress is not None:
+            progress(self.n_rows)
+
+    def save(self, prefix=''):
+        """Finishes the export
+
+        :param prefix: the prefix of the file name
+        :returns: the temporary file, open for reading
+        """
+        if not self._started:
+            self._start()
+        self.finish(self._fp)
+        self._fp.close()
+
+        if prefix:
+            prefix = 'Stoq-%s-' % (prefix, )
+        else:
+            prefix = 'Stoq-'
+        filename = tempfile.mktemp(prefix=prefix, suffix=self.suffix)
+        self.package(self.filename, filename)
+        self.filename = filename
+        return open(filename, 'rb')
+
+    def discard(self):
+        """Removes the temporary file of an unfinished export"""
+        self._fp.close()
+        os.unlink(self.filename)
+
+    #
+    #  Private
+    #
+
+    def _start(self):
+        self._started = True
+        self.start(self._fp)
+        if self._headers:
+            self.write_row(self._fp, self._headers, header=True)
+
+
+class ExportThread(threading.Thread):
+    """Exports a search on a thread
+
+    The result set must be built before the thread starts, on the main
+    thread, since building it may read the values of the search filters.
+    It must be built on a store that is only used by the thread from
+    then on, which is closed when the export finishes::
+
+        store = new_store()
+        results = executer.search(states, store=store)
+        ExportThread(exporter, columns, store, results).start()
+
+    :param exporter: a :class:`StreamExporter`
+    :param columns: the columns to export
+    :param store: the store of *results*, owned by the thread
+    :param results: the result set to export
+    :param progress: a callable called with the number of rows exported,
+      from the thread
+    :param prefix: the prefix of the exported file name
+    """
+
+    def __init__(self, exporter, columns, store, results, progress=None,
+                 prefix=''):
+        threading.Thread.__init__(self, name='ExportThread')
+        self.daemon = True
+        self.exporter = exporter
+        self.columns = columns
+        self.store = store
+        self.results = results
+        self.progress = progress
+        self.prefix = prefix
+        #: the exported file, once the thread finished
+        self.temporary = None
+        #: the exception raised while exporting, if any
+        self.error = None
+        self._cancelled = threading.Event()
+
+    def cancel(self):
+        """Interrupts the export"""
+        self._cancelled.set()
+
+    def run(self):
+        try:
+            self.exporter.add_from_results(
+                self.columns, self.results, progress=self.progress,
+                cancelled=self._cancelled.is_set)
+            if self._cancelled.is_set():
+                self.exporter.discard()
+            else:
+                self.temporary = self.exporter.save(self.prefix)
+        except Exception as e:
+            log.exception('Could not export %r' % (self.exporter, ))
+            self.error = e
+        finally:
+            self.store.rollback(close=True)
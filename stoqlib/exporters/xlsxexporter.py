@@ -0,0 +1,212 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""XLSX exporter
+
+Office Open XML spreadsheets, unlike the xls files written by
+:class:`stoqlib.exporters.xlsexporter.XLSExporter`, are not limited
+to 65536 rows. The worksheet is written directly as xml, with the
+strings inline, so that no row needs to be kept in memory.
+"""
+
+import datetime
+import decimal
+import os
+import re
+import zipfile
+from xml.sax.saxutils import escape, quoteattr
+
+from stoqlib.exporters.streamexporter import StreamExporter, NUMERIC_TYPES
+from stoqlib.exporters.xlsutils import get_date_format, get_number_format
+from stoqlib.lib.translation import stoqlib_gettext
+
+_ = stoqlib_gettext
+
+# Characters that are not allowed in xml documents
+_INVALID_XML_RE = re.compile(ur'[\x00-\x08\x0b\x0c\x0e-\x1f]')
+_EPOCH = datetime.datetime(1899, 12, 30)
+
+(_STYLE_GENERAL,
+ _STYLE_HEADER,
+ _STYLE_DATE,
+ _STYLE_DATETIME,
+ _STYLE_NUMBER) = range(5)
+
+_CONTENT_TYPES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">
+<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>
+<Default Extension="xml" ContentType="application/xml"/>
+<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>
+<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>
+<Override PartName="/xl/styles.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>
+</Types>"""
+
+_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>
+</Relationships>"""
+
+_WORKBOOK = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">
+<sheets><sheet name=%s sheetId="1" r:id="rId1"/></sheets>
+</workbook>"""
+
+_WORKBOOK_RELS = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">
+<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>
+<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" Target="styles.xml"/>
+</Relationships>"""
+
+# The cellXfs must be in the same order as the _STYLE_* constants
+_STYLES = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<numFmts count="3">
+<numFmt numFmtId="164" formatCode=%(date)s/>
+<numFmt numFmtId="165" formatCode=%(datetime)s/>
+<numFmt numFmtId="166" formatCode=%(number)s/>
+</numFmts>
+<fonts count="2"><font><sz val="10"/><name val="Arial"/></font><font><b/><sz val="10"/><name val="Arial"/></font></fonts>
+<fills count="2"><fill><patternFill patternType="none"/></fill><fill><patternFill patternType="gray125"/></fill></fills>
+<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>
+<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>
+<cellXfs count="5">
+<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>
+<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>
+<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+<xf numFmtId="166" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>
+</cellXfs>
+</styleSheet>"""
+
+_SHEET_START = """<?xml version="1.0" encoding="UTF-8" standalone="yes"?>
+<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">
+<sheetData>
+"""
+
+_SHEET_END = """</sheetData>
+</worksheet>
+"""
+
+
+def _get_column_name(i):
+    # 0 -> A, 25 -> Z, 26 -> AA
+    name = ''
+    i += 1
+    while i:
+        i, remainder = divmod(i - 1, 26)
+        name = chr(ord('A') + remainder) + name
+    return name
+
+
+class XLSXExporter(StreamExporter):
+    """Exports to an Office Open XML spreadsheet
+
+    The rows are written as they are added, see :class:`StreamExporter`.
+    """
+
+    suffix = '.xlsx'
+    mime_type = ('application/vnd.openxmlformats-officedocument.'
+                 'spreadsheetml.sheet')
+
+    def start(self, fp):
+        self._column_names = []
+        fp.write(_SHEET_START)
+
+    def write_row(self, fp, values, header=False):
+        row = self.n_rows + 1
+        if self._headers and not header:
+            row += 1
+        while len(self._column_names) < len(values):
+            self._column_names.append(_get_column_name(len(self._column_names)))
+
+        cells = []
+        for i, value in enumerate(values):
+            if value is None or value == '':
+                continue
+            ref = '%s%d' % (self._column_names[i], row)
+            if header:
+                cells.append(self._get_string_cell(ref, value, _STYLE_HEADER))
+            else:
+                cells.append(self._get_cell(ref, value, i))
+        fp.write('<row r="%d">%s</row>\n' % (row, ''.join(cells)))
+
+    def finish(self, fp):
+        fp.write(_SHEET_END)
+
+    def package(self, temporary, filename):
+        name = (self.name or _('Stoq sheet'))[:31]
+        if isinstance(name, unicode):
+            name = name.encode('utf-8')
+        styles = _STYLES % dict(
+            date=quoteattr(get_date_format()),
+            datetime=quoteattr(get_date_format() + ' hh:mm'),
+            number=quoteattr(get_number_format()))
+
+        zf = zipfile.ZipFile(filename, 'w', zipfile.ZIP_DEFLATED)
+        try:
+            zf.writestr('[Content_Types].xml', _CONTENT_TYPES)
+            zf.writestr('_rels/.rels', _RELS)
+            zf.writestr('xl/workbook.xml', _WORKBOOK % (quoteattr(name), ))
+            zf.writestr('xl/_rels/workbook.xml.rels', _WORKBOOK_RELS)
+            zf.writestr('xl/styles.xml', styles)
+            # The sheet is copied in chunks, it's never all in memory
+            zf.write(temporary, 'xl/worksheets/sheet1.xml')
+        finally:
+            zf.close()
+        os.unlink(temporary)
+
+    #
+    #  Private
+    #
+
+    def _get_cell(self, ref, value, i):
+        if isinstance(value, bool):
+            return '<c r="%s" t="b"><v>%d</v></c>' % (ref, value)
+        elif isinstance(value, datetime.datetime):
+            delta = value - _EPOCH
+            return '<c r="%s" s="%d"><v>%r</v></c>' % (
+                ref, _STYLE_DATETIME,
+                delta.days + delta.seconds / 86400.0)
+        elif isinstance(value, datetime.date):
+            return '<c r="%s" s="%d"><v>%d</v></c>' % (
+                ref, _STYLE_DATE,
+                (value - _EPOCH.date()).days)
+        elif isinstance(value, NUMERIC_TYPES):
+            if isinstance(value, (int, long)):
+                style = _STYLE_GENERAL
+            else:
+                style = _STYLE_NUMBER
+            if isinstance(value, decimal.Decimal):
+                # currency formats itself with the currency symbol
+                value = decimal.Decimal(value)
+            return '<c r="%s" s="%d"><v>%s</v></c>' % (ref, style, value)
+        return self._get_string_cell(ref, value, _STYLE_GENERAL)
+
+    def _get_string_cell(self, ref, value, style):
+        if isinstance(value, str):
+            value = unicode(value, 'utf-8')
+        elif not isinstance(value, unicode):
+            value = unicode(value)
+        value = escape(_INVALID_XML_RE.sub(u'', value)).encode('utf-8')
+        return '<c r="%s" s="%d" t="inlineStr"><is><t>%s</t></is></c>' % (
+            ref, style, value)
@@ -25,12 +25,16 @@
 
 
 import gio
+import glib
 import gtk
 
 from stoqlib.api import api
 
+from stoqlib.exporters.streamexporter import ExportThread
 from stoqlib.exporters.xlsexporter import XLSExporter
-from stoqlib.lib.message import yesno
+from stoqlib.exporters.xlsxexporter import XLSXExporter
+from stoqlib.gui.dialogs.progressdialog import ProgressDialog
+from stoqlib.lib.message import warning, yesno
 from stoqlib.lib.translation import stoqlib_gettext
 
 _ = stoqlib_gettext
@@ -47,8 +51,56 @@ class SpreadSheetExporter:
         temporary = xls.save(filename_prefix)
         self.export_temporary(temporary)
 
-    def export_temporary(self, temporary):
-        mime_type = 'application/vnd.ms-excel'
+    def export_search(self, search, name, filename_prefix,
+                      exporter_class=XLSXExporter):
+        """Exports the results of a search without loading them
+
+        The last search is executed again on a thread and its rows are
+        written to the spreadsheet as they come from the database, while
+        a dialog shows how many rows were exported.
+
+        :param search: a :class:`stoqlib.gui.search.searchslave.SearchSlave`
+        :param name: the name of the sheet
+        :param filename_prefix: the prefix of the file name
+        :param exporter_class: a
+          :class:`stoqlib.exporters.streamexporter.StreamExporter` subclass
+        """
+        executer = search.get_query_executer()
+        # The query callbacks read the filters, so the query is built
+        # here, on the main thread, with the store the thread will use
+        store = api.new_store()
+        results = executer.search(search.get_last_states(), store=store)
+        exporter = exporter_class(name)
+        dialog = ProgressDialog(_('Exporting rows'), pulse=True)
+
+        def progress(n_rows):
+            glib.idle_add(dialog.set_label,
+                          _('Exported %d rows') % (n_rows, ))
+
+        thread = ExportThread(
+            exporter, search.result_view.get_columns(), store, results,
+            progress=progress, prefix=filename_prefix)
+        dialog.connect('cancel', lambda dialog: thread.cancel())
+
+        def wait():
+            if thread.is_alive():
+                return True
+            dialog.stop()
+            if thread.error is not None:
+                warning(_('Could not export the spreadsheet'),
+                        str(thread.error))
+            elif thread.temporary is not None:
+                self.export_temporary(thread.temporary,
+                                      mime_type=exporter.mime_type,
+                                      suffix=exporter.suffix)
+            return False
+
+        dialog.start()
+        thread.start()
+        glib.timeout_add(100, wait)
+
+    def export_temporary(self, temporary,
+                         mime_type='application/vnd.ms-excel', suffix='.xls'):
         app_info = gio.app_info_get_default_for_type(mime_type, False)
         if app_info:
             action = api.user_settings.get('spreadsheet-action')
@@ -64,7 +116,7 @@ class SpreadSheetExporter:
             temporary.close()
             self._open_application(mime_type, temporary.name)
         elif action == 'save':
-            self._save(temporary)
+            self._save(temporary, suffix)
 
     def _ask(self, app_info):
         # FIXME: What if the user presses esc? Esc will return False
@@ -83,7 +135,7 @@ class SpreadSheetExporter:
         gfile = gio.File(path=filename)
         app_info.launch([gfile])
 
-    def _save(self, temp):
+    def _save(self, temp, ext='.xls'):
         chooser = gtk.FileChooserDialog(
             _("Export Spreadsheet..."), None,
             gtk.FILE_CHOOSER_ACTION_SAVE,
@@ -92,8 +144,11 @@ class SpreadSheetExporter:
         chooser.set_do_overwrite_confirmation(True)
 
         xls_filter = gtk.FileFilter()
-        xls_filter.set_name(_('Excel Files'))
-        xls_filter.add_pattern('*.xls')
+        if ext == '.csv':
+            xls_filter.set_name(_('CSV Files'))
+        else:
+            xls_filter.set_name(_('Excel Files'))
+        xls_filter.add_pattern('*' + ext)
         chooser.add_filter(xls_filter)
 
         response = chooser.run()
@@ -104,7 +159,6 @@ class SpreadSheetExporter:
             return
 
         filename = chooser.get_filename()
-        ext = '.xls'
 
         chooser.destroy()
 
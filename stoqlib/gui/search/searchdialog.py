@@ -491,9 +491,9 @@ class SearchDialog(BasicDialog):
 
     def _on_export_csv_button__clicked(self, widget):
         sse = SpreadSheetExporter()
-        sse.export(object_list=self.results,
-                   name=self._csv_name,
-                   filename_prefix=self._csv_prefix)
+        sse.export_search(self.search,
+                          name=self._csv_name,
+                          filename_prefix=self._csv_prefix)
 
     def _on_print_button__clicked(self, button):
         self.print_report()
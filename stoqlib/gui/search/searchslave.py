@@ -40,6 +40,7 @@ from stoqlib.database.queryexecuter import (NumberQueryState, StringQueryState,
                                             DateQueryState, DateIntervalQueryState,
                                             NumberIntervalQueryState, BoolQueryState,
                                             QueryExecuter)
+from stoqlib.database.runtime import DEFAULT_ITERSIZE
 from stoqlib.enums import SearchFilterPosition
 from stoqlib.gui.interfaces import ISearchResultView
 from stoqlib.gui.search.searchcolumns import SearchColumn
@@ -108,6 +109,7 @@ class SearchSlave(SlaveDelegate):
         self._auto_search = True
         self._lazy_search = False
         self._last_results = None
+        self._last_states = None
         self._model = None
         self._query_executer = None
         self._restore_name = restore_name
@@ -244,7 +246,7 @@ class SearchSlave(SlaveDelegate):
         if clear:
             self.result_view.clear()
         if self._fast_iter:
-            results = results.fast_iter()
+            results = results.fast_iter(itersize=DEFAULT_ITERSIZE)
         self.result_view.search_completed(results)
 
         if self.result_view.get_n_items() == 0:
@@ -575,6 +577,9 @@ class SearchSlave(SlaveDelegate):
     def get_last_results(self):
         return self._last_results
 
+    def get_last_states(self):
+        return self._last_states
+
     def set_result_view(self, result_view_class, refresh=False):
         """
         Creates a new result view and attaches it to this search container.
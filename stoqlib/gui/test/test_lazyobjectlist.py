@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+__tests__ = 'stoqlib/gui/widgets/lazyobjectlist.py'
+
+import gtk
+from kiwi.ui.objectlist import Column, ObjectList
+import mock
+
+from stoqlib.database.queryexecuter import QueryExecuter
+from stoqlib.domain.person import Person
+from stoqlib.gui.test.uitestutils import GUITest
+from stoqlib.gui.widgets.lazyobjectlist import LazyObjectModel
+
+
+class TestLazyObjectModel(GUITest):
+    def setUp(self):
+        super(TestLazyObjectModel, self).setUp()
+        # Some repeated names, so that the rows are also sorted by id
+        for i in range(10):
+            self.create_person(name=u'Keyset %d' % (i // 2, ))
+        self.result = self.store.find(Person,
+                                      Person.name.startswith(u'Keyset'))
+        self.expected = list(self.result.order_by(Person.name, Person.id))
+
+        self.executer = QueryExecuter(self.store)
+        self.executer.set_search_spec(Person)
+        self.objectlist = ObjectList([Column('name', data_type=unicode,
+                                             sorted=True)])
+
+    def _get_model(self):
+        with mock.patch.object(self.executer, 'get_post_result',
+                               return_value=None):
+            return LazyObjectModel(self.objectlist, self.result,
+                                   self.executer, initial_count=2)
+
+    def _get_values(self, model):
+        return [model[i][0] for i in range(len(model))]
+
+    def test_keyset_paging(self):
+        model = self._get_model()
+        self.assertEqual(self._get_values(model)[:2], self.expected[:2])
+
+        # Loaded from the end, from the page after it and from
+        # the page before it
+        model.load_items_from_results(7, 10)
+        model.load_items_from_results(5, 7)
+        model.load_items_from_results(2, 5)
+        self.assertEqual(self._get_values(model), self.expected)
+        self.assertEqual(model._key_indexes, [0, 1, 2, 4, 5, 6, 7, 9])
+        for index in model._key_indexes:
+            self.assertEqual(model._keys[index],
+                             (self.expected[index].name,
+                              self.expected[index].id))
+
+    def test_keyset_paging_descending(self):
+        model = self._get_model()
+        with mock.patch.object(self.executer, 'get_post_result',
+                               return_value=None):
+            model.do_set_sort_column_id(0, gtk.SORT_DESCENDING)
+        model.load_items_from_results(4, 7)
+        model.load_items_from_results(2, 4)
+        model.load_items_from_results(7, 10)
+        self.assertEqual(self._get_values(model),
+                         list(reversed(self.expected)))
+
+    def test_offset_fallback(self):
+        model = self._get_model()
+        # Grouped searches may be sorted by aggregates, so they are sliced
+        with mock.patch.object(Person, 'group_by', [Person.id], create=True):
+            model.load_items_from_results(5, 10)
+        self.assertEqual(self._get_values(model)[5:], self.expected[5:])
+        self.assertNotIn(5, model._keys)
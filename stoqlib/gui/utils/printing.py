@@ -34,6 +34,7 @@ import pango
 import poppler
 
 from stoqlib.gui.base.dialogs import get_current_toplevel
+from stoqlib.gui.dialogs.progressdialog import ProgressDialog
 from stoqlib.gui.events import PrintReportEvent
 from stoqlib.lib.message import warning
 from stoqlib.lib.osutils import get_application_dir
@@ -42,7 +43,8 @@ from stoqlib.lib.template import render_template_string
 from stoqlib.lib.threadutils import (schedule_in_main_thread,
                                      terminate_thread)
 from stoqlib.lib.translation import stoqlib_gettext
-from stoqlib.reporting.report import HTMLReport
+from stoqlib.reporting.renderer import CHUNKED_MIN_ROWS, render_report
+from stoqlib.reporting.report import HTMLReport, TableReport
 from stoqlib.reporting.labelreport import LabelReport
 
 
@@ -244,6 +246,10 @@ class PrintOperationWEasyPrint(PrintOperation):
 
     def __init__(self, report):
         PrintOperation.__init__(self, report)
+        # Large table reports are rendered on worker processes
+        self._chunked = (isinstance(report, TableReport) and
+                         len(report.data) >= CHUNKED_MIN_ROWS)
+        self._progress_dialog = None
         self._load_settings()
 
         self.connect('create-custom-widget',
@@ -271,15 +277,35 @@ class PrintOperationWEasyPrint(PrintOperation):
 
     def begin_print(self):
         self._fetch_settings()
+        if self._chunked:
+            self._progress_dialog = ProgressDialog(_('Rendering the report'))
+            self._progress_dialog.start()
 
     def render(self):
+        if self._chunked:
+            render_report(self._report, self._report.filename,
+                          stylesheet=self.print_css,
+                          progress=self._on_render_progress)
+            uri = gio.File(path=self._report.filename).get_uri()
+            self._document = poppler.document_new_from_file(uri, password="")
+            return
+
         self._document = self._report.render(
             stylesheet=self.print_css)
 
     def render_done(self):
+        if self._chunked:
+            self._stop_progress_dialog()
+            self.set_n_pages(self._document.get_n_pages())
+            return
+
         self.set_n_pages(len(self._document.pages))
 
     def draw_page(self, cr, page_no):
+        if self._chunked:
+            self._document.get_page(page_no).render_for_printing(cr)
+            return
+
         import weasyprint
         weasyprint_version = tuple(map(int, weasyprint.__version__.split('.')))
         if weasyprint_version >= (0, 18):
@@ -287,6 +313,10 @@ class PrintOperationWEasyPrint(PrintOperation):
         # 0.75 is here because its also in weasyprint render_pdf()
         self._document.pages[page_no].paint(cr, scale=0.75)
 
+    def done(self):
+        # When the printing is aborted, render_done() is never called
+        self._stop_progress_dialog()
+
     # Private
 
     def _fetch_settings(self):
@@ -344,11 +374,28 @@ class PrintOperationWEasyPrint(PrintOperation):
         box.show_all()
         return box
 
+    def _stop_progress_dialog(self):
+        if self._progress_dialog is None:
+            return
+        self._progress_dialog.stop()
+        self._progress_dialog = None
+
+    def _set_progress_label(self, label):
+        # The printing may have been aborted before this was called
+        if self._progress_dialog is not None:
+            self._progress_dialog.set_label(label)
+
     # Callbacks
 
     def _on_operation_create_custom_widget(self, operation):
         return self._create_custom_tab()
 
+    def _on_render_progress(self, done, total):
+        # Called from the rendering thread
+        schedule_in_main_thread(
+            self._set_progress_label,
+            _('Rendered %d of %d parts of the report') % (done, total))
+
 
 def describe_search_filters_for_reports(filters, **kwargs):
     filter_strings = []
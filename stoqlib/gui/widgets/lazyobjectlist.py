@@ -22,10 +22,14 @@
 ## Author(s): Stoq Team <stoq-devel@async.com.br>
 #
 
+import bisect
+
 import gtk
 
 from kiwi.datatypes import number
 from kiwi.ui.objectlist import empty_marker, ListLabel
+from storm import Undef
+from storm.expr import And, ComparableExpr, Desc, Or
 
 from stoqlib.lib.translation import stoqlib_gettext
 
@@ -78,6 +82,10 @@ class LazyObjectModel(gtk.GenericTreeModel, gtk.TreeSortable):
         self._executer = executer
         self._initial_count = initial_count
         self._iters = []
+        # Forward index -> (sort value, id) of the rows in the boundaries
+        # of the pages already loaded, used for keyset pagination
+        self._keys = {}
+        self._key_indexes = []
         self._orig_result = result
         self._post_result = None
         self._result = None
@@ -101,8 +109,108 @@ class LazyObjectModel(gtk.GenericTreeModel, gtk.TreeSortable):
         self._iters = list(range(0, count))
         self._result = result
         self._values = [empty_marker] * count
+        self._keys = {}
+        self._key_indexes = []
         self.load_items_from_results(0, self._initial_count)
 
+    def _get_order_attr(self):
+        column = self._objectlist.get_columns()[self._sort_column_id]
+        if hasattr(column, 'search_attribute'):
+            # Even if it's defined, it could be None
+            return column.search_attribute or column.attribute
+        return column.attribute
+
+    def _get_keyset_columns(self, result):
+        # Returns the (sort column, id column) pair used for keyset
+        # pagination or None if we cannot use it for this search and
+        # should fallback to OFFSET/LIMIT slicing. The sort column is the
+        # one the executer ordered the result by
+        search_spec = self._executer.search_spec
+        if search_spec is None or result._order_by is Undef:
+            return None
+        # Grouped results can be sorted by aggregates, which
+        # cannot be used in the WHERE clause
+        if (result._group_by is not Undef or
+                getattr(search_spec, 'group_by', None)):
+            return None
+
+        order_by = result._order_by
+        if not isinstance(order_by, (list, tuple)):
+            order_by = [order_by]
+        if len(order_by) != 1:
+            return None
+        sort_column = order_by[0]
+        if isinstance(sort_column, basestring):
+            sort_column = getattr(search_spec, sort_column, None)
+        id_column = getattr(search_spec, 'id', None)
+        if not (isinstance(sort_column, ComparableExpr) and
+                isinstance(id_column, ComparableExpr)):
+            return None
+        return sort_column, id_column
+
+    def _remember_key(self, index, item, order_attr):
+        if index in self._keys:
+            return
+        self._keys[index] = (getattr(item, order_attr), item.id)
+        bisect.insort(self._key_indexes, index)
+
+    def _fetch_forward_range(self, order_attr, start, end):
+        # Fetches the rows between start and end, considering that the
+        # results are sorted ascending by order_attr and then by id.
+        #
+        # Instead of using OFFSET start, which makes the database scan
+        # and discard every previous row, we seek from the nearest
+        # anchor: the beginning or the end of the results, or the rows
+        # in the boundaries of the pages already loaded.
+        result = self._result
+        columns = self._get_keyset_columns(result)
+        if columns is None:
+            return list(result[start:end])
+        sort_column, id_column = columns
+        limit = end - start
+
+        # (distance, is_forward, key)
+        anchors = [(start, True, None),
+                   (self._count - end, False, None)]
+        pos = bisect.bisect_left(self._key_indexes, start)
+        if pos > 0:
+            index = self._key_indexes[pos - 1]
+            anchors.append((start - index - 1, True, self._keys[index]))
+        pos = bisect.bisect_left(self._key_indexes, end)
+        if pos < len(self._key_indexes):
+            index = self._key_indexes[pos]
+            anchors.append((index - end, False, self._keys[index]))
+        offset, forward, key = min(anchors)
+
+        if key is not None:
+            value, id_ = key
+            # PostgreSQL puts NULLs last on ascending order
+            if forward and value is None:
+                query = And(sort_column == None, id_column > id_)
+            elif forward:
+                query = Or(sort_column > value,
+                           And(sort_column == value, id_column > id_),
+                           sort_column == None)
+            elif value is None:
+                query = Or(sort_column != None,
+                           And(sort_column == None, id_column < id_))
+            else:
+                query = Or(sort_column < value,
+                           And(sort_column == value, id_column < id_))
+            result = result.find(query)
+
+        if forward:
+            result = result.order_by(sort_column, id_column)
+            items = list(result[offset:offset + limit])
+        else:
+            result = result.order_by(Desc(sort_column), Desc(id_column))
+            items = list(reversed(list(result[offset:offset + limit])))
+
+        if items:
+            self._remember_key(start, items[0], order_attr)
+            self._remember_key(start + len(items) - 1, items[-1], order_attr)
+        return items
+
     # GtkTreeModel
 
     @debug
@@ -255,25 +363,19 @@ class LazyObjectModel(gtk.GenericTreeModel, gtk.TreeSortable):
         # If we moved the start value in the for above, also move the end value
         end = min(start + load_total, self._count)
 
-        column = self._objectlist.get_columns()[self._sort_column_id]
-        if hasattr(column, 'search_attribute'):
-            # Even if it's defined, it could be None
-            order_attr = column.search_attribute or column.attribute
-        else:
-            order_attr = column.attribute
+        order_attr = self._get_order_attr()
         self._result = self._executer.get_ordered_result(self._orig_result,
                                                          order_attr)
 
         if self._sort_order == gtk.SORT_DESCENDING:
             # Results should be reversed, so we need to invert the start and
             # end values, and use the end of the list as a reference.
-            # This should be as easy as reversed(self._results[-end:-start])
-            # but storm does not support this.
             start_ = self._count - end
             end_ = self._count - start
-            results = reversed(list(self._result[start_:end_]))
+            results = reversed(
+                self._fetch_forward_range(order_attr, start_, end_))
         else:
-            results = list(self._result[start:end])
+            results = self._fetch_forward_range(order_attr, start, end)
 
         has_loaded = False
         for i, item in enumerate(results, start):
@@ -27,15 +27,26 @@
 CSV import classes
 """
 
+from cStringIO import StringIO
 import csv
-import datetime
-import time
 
 from stoqlib.database.runtime import new_store
 from stoqlib.importers.importer import Importer
 from stoqlib.lib.dateutils import localdate
 
 
+def _copy_value(value):
+    if value is None:
+        return '\\N'
+    if not isinstance(value, unicode):
+        value = unicode(value)
+    value = value.replace(u'\\', u'\\\\')
+    for char, escaped in [(u'\t', u'\\t'), (u'\n', u'\\n'),
+                          (u'\r', u'\\r')]:
+        value = value.replace(char, escaped)
+    return value.encode('utf-8')
+
+
 class CSVRow(object):
     """A row in a CSV file
     """
@@ -62,13 +73,14 @@ class CSVImporter(Importer):
     optional_fields = []
     dialect = 'excel'
 
-    def __init__(self, lines=500, dry=False):
+    def __init__(self, lines=500, dry=False, bulk=False):
         """
         Create a new CSVImporter object.
         :param lines: see :class:`set_lines_per_commit`
         :param dry: see :class:`set_dry`
+        :param bulk: see :class:`set_bulk`
         """
-        Importer.__init__(self, items=lines, dry=dry)
+        Importer.__init__(self, items=lines, dry=dry, bulk=bulk)
         self.lines = lines
 
     #
@@ -79,56 +91,59 @@ class CSVImporter(Importer):
         store = new_store()
         self.before_start(store)
         store.commit(close=True)
-        self.lineno = 1
+        self.filename = filename
         self.rows = list(csv.reader(fp, dialect=self.dialect))
 
     def get_n_items(self):
         return len(self.rows)
 
     def process_item(self, store, item_no):
-        t = time.time()
-        item = self.rows[item_no]
-        if not item or item[0].startswith('%'):
-            self.lineno += 1
+        row = self._parse_row(item_no)
+        if row is None:
             return False
-        if len(item) < len(self.fields):
-            raise ValueError(
-                "line %d in file %s has %d fields, but we need at "
-                "least %d fields to be able to process it" % (self.lineno,
-                                                              self.filename,
-                                                              len(item),
-                                                              len(self.fields)))
 
-        field_names = self.fields + self.optional_fields
-        if len(item) > len(field_names):
-            raise ValueError(
-                "line %d in file %s has %d fields, but we can at most "
-                "handle %d fields, fields=%r" % (self.lineno,
-                                                 self.filename,
-                                                 len(item),
-                                                 len(field_names),
-                                                 item))
-
-        row = CSVRow(item, field_names)
         try:
             self.process_one(row, row.fields, store)
         except Exception:
             print()
-            print('Error while processing row %d %r' % (self.lineno, row, ))
+            print('Error while processing row %d %r' % (item_no + 1, row, ))
             print()
             raise
 
-        if self.items != -1:
-            if self.lineno % self.items == 0:
-                t2 = time.time()
-                print('%s Imported %d entries in %2.2f sec total=%d' % (
-                    datetime.datetime.now().strftime('%T'), self.items,
-                    t2 - t, self.lineno))
-                t = t2
-
-        self.lineno += 1
         return True
 
+    def process_batch(self, store, start, end):
+        rows = []
+        for item_no in range(start, end):
+            row = self._parse_row(item_no)
+            if row is not None:
+                rows.append(row)
+        if rows:
+            self.process_rows(rows, store)
+        return len(rows)
+
+    def copy_rows(self, store, table, columns, rows):
+        """Streams rows into a table using COPY, this is a lot faster
+        than inserting them one by one.
+
+        :param store: a store
+        :param table: the name of the table
+        :param columns: the columns to copy into
+        :param rows: a sequence of tuples with the values of the columns,
+          ``None`` will be copied as ``NULL``
+        """
+        fp = StringIO()
+        for row in rows:
+            fp.write('\t'.join(_copy_value(v) for v in row))
+            fp.write('\n')
+        fp.seek(0)
+
+        # Make sure that everything done using storm reached the database
+        store.flush()
+        cursor = store._connection.build_raw_cursor()
+        cursor.copy_from(fp, table, columns=columns)
+        cursor.close()
+
     def parse_date(self, data):
         return localdate(*map(int, data.split('-')))
 
@@ -141,6 +156,36 @@ class CSVImporter(Importer):
                             for field_id in field.split('|')]
         return field_values
 
+    #
+    # Private
+    #
+
+    def _parse_row(self, item_no):
+        item = self.rows[item_no]
+        if not item or item[0].startswith('%'):
+            return None
+
+        lineno = item_no + 1
+        if len(item) < len(self.fields):
+            raise ValueError(
+                "line %d in file %s has %d fields, but we need at "
+                "least %d fields to be able to process it" % (lineno,
+                                                              self.filename,
+                                                              len(item),
+                                                              len(self.fields)))
+
+        field_names = self.fields + self.optional_fields
+        if len(item) > len(field_names):
+            raise ValueError(
+                "line %d in file %s has %d fields, but we can at most "
+                "handle %d fields, fields=%r" % (lineno,
+                                                 self.filename,
+                                                 len(item),
+                                                 len(field_names),
+                                                 item))
+
+        return CSVRow(item, field_names)
+
     #
     # Override this in a subclass
     #
@@ -154,6 +199,16 @@ class CSVImporter(Importer):
         """
         raise NotImplementedError
 
+    def process_rows(self, rows, store):
+        """Processes a batch of lines in a csv file when in bulk mode.
+        By default this calls :meth:`.process_one` for each row.
+
+        :param rows: a list of objects representing the rows in the input
+        :param store: a store
+        """
+        for row in rows:
+            self.process_one(row, row.fields, store)
+
     def read(self, iterable):
         """This can be overridden by as subclass which wishes to specialize
         the CSV reader.
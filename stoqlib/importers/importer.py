@@ -64,14 +64,16 @@ class Importer(object):
 
     """
 
-    def __init__(self, items=500, dry=False):
+    def __init__(self, items=500, dry=False, bulk=False):
         """
         Create a new Importer object.
         :param items: see :class:`set_items_per_commit`
         :param dry: see :class:`set_dry`
+        :param bulk: see :class:`set_bulk`
         """
         self.items = items
         self.dry = dry
+        self.bulk = bulk
 
     def feed_file(self, filename):
         """Feeds csv data from filename to the importer
@@ -86,7 +88,7 @@ class Importer(object):
         before committing
         :param items: number of items or
         """
-        self.n_items = items
+        self.items = items
 
     def set_dry(self, dry):
         """Tells the CSVImporter to run in dry mode, eg without committing
@@ -95,6 +97,14 @@ class Importer(object):
         """
         self.dry = dry
 
+    def set_bulk(self, bulk):
+        """Tells the importer to process the items in batches of
+        :class:`items per commit <set_items_per_commit>`, see
+        :meth:`.process_batch`.
+        :param bulk: bulk mode
+        """
+        self.bulk = bulk
+
     def process(self, store=None):
         """Do the main logic, create stores, import items etc"""
         n_items = self.get_n_items()
@@ -102,31 +112,38 @@ class Importer(object):
         create_log.info('ITEMS:%d' % (n_items, ))
         t1 = time.time()
 
+        if self.items > 0:
+            batch_size = self.items
+        else:
+            batch_size = max(n_items, 1)
+
         imported_items = 0
         if not store:
             store = new_store()
         self.before_start(store)
-        for i in range(n_items):
-            if self.process_item(store, i):
-                create_log.info('ITEM:%d' % (i + 1, ))
-                imported_items += 1
-            if not self.dry and i + 1 % 100 == 0:
+        for start in range(0, n_items, batch_size):
+            t = time.time()
+            end = min(start + batch_size, n_items)
+            if self.bulk:
+                imported_items += self.process_batch(store, start, end)
+                create_log.info('ITEM:%d' % (end, ))
+            else:
+                for i in range(start, end):
+                    if self.process_item(store, i):
+                        create_log.info('ITEM:%d' % (i + 1, ))
+                        imported_items += 1
+
+            if not self.dry:
                 store.commit(close=True)
                 store = new_store()
-
-        if not self.dry:
-            store.commit(close=True)
-            store = new_store()
+            self._log_progress(end - start, t, end)
 
         self.when_done(store)
 
         if not self.dry:
             store.commit(close=True)
 
-        t2 = time.time()
-        log.info('%s Imported %d entries in %2.2f sec' % (
-            datetime.datetime.now().strftime('%T'), n_items,
-            t2 - t1))
+        self._log_progress(n_items, t1)
         create_log.info('IMPORTED-ITEMS:%d' % (imported_items, ))
 
     def feed(self, fp, filename='<stdin>'):
@@ -145,6 +162,21 @@ class Importer(object):
         """
         raise NotImplementedError
 
+    def process_batch(self, store, start, end):
+        """Process the items from *start* to *end* at once, used
+        in :class:`bulk mode <set_bulk>`.
+
+        Subclasses can override this to import a batch faster than
+        processing the items one by one.
+
+        :returns: the number of items imported
+        """
+        imported_items = 0
+        for i in range(start, end):
+            if self.process_item(store, i):
+                imported_items += 1
+        return imported_items
+
     #
     # Optional to implement
     #
@@ -159,6 +191,19 @@ class Importer(object):
         before committing.
         """
 
+    #
+    # Private
+    #
+
+    def _log_progress(self, n_items, start_time, total=None):
+        elapsed = time.time() - start_time
+        msg = '%s Imported %d entries in %2.2f sec (%d rows/sec)' % (
+            datetime.datetime.now().strftime('%T'), n_items, elapsed,
+            n_items / max(elapsed, 0.001))
+        if total is not None:
+            msg += ' total=%d' % (total, )
+        log.info(msg)
+
 
 def get_by_type(importer_type):
     """Gets an importers class, instantiates it returns it
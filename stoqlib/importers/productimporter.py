@@ -33,11 +33,100 @@ from stoqlib.domain.product import (Product, ProductSupplierInfo,
 from stoqlib.domain.sellable import (Sellable,
                                      SellableCategory,
                                      SellableUnit)
+from stoqlib.exceptions import SellableError
 from stoqlib.importers.csvimporter import CSVImporter
 from stoqlib.lib.parameters import sysparam
+from stoqlib.lib.translation import stoqlib_gettext
+
+_ = stoqlib_gettext
+
+_STAGING_COLUMNS = ['barcode', 'code', 'description', 'cost', 'price',
+                    'commission', 'category_id', 'unit_id']
+
+# The ids and the transaction entries of the objects are allocated by the
+# column defaults while the rows are copied in.
+_CREATE_STAGING_TABLE = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS _product_import (
+        barcode text,
+        code text,
+        description text,
+        cost numeric(20, 8),
+        price numeric(20, 2),
+        commission numeric(10, 2),
+        category_id uuid,
+        unit_id uuid,
+        sellable_id uuid DEFAULT uuid_generate_v1(),
+        product_id uuid DEFAULT uuid_generate_v1(),
+        sellable_te_id bigint DEFAULT nextval('transaction_entry_id_seq'),
+        product_te_id bigint DEFAULT nextval('transaction_entry_id_seq'),
+        storable_te_id bigint DEFAULT nextval('transaction_entry_id_seq'),
+        supplier_info_te_id bigint DEFAULT nextval('transaction_entry_id_seq')
+    );
+    TRUNCATE _product_import;
+"""
+
+# A code or barcode of the staged rows that already exists, on the
+# sellables or on another staged row. The empty ones are not unique, as
+# in Sellable.check_unique_value_exists
+_DUPLICATED_VALUE = """
+    SELECT staged.%(column)s
+      FROM _product_import AS staged
+     WHERE staged.%(column)s <> ''
+       AND (EXISTS (SELECT 1 FROM sellable
+                     WHERE sellable.%(column)s = staged.%(column)s)
+            OR EXISTS (SELECT 1 FROM _product_import AS other
+                        WHERE other.%(column)s = staged.%(column)s
+                          AND other.ctid <> staged.ctid))
+     LIMIT 1
+"""
+
+# The values here are the same as the defaults of the domain classes
+_INSERT_PRODUCTS = """
+    INSERT INTO transaction_entry (id, te_time, dirty)
+        SELECT unnest(ARRAY[sellable_te_id, product_te_id,
+                            storable_te_id, supplier_info_te_id]),
+               STATEMENT_TIMESTAMP(), true
+          FROM _product_import;
+
+    INSERT INTO sellable (id, te_id, barcode, code, status, description,
+                          cost, base_price, notes, max_discount, commission,
+                          on_sale_price, unit_id, category_id, tax_constant_id)
+        SELECT sellable_id, sellable_te_id, barcode, code, 'available',
+               description, cost, price, '', 0, commission, 0, unit_id,
+               category_id, ?
+          FROM _product_import;
+
+    INSERT INTO product (id, te_id, sellable_id, consignment, location,
+                         part_number, family, brand, model, production_time,
+                         manage_stock, is_composed, is_grid, width, height,
+                         depth, weight)
+        SELECT product_id, product_te_id, sellable_id, false, '', '', '', '',
+               '', 1, true, false, false, 0, 0, 0, 0
+          FROM _product_import;
+
+    INSERT INTO storable (te_id, product_id, is_batch, minimum_quantity,
+                          maximum_quantity)
+        SELECT storable_te_id, product_id, false, 0, 0
+          FROM _product_import;
+
+    INSERT INTO product_supplier_info (te_id, product_id, supplier_id,
+                                       supplier_code, base_cost, notes,
+                                       is_main_supplier, icms, lead_time,
+                                       minimum_purchase)
+        SELECT supplier_info_te_id, product_id, ?, '', cost, '', true, 0, 1, 1
+          FROM _product_import;
+"""
 
 
 class ProductImporter(CSVImporter):
+    """Imports products
+
+    In :meth:`bulk mode <stoqlib.importers.importer.Importer.set_bulk>`
+    the products are copied into a staging table and created from there
+    using plain SQL, note that ProductCreateEvent will not be emitted for
+    them in this case.
+    """
+
     fields = ['base_category',
               'barcode',
               'category',
@@ -65,38 +154,92 @@ class ProductImporter(CSVImporter):
 
         self.units = {}
         for unit in default_store.find(SellableUnit):
-            self.units[unit.description] = unit
+            self.units[unit.description] = unit.id
+
+        # Lookups of the existing categories and commission sources, so
+        # that we don't need to query for them for each line
+        self._categories = {}
+        for category in default_store.find(SellableCategory):
+            self._add_category(category)
+        self._commission_sources = set(
+            default_store.find((CommissionSource.category_id,
+                                CommissionSource.direct_value,
+                                CommissionSource.installments_value),
+                               CommissionSource.category_id != None))
+        self._commissions = {}
 
         self.tax_constant_id = sysparam.get_object_id(
             'DEFAULT_PRODUCT_TAX_CONSTANT')
         self._code = 1
 
-    def _get_or_create(self, table, store, **attributes):
-        obj = store.find(table, **attributes).one()
-        if obj is None:
-            obj = table(store=store, **attributes)
-        return obj
+    def _add_category(self, category):
+        # A base category is looked up by its commission too
+        for commission in [None, category.salesperson_commission]:
+            key = (category.description, category.category_id,
+                   category.suggested_markup, commission)
+            self._categories.setdefault(key, category.id)
 
-    def process_one(self, data, fields, store):
-        base_category = self._get_or_create(
-            SellableCategory, store,
+    def _get_or_create_category(self, store, description, parent,
+                                suggested_markup, salesperson_commission=None):
+        key = (description, parent and parent.id, suggested_markup,
+               salesperson_commission)
+        category_id = self._categories.get(key)
+        if category_id is not None:
+            return store.get(SellableCategory, category_id)
+
+        category = SellableCategory(store=store,
+                                    description=description,
+                                    category=parent,
+                                    suggested_markup=suggested_markup)
+        if salesperson_commission is not None:
+            category.salesperson_commission = salesperson_commission
+        self._add_category(category)
+        return category
+
+    def _get_category(self, data, store):
+        base_category = self._get_or_create_category(
+            store, data.base_category, None,
             suggested_markup=int(data.markup),
-            salesperson_commission=int(data.commission),
-            category=None,
-            description=data.base_category)
+            salesperson_commission=int(data.commission))
 
         # create a commission source
-        self._get_or_create(
-            CommissionSource, store,
-            direct_value=int(data.commission),
-            installments_value=int(data.commission2),
-            category=base_category)
-
-        category = self._get_or_create(
-            SellableCategory, store,
-            description=data.category,
-            suggested_markup=int(data.markup2),
-            category=base_category)
+        key = (base_category.id, int(data.commission), int(data.commission2))
+        if not key in self._commission_sources:
+            CommissionSource(store=store,
+                             direct_value=int(data.commission),
+                             installments_value=int(data.commission2),
+                             category=base_category)
+            self._commission_sources.add(key)
+
+        return self._get_or_create_category(
+            store, data.category, base_category,
+            suggested_markup=int(data.markup2))
+
+    def _get_unit_id(self, data, fields):
+        if not u'unit' in fields:
+            return None
+        if not data.unit in self.units:
+            raise ValueError(u"invalid unit: %s" % data.unit)
+        return self.units[data.unit]
+
+    def _get_next_code(self):
+        code = u'%02d' % self._code
+        self._code += 1
+        return code
+
+    def _check_duplicated_values(self, store):
+        # The sellables are not created through Sellable, so its code
+        # and barcode validation needs to be done here
+        messages = [('code', _(u"The sellable code %r already exists")),
+                    ('barcode', _(u"The sellable barcode %r already exists"))]
+        for column, message in messages:
+            row = store.execute(
+                _DUPLICATED_VALUE % dict(column=column)).get_one()
+            if row is not None:
+                raise SellableError(message % (row[0], ))
+
+    def process_one(self, data, fields, store):
+        category = self._get_category(data, store)
 
         sellable = Sellable(store=store,
                             cost=Decimal(data.cost),
@@ -104,12 +247,10 @@ class ProductImporter(CSVImporter):
                             description=data.description,
                             price=int(data.price))
         sellable.barcode = data.barcode
-        sellable.code = u'%02d' % self._code
-        self._code += 1
-        if u'unit' in fields:
-            if not data.unit in self.units:
-                raise ValueError(u"invalid unit: %s" % data.unit)
-            sellable.unit = store.fetch(self.units[data.unit])
+        sellable.code = self._get_next_code()
+        unit_id = self._get_unit_id(data, fields)
+        if unit_id is not None:
+            sellable.unit = store.get(SellableUnit, unit_id)
         sellable.tax_constant_id = self.tax_constant_id
 
         product = Product(sellable=sellable, store=store)
@@ -121,3 +262,24 @@ class ProductImporter(CSVImporter):
                             base_cost=Decimal(data.cost),
                             product=product)
         Storable(product=product, store=store)
+
+    def process_rows(self, rows, store):
+        values = []
+        for data in rows:
+            category = self._get_category(data, store)
+            if not category.id in self._commissions:
+                self._commissions[category.id] = category.get_commission()
+            values.append((data.barcode,
+                           self._get_next_code(),
+                           data.description,
+                           Decimal(data.cost),
+                           int(data.price),
+                           self._commissions[category.id] or 0,
+                           category.id,
+                           self._get_unit_id(data, data.fields)))
+
+        store.execute(_CREATE_STAGING_TABLE)
+        self.copy_rows(store, '_product_import', _STAGING_COLUMNS, values)
+        self._check_duplicated_values(store)
+        store.execute(_INSERT_PRODUCTS, (self.tax_constant_id,
+                                         self.supplier.id))
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""A bounded in-memory cache
+
+The decorators in :mod:`stoqlib.lib.decorators` store their values in
+a :class:`Cache`, which evicts the least recently used entries when full
+and expires them after their time to live.
+
+Keys are tuples, and entries can be invalidated by a prefix of their key::
+
+    cache = get_cache()
+    cache.set(('product', product_id, 'stock'), stock, ttl=60)
+    cache.invalidate(('product', product_id))
+"""
+
+import collections
+import threading
+import time
+
+#: The maximum number of entries kept by the default cache
+DEFAULT_MAXSIZE = 2048
+# Expired entries are looked for at most once in this many seconds
+_SWEEP_INTERVAL = 60
+
+_caches = collections.OrderedDict()
+
+
+class Cache(object):
+    """A LRU cache with a time to live per entry
+
+    :param name: the name of the cache, used on :func:`get_cache_stats`
+    :param maxsize: the maximum number of entries kept
+    """
+
+    def __init__(self, name, maxsize=DEFAULT_MAXSIZE):
+        self.name = name
+        self.maxsize = maxsize
+        # key -> (value, expires at or None)
+        self._entries = collections.OrderedDict()
+        self._commit_prefixes = set()
+        self._lock = threading.RLock()
+        self._last_sweep = time.time()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry is not None and not self._is_expired(entry)
+
+    #
+    #  Public API
+    #
+
+    def get(self, key):
+        """Get the value of a key
+
+        :param key: a tuple
+        :returns: the value
+        :raises: KeyError if the key is not on the cache or has expired
+        """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                raise KeyError(key)
+            if self._is_expired(entry):
+                self.misses += 1
+                self.expirations += 1
+                raise KeyError(key)
+            # Move it to the end, it's now the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=0):
+        """Set the value of a key
+
+        :param key: a tuple
+        :param value: the value
+        :param ttl: the time to live of the value in seconds,
+          ``0`` means it will never expire
+        """
+        expires = time.time() + ttl if ttl > 0 else None
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            self._sweep()
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        """Removes a key from the cache, if it's there
+
+        :param key: a tuple
+        """
+        with self._lock:
+            if self._entries.pop(key, None) is not None:
+                self.invalidations += 1
+
+    def invalidate(self, prefix=()):
+        """Removes the entries whose key starts with prefix
+
+        :param prefix: a tuple, an empty one will remove all entries
+        """
+        n = len(prefix)
+        with self._lock:
+            for key in list(self._entries):
+                if key[:n] == prefix:
+                    self._entries.pop(key, None)
+                    self.invalidations += 1
+
+    def invalidate_on_commit(self, prefix):
+        """Invalidate the entries starting with prefix on every commit
+
+        See :meth:`.commit`
+
+        :param prefix: a tuple
+        """
+        self._commit_prefixes.add(prefix)
+
+    def commit(self):
+        """Invalidate the entries registered with :meth:`.invalidate_on_commit`
+
+        This is called after a store is committed.
+        """
+        for prefix in list(self._commit_prefixes):
+            self.invalidate(prefix)
+
+    def get_stats(self):
+        """Get statistics about the cache usage
+
+        :returns: a dict with the number of ``entries`` and the
+          number of ``hits``, ``misses``, ``evictions``,
+          ``expirations`` and ``invalidations``
+        """
+        return dict(entries=len(self._entries),
+                    maxsize=self.maxsize,
+                    hits=self.hits,
+                    misses=self.misses,
+                    evictions=self.evictions,
+                    expirations=self.expirations,
+                    invalidations=self.invalidations)
+
+    #
+    #  Private
+    #
+
+    def _is_expired(self, entry):
+        return entry[1] is not None and entry[1] < time.time()
+
+    def _sweep(self):
+        now = time.time()
+        if now - self._last_sweep < _SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        for key, (value, expires) in list(self._entries.items()):
+            if expires is not None and expires < now:
+                self._entries.pop(key, None)
+                self.expirations += 1
+
+
+def get_cache(name='default', maxsize=DEFAULT_MAXSIZE):
+    """Get a cache by its name, creating it if needed
+
+    :param name: the name of the cache
+    :param maxsize: the maximum number of entries, only used
+      when the cache gets created
+    :returns: a :class:`Cache`
+    """
+    cache = _caches.get(name)
+    if cache is None:
+        cache = _caches[name] = Cache(name, maxsize=maxsize)
+    return cache
+
+
+def get_cache_stats():
+    """Get the statistics of all the caches
+
+    :returns: a dict mapping the cache names to their
+      :meth:`Cache.get_stats`
+    """
+    return dict((name, cache.get_stats())
+                for name, cache in _caches.items())
+
+
+def commit_caches():
+    """Calls :meth:`Cache.commit` on all the caches"""
+    for cache in _caches.values():
+        cache.commit()
@@ -157,6 +157,8 @@ class StoqConfig:
         port = self.get('Database', 'port')
         if port:
             port = int(port)
+        pool_size = self.get('Database', 'pool_size')
+        statement_cache = self.get('Database', 'statement_cache')
 
         database_section = self.get('General', 'database_section')
         if database_section is not None:
@@ -165,6 +167,9 @@ class StoqConfig:
             dbname = self.get(database_section, 'dbname') or dbname
             username = self.get(database_section, 'dbusername') or username
             port = self.get(database_section, 'port') or port
+            pool_size = self.get(database_section, 'pool_size') or pool_size
+            statement_cache = (self.get(database_section, 'statement_cache') or
+                               statement_cache)
 
         # FIXME: This and load_settings() needs to be simplified now when
         #        we only have one global settings singleton
@@ -175,6 +180,11 @@ class StoqConfig:
         db_settings.dbname = dbname or db_settings.dbname
         db_settings.username = username or db_settings.username
         db_settings.password = db_settings.password
+        if pool_size is not None:
+            db_settings.pool_size = int(pool_size)
+        if statement_cache is not None:
+            db_settings.statement_cache = statement_cache.lower() not in (
+                '0', 'false', 'no', 'off')
         return db_settings
 
     def set_from_options(self, options):
@@ -32,7 +32,14 @@ import rlcompleter
 rlcompleter  # pylint: disable=W0104
 
 from stoqlib.api import api
+from stoqlib.database.pool import get_pool_stats
+from stoqlib.database.runtime import get_commit_stats
+from stoqlib.database.statements import (get_statement_stats,
+                                         reset_statement_stats)
 from stoqlib.database.tables import get_table_types
+from stoqlib.lib.cache import get_cache_stats
+from stoqlib.lib.event import get_event_stats, reset_event_stats
+from stoqlib.lib.template import get_template_stats
 
 from stoq import version as stoq_version
 
@@ -56,6 +63,14 @@ class Console(object):
         self.ns['store'] = self.store
         self.ns['sysparam'] = api.sysparam
         self.ns['api'] = api
+        self.ns['get_pool_stats'] = get_pool_stats
+        self.ns['get_cache_stats'] = get_cache_stats
+        self.ns['get_commit_stats'] = get_commit_stats
+        self.ns['get_event_stats'] = get_event_stats
+        self.ns['reset_event_stats'] = reset_event_stats
+        self.ns['get_template_stats'] = get_template_stats
+        self.ns['get_statement_stats'] = get_statement_stats
+        self.ns['reset_statement_stats'] = reset_statement_stats
 
         if not bare:
             self.ns['branch'] = api.get_current_branch(self.store)
@@ -5,7 +5,14 @@
 # http://wiki.python.org/moin/PythonDecoratorLibrary#Cached_Properties
 #
 
-import time
+import functools
+import weakref
+
+from stoqlib.lib.cache import get_cache
+
+
+def _get_prefix(func):
+    return ('%s.%s' % (func.__module__, func.__name__), )
 
 
 class cached_property(object):
@@ -23,66 +30,122 @@ class cached_property(object):
                 # will only be evaluated every 10 min. at maximum.
                 return random.randint(0, 100)
 
-    The value is cached  in the '_cache' attribute of the object instance that
-    has the property getter method wrapped by this decorator. The '_cache'
-    attribute value is a dictionary which has a key for every property of the
-    object which is wrapped by this decorator. Each entry in the cache is
-    created only when the property is accessed for the first time and is a
-    two-element tuple with the last computed property value and the last time
-    it was updated in seconds since the epoch.
+    The values are kept in the default :class:`stoqlib.lib.cache.Cache`,
+    so the least recently used ones are evicted when it gets full. They
+    are removed when the instance is garbage collected, so the values of
+    instances that cannot be weakly referenced are not cached.
 
     The default time-to-live (TTL) is 300 seconds (5 minutes). Set the TTL to
-    zero for the cached value to never expire.
+    zero for the cached value to never expire. If *invalidate_on_commit* is
+    ``True``, the cached values are also expired when a store is committed.
 
     To expire a cached property value manually just do::
 
-        del instance._cache[<property name>]
+        MyClass.randint.invalidate(instance)
 
     '''
-    def __init__(self, ttl=300):
+    def __init__(self, ttl=300, invalidate_on_commit=False):
         self.ttl = ttl
+        self.invalidate_on_commit = invalidate_on_commit
 
     def __call__(self, fget, doc=None):
         self.fget = fget
         self.__doc__ = doc or fget.__doc__
         self.__name__ = fget.__name__
         self.__module__ = fget.__module__
+        # The class isn't known yet, see _get_key_prefix
+        self._prefix = None
         return self
 
     def __get__(self, inst, owner):
-        now = time.time()
+        if inst is None:
+            return self
+
         try:
-            value, last_update = inst._cache[self.__name__]
-            if self.ttl > 0 and now - last_update > self.ttl:
-                raise AttributeError
-        except (KeyError, AttributeError):
-            value = self.fget(inst)
-            try:
-                cache = inst._cache
-            except AttributeError:
-                cache = inst._cache = {}
-            cache[self.__name__] = (value, now)
+            ref = weakref.ref(inst)
+        except TypeError:
+            return self.fget(inst)
+
+        cache = get_cache()
+        key = self._get_key_prefix(owner) + (id(inst), )
+        try:
+            value, cached_ref = cache.get(key)
+        except KeyError:
+            pass
+        else:
+            # The id may be from an instance that doesn't exist anymore
+            if cached_ref() is inst:
+                return value
+
+        value = self.fget(inst)
+        ref = weakref.ref(inst, lambda ref: cache.discard(key))
+        cache.set(key, (value, ref), ttl=self.ttl)
         return value
 
+    def invalidate(self, inst):
+        """Expires the value cached for inst
+
+        :param inst: the instance
+        """
+        get_cache().discard(
+            self._get_key_prefix(type(inst)) + (id(inst), ))
+
+    def _get_key_prefix(self, owner):
+        if self._prefix is not None:
+            return self._prefix
+
+        # Properties with the same name on different classes of the same
+        # module must not share their values
+        for cls in owner.__mro__:
+            if cls.__dict__.get(self.__name__) is self:
+                prefix = ('%s.%s.%s' % (cls.__module__, cls.__name__,
+                                        self.__name__), )
+                break
+        else:
+            prefix = _get_prefix(self.fget)
+        if self.invalidate_on_commit:
+            get_cache().invalidate_on_commit(prefix)
+        self._prefix = prefix
+        return prefix
+
 
 class cached_function(object):
-    """Like cached_property but for functions"""
-    def __init__(self, ttl=300):
-        self._cache = {}
+    """Like cached_property but for functions
+
+    The values are cached based on the arguments the function was called
+    with. To expire them manually use the ``invalidate`` attribute of the
+    decorated function, it expires all the values cached for calls whose
+    arguments started with the given ones::
+
+        @cached_function()
+        def get_stock(product, branch):
+            ...
+
+        get_stock.invalidate(product)
+    """
+    def __init__(self, ttl=300, invalidate_on_commit=False):
         self.ttl = ttl
+        self.invalidate_on_commit = invalidate_on_commit
 
     def __call__(self, func):
+        cache = get_cache()
+        prefix = _get_prefix(func)
+        if self.invalidate_on_commit:
+            cache.invalidate_on_commit(prefix)
+
+        @functools.wraps(func)
         def wraps(*args, **kwargs):
-            now = time.time()
+            key = prefix + args
+            if kwargs:
+                key += (tuple(sorted(kwargs.items())), )
             try:
-                value, last_update = self._cache[args]
-                if self.ttl > 0 and now - last_update > self.ttl:
-                    raise AttributeError
-                return value
-            except (KeyError, AttributeError):
+                return cache.get(key)
+            except KeyError:
                 value = func(*args, **kwargs)
-                self._cache[args] = (value, now)
+                cache.set(key, value, ttl=self.ttl)
                 return value
+
+        wraps.invalidate = lambda *args: cache.invalidate(prefix + args)
         return wraps
 
 
@@ -25,12 +25,56 @@
 import logging
 import sys
 import weakref
+from timeit import default_timer
 
 from kiwi.python import ClassInittableObject, namedAny
 
 log = logging.getLogger(__name__)
 # Returned when object is dead
 _dead = object()
+# event name -> [calls, seconds]
+_event_stats = {}
+# (event name, callback name) -> [calls, seconds]
+_callback_stats = {}
+
+
+def _get_callable_name(func):
+    module = getattr(func, '__module__', None)
+    name = getattr(func, '__name__', None) or repr(func)
+    im_self = getattr(func, 'im_self', None)
+    if im_self is not None:
+        if isinstance(im_self, type):
+            name = '%s.%s' % (im_self.__name__, name)
+        else:
+            name = '%s.%s' % (type(im_self).__name__, name)
+    if module:
+        name = '%s.%s' % (module, name)
+    return name
+
+
+def get_event_stats():
+    """Get statistics about the emitted events
+
+    :returns: a dict mapping the name of the events emitted to a dict with
+      the number of ``calls``, the cumulative ``time`` in seconds they took
+      and the ``callbacks``, a dict mapping the name of each callback
+      called to its number of ``calls`` and cumulative ``time``
+    """
+    stats = {}
+    for name, (calls, seconds) in _event_stats.items():
+        if calls:
+            stats[name] = dict(calls=calls, time=seconds, callbacks={})
+    for (name, callback_name), (calls, seconds) in _callback_stats.items():
+        if calls and name in stats:
+            stats[name]['callbacks'][callback_name] = dict(calls=calls,
+                                                           time=seconds)
+    return stats
+
+
+def reset_event_stats():
+    """Resets the statistics returned by :func:`get_event_stats`"""
+    for stats in _event_stats.values() + _callback_stats.values():
+        stats[:] = [0, 0.0]
 
 
 class _CallbacksList(list):
@@ -69,6 +113,9 @@ class _WeakRef(object):
             self.obj = None
             self.meth = weakref.ref(func)
             self.id = id(func)
+        self.name = _get_callable_name(func)
+        # Set by Event.connect
+        self.stats = None
 
     def __eq__(self, other):
         if type(self) is not type(other):
@@ -105,6 +152,20 @@ class _WeakRef(object):
         return func(obj, *args, **kwargs)
 
 
+class _ClassMethodRef(object):
+    """A classmethod connected with a decorator, see :meth:`Event.connect`"""
+
+    def __init__(self, klass, func):
+        self.klass = klass
+        self.func = func
+        self.name = '%s.%s.%s' % (klass.__module__, klass.__name__,
+                                  func.__name__)
+        self.stats = None
+
+    def __call__(self, *args, **kwargs):
+        return self.func(self.klass, *args, **kwargs)
+
+
 class Event(ClassInittableObject):
     """Base class for events"""
 
@@ -116,7 +177,11 @@ class Event(ClassInittableObject):
         # a cls._callbacks_list, Event's one will be used.
         # Also, using a list instead of a set to keep the order
         cls._callbacks_list = _CallbacksList()
+        # A copy of _callbacks_list that emit iterates over, so the
+        # callbacks can connect and disconnect while it's being emitted
+        cls._callbacks = ()
         cls._lazy_callbacks = []
+        cls._stats = _event_stats.setdefault(cls.__name__, [0, 0.0])
 
     #
     #  Public API
@@ -142,19 +207,39 @@ class Event(ClassInittableObject):
 
     @classmethod
     def emit(cls, *args, **kwargs):
-        cls._resolve_lazy_callbacks()
+        if cls._lazy_callbacks:
+            cls._resolve_lazy_callbacks()
+
+        # The arguments are usually domain objects, only call their
+        # __repr__ when the message is going to be logged
+        if log.isEnabledFor(logging.INFO):
+            log.info('emitting event %s %r %r', cls.__name__, args, kwargs)
 
-        log.info('emitting event %s %r %r' % (cls.__name__,
-                                              args, kwargs))
+        start = default_timer()
         rv_list = []
-        for callback in cls._callbacks_list:
+        dead = []
+        for callback in cls._callbacks:
+            callback_start = default_timer()
             rv = callback(*args, **kwargs)
             if rv is _dead:
+                dead.append(callback)
                 continue
+            stats = callback.stats
+            stats[0] += 1
+            stats[1] += default_timer() - callback_start
             # Insert in the beggining to pick the last
             # return value which is not None
             rv_list.insert(0, rv)
 
+        if dead:
+            # Forget about the callbacks whose objects died
+            cls._callbacks_list[:] = [c for c in cls._callbacks_list
+                                      if not any(c is d for d in dead)]
+            cls._update_callbacks()
+
+        stats = cls._stats
+        stats[0] += 1
+        stats[1] += default_timer() - start
         return cls.handle_return_values(rv_list)
 
     @classmethod
@@ -178,19 +263,31 @@ class Event(ClassInittableObject):
             raise TypeError("callback %r must be callable" % (callback, ))
 
         assert callback not in cls._callbacks_list
-        cls._callbacks_list.append(callback)
+        cls._add_callback(callback)
 
     @classmethod
     def disconnect(cls, callback):
         cls._callbacks_list.remove(_WeakRef(callback))
+        cls._update_callbacks()
 
     #
     #  Private
     #
 
+    @classmethod
+    def _add_callback(cls, callback):
+        callback.stats = _callback_stats.setdefault(
+            (cls.__name__, callback.name), [0, 0.0])
+        cls._callbacks_list.append(callback)
+        cls._update_callbacks()
+
+    @classmethod
+    def _update_callbacks(cls):
+        cls._callbacks = tuple(cls._callbacks_list)
+
     @classmethod
     def _resolve_lazy_callbacks(cls):
-        for klass_string, func in cls._lazy_callbacks[:]:
-            klass = namedAny(klass_string)
-            cls._callbacks_list.append(lambda *a, **kw: func(klass, *a, **kw))
-            cls._lazy_callbacks.remove((klass_string, func))
+        lazy_callbacks = cls._lazy_callbacks
+        cls._lazy_callbacks = []
+        for klass_string, func in lazy_callbacks:
+            cls._add_callback(_ClassMethodRef(namedAny(klass_string), func))
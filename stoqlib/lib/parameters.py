@@ -25,11 +25,13 @@
 
 from decimal import Decimal
 import logging
+import weakref
 
 from kiwi.datatypes import ValidationError
 from kiwi.python import namedAny
 from stoqdrivers.enum import TaxType
 
+from stoqlib.database.pool import PooledPostgres
 from stoqlib.database.runtime import get_default_store
 from stoqlib.domain.parameter import ParameterData
 from stoqlib.enums import (LatePaymentPolicy, ReturnPolicy,
@@ -860,13 +862,26 @@ _details = [
 class ParameterAccess(object):
     """
     API for accessing and updating system parameters
+
+    The values are loaded once and the parsed values of the typed
+    getters are cached, as are the objects fetched by :meth:`.get_object`
+    for each store. Call :meth:`.listen` to be notified by the database
+    when a parameter is modified by another station.
     """
 
+    #: The channel notified by the parameter_data trigger
+    NOTIFY_CHANNEL = 'parameter_data'
+
     def __init__(self):
         # Mapping of details, name -> ParameterDetail
         self._details = dict((detail.key, detail) for detail in _details)
 
         self._values_cache = None
+        # name -> parsed value, for the typed getters
+        self._parsed_values = {}
+        # store -> {(name, id): weakref to object}, for get_object
+        self._objects = weakref.WeakKeyDictionary()
+        self._listen_connection = None
 
     # Lazy Mapping of database raw database values, name -> database value
     @property
@@ -877,6 +892,28 @@ class ParameterAccess(object):
                 for p in get_default_store().find(ParameterData))
         return self._values_cache
 
+    def _set_value(self, param_name, value):
+        self._values[param_name] = value
+        self._parsed_values.pop(param_name, None)
+
+    def _get_parsed_value(self, param_name, expected_type, parse):
+        detail = self._verify_detail(param_name, expected_type)
+        try:
+            return self._parsed_values[param_name]
+        except KeyError:
+            pass
+
+        value = self._values.get(param_name)
+        if value is None:
+            parsed = detail.initial
+        else:
+            try:
+                parsed = parse(value)
+            except ValueError:
+                parsed = detail.initial
+        self._parsed_values[param_name] = parsed
+        return parsed
+
     def _create_default_values(self, store):
         # Create default values for parameters that take objects
         self.set_object_default(store, "CUSTOM_LOGO_FOR_REPORTS", None)
@@ -979,7 +1016,8 @@ class ParameterAccess(object):
         # bool are represented as 1/0
         if expected_type is bool:
             value = int(value)
-        self._values[param_name] = param.field_value = unicode(value)
+        param.field_value = unicode(value)
+        self._set_value(param_name, param.field_value)
 
     def _set_default_value(self, store, detail, value):
         if value is None:
@@ -997,7 +1035,7 @@ class ParameterAccess(object):
                                  field_name=param_name,
                                  field_value=value,
                                  is_editable=True)
-            self._values[param_name] = data.field_value
+            self._set_value(param_name, data.field_value)
 
         data.field_value = value
 
@@ -1019,6 +1057,71 @@ class ParameterAccess(object):
     def clear_cache(self):
         """Clears the internal cache so it can be rebuilt on next access"""
         self._values_cache = None
+        self._parsed_values.clear()
+
+    def listen(self, store):
+        """Listen for notifications of modified parameters
+
+        A dedicated connection is used, since notifications are only
+        delivered outside of transactions. It doesn't come from the
+        connection pool, since the pool unlistens the connections given
+        back to it. After calling this,
+        :meth:`.process_notifications` needs to be called when
+        :meth:`.get_listen_fileno` becomes readable.
+
+        :param store: a store connected to the database to listen to
+        """
+        if self._listen_connection is not None:
+            return
+        database = store.get_database()
+        if isinstance(database, PooledPostgres):
+            conn = database.raw_connect_unpooled()
+        else:
+            conn = database.raw_connect()
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute('LISTEN %s' % (self.NOTIFY_CHANNEL, ))
+        cursor.close()
+        self._listen_connection = conn
+
+    def get_listen_fileno(self):
+        """Get the file descriptor of the connection used by :meth:`.listen`
+
+        :returns: the file descriptor or ``None`` if not listening
+        """
+        if self._listen_connection is None:
+            return None
+        return self._listen_connection.fileno()
+
+    def process_notifications(self):
+        """Reloads the parameters that were modified by other stations
+
+        :returns: the names of the parameters that were reloaded
+        """
+        conn = self._listen_connection
+        if conn is None:
+            return []
+
+        conn.poll()
+        names = set(notify.payload for notify in conn.notifies)
+        del conn.notifies[:]
+        if not names or self._values_cache is None:
+            return list(names)
+
+        cursor = conn.cursor()
+        cursor.execute(
+            "SELECT field_name, field_value FROM parameter_data "
+            "WHERE field_name = ANY(%s)", (list(names), ))
+        values = dict(cursor.fetchall())
+        cursor.close()
+        for name in names:
+            if name in values:
+                self._set_value(name, values[name])
+            else:
+                self._values.pop(name, None)
+                self._parsed_values.pop(name, None)
+        log.info('Reloaded parameters: %s' % (', '.join(sorted(names)), ))
+        return list(names)
 
     def check_parameter_presence(self):
         """
@@ -1075,11 +1178,8 @@ class ParameterAccess(object):
         :returns: the database value
         :rtype: bool
         """
-        detail = self._verify_detail(param_name, bool)
-        value = self._values.get(param_name)
-        if value is None:
-            return detail.initial
-        return value == u'1'
+        return self._get_parsed_value(param_name, bool,
+                                      lambda value: value == u'1')
 
     def set_decimal(self, store, param_name, value):
         """
@@ -1101,15 +1201,7 @@ class ParameterAccess(object):
         :returns: the database value
         :rtype: decimal.Decimal
         """
-        detail = self._verify_detail(param_name, Decimal)
-        value = self._values.get(param_name)
-        if value is None:
-            return detail.initial
-
-        try:
-            return Decimal(value)
-        except ValueError:
-            return detail.initial
+        return self._get_parsed_value(param_name, Decimal, Decimal)
 
     def set_int(self, store, param_name, value):
         """
@@ -1131,15 +1223,7 @@ class ParameterAccess(object):
         :returns: the database value
         :rtype: int
         """
-        detail = self._verify_detail(param_name, int)
-        value = self._values.get(param_name)
-        if value is None:
-            return detail.initial
-
-        try:
-            return int(value)
-        except ValueError:
-            return detail.initial
+        return self._get_parsed_value(param_name, int, int)
 
     def set_string(self, store, param_name, value):
         """
@@ -1194,7 +1278,7 @@ class ParameterAccess(object):
             value = unicode(value.id)
         param.field_value = value
         param.is_editable = is_editable
-        self._values[param_name] = value
+        self._set_value(param_name, value)
 
     def set_object_default(self, store, param_name, value, is_editable=True):
         """
@@ -1215,8 +1299,8 @@ class ParameterAccess(object):
         """
         Fetches an object from the database.
 
-        ..note..:: This has to query the database to build an object and
-                   it is slower than other getters, avoid it if you can.
+        The object is only fetched the first time it's requested
+        for each store.
 
         :param store: a database store
         :param param_name: the parameter name
@@ -1227,8 +1311,17 @@ class ParameterAccess(object):
         if value is None:
             return detail.initial
 
-        field_type = detail.get_parameter_type()
-        return store.get(field_type, unicode(value))
+        # Only weak references are kept, the objects reference their store
+        objects = self._objects.setdefault(store, {})
+        key = (param_name, value)
+        ref = objects.get(key)
+        obj = ref and ref()
+        if obj is None:
+            field_type = detail.get_parameter_type()
+            obj = store.get(field_type, unicode(value))
+            if obj is not None:
+                objects[key] = weakref.ref(obj)
+        return obj
 
     def get_object_id(self, param_name):
         """
@@ -1279,7 +1372,7 @@ class ParameterAccess(object):
         :param value: value
         :type value: unicode
         """
-        self._values[param_name] = value
+        self._set_value(param_name, value)
 
     def get_detail_by_name(self, param_name):
         """
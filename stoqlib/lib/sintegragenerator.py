@@ -24,18 +24,24 @@
 
 """Generate a Sintegra archive from the Stoqlib domain classes"""
 
+from decimal import Decimal
 import operator
 
+from storm.expr import Join
+
 from stoqlib.database.queryexecuter import DateIntervalQueryState
 
 from stoqlib.database.queryexecuter import QueryExecuter
-from stoqlib.database.runtime import get_current_branch, get_default_store
+from stoqlib.database.runtime import (get_current_branch, get_default_store,
+                                      DEFAULT_ITERSIZE)
 from stoqlib.domain.devices import FiscalDayHistory
-from stoqlib.domain.inventory import Inventory
+from stoqlib.domain.inventory import Inventory, InventoryItem
 from stoqlib.domain.person import (Company,
                                    Individual)
 from stoqlib.domain.receiving import ReceivingOrder
+from stoqlib.domain.product import Product
 from stoqlib.domain.sale import Sale
+from stoqlib.domain.sellable import Sellable
 from stoqlib.lib.sintegra import SintegraFile, SintegraError
 from stoqlib.lib.translation import stoqlib_gettext
 
@@ -326,19 +332,31 @@ class StoqlibSintegraGenerator(object):
                                   0, 0, 0, 0)
 
     def _add_inventory(self, inventory, state):
-        for item in inventory.get_items():
-            sellable = item.product.sellable
+        # A store wide inventory has one item per product, so stream them
+        # without creating the objects
+        tables = [InventoryItem,
+                  Join(Product, Product.id == InventoryItem.product_id),
+                  Join(Sellable, Sellable.id == Product.sellable_id)]
+        items = self.store.using(*tables).find(
+            (InventoryItem.product_cost, InventoryItem.actual_quantity,
+             InventoryItem.is_adjusted, Sellable.code, Sellable.cost),
+            InventoryItem.inventory_id == inventory.id)
+        for (product_cost, actual_quantity, is_adjusted,
+             code, cost) in items.fast_iter(itersize=DEFAULT_ITERSIZE):
             # Before bug #3708 the inventory items did not store the product's
             # cost, in this case, we use the current cost.
-            if item.product_cost:
-                total_product_value = item.get_total_cost()
+            # See InventoryItem.get_total_cost
+            if not is_adjusted and actual_quantity is None:
+                total_product_value = Decimal(0)
+            elif product_cost:
+                total_product_value = product_cost * actual_quantity
             else:
-                total_product_value = sellable.cost * item.actual_quantity
+                total_product_value = cost * actual_quantity
 
             self.sintegra.add_inventory_item(
                 inventory.close_date,
-                product_code=sellable.code,
-                product_quantity=item.actual_quantity,
+                product_code=code,
+                product_quantity=actual_quantity,
                 total_product_value=total_product_value,
                 # we are assuming that the main company owns all the products
                 # see the link in bug #3708 for further details.
@@ -21,12 +21,78 @@
 ##
 ## Author(s): Stoq Team <stoq-devel@async.com.br>
 ##
-""" Templating """
+""" Templating
+
+The templates are compiled only once per process. Template files are
+looked up on a :class:`mako.lookup.TemplateLookup` shared by all the
+calls to :func:`render_template`, which also keeps the compiled modules
+on disk, so the next processes don't need to compile them again.
+Template strings are kept compiled on a :class:`stoqlib.lib.cache.Cache`
+indexed by their hash.
+"""
+
+import hashlib
+import logging
+import os
+import threading
 
 from kiwi.environ import environ
 from mako.lookup import TemplateLookup
 from mako.template import Template
 
+from stoqlib.lib.cache import get_cache
+from stoqlib.lib.osutils import get_application_dir
+
+log = logging.getLogger(__name__)
+
+#: The maximum number of template strings kept compiled
+STRING_TEMPLATES_MAXSIZE = 128
+
+_TEMPLATE_ARGS = dict(output_encoding='utf8', input_encoding='utf8',
+                      default_filters=['h'])
+_lookup = None
+_lookup_lock = threading.Lock()
+_stats = dict(renders=0, loaded=0)
+
+
+def _get_module_filename(filename, uri):
+    # The source mtime is part of the module name, so a template
+    # installed with an older mtime than its cached module won't use it
+    mtime = os.path.getmtime(filename)
+    key = hashlib.sha1('%s:%r' % (filename, mtime)).hexdigest()
+    _stats['loaded'] += 1
+    log.info('Loading template %s' % (uri, ))
+    return os.path.join(get_application_dir(), 'templates',
+                        '%s.py' % (key, ))
+
+
+def get_template_lookup():
+    """Get the lookup used to find the template files
+
+    :returns: a :class:`mako.lookup.TemplateLookup`
+    """
+    global _lookup
+    with _lookup_lock:
+        if _lookup is None:
+            directories = environ.get_resource_filename('stoq', 'template')
+            _lookup = TemplateLookup(directories=directories,
+                                     modulename_callable=_get_module_filename,
+                                     **_TEMPLATE_ARGS)
+    return _lookup
+
+
+def get_template_stats():
+    """Get statistics about the templates
+
+    :returns: a dict with the number of ``renders`` of template files,
+      how many of them were ``loaded``, compiled or from the disk, and the
+      :meth:`stoqlib.lib.cache.Cache.get_stats` of the template ``strings``
+    """
+    stats = _stats.copy()
+    stats['strings'] = get_cache(
+        'templates', maxsize=STRING_TEMPLATES_MAXSIZE).get_stats()
+    return stats
+
 
 def render_template(filename, **ns):
     """Renders a template giving a filename and a keyword dictionary
@@ -34,11 +100,8 @@ def render_template(filename, **ns):
     @kwargs: keyword arguments to send to the template
     @return: the rendered template
     """
-    directories = environ.get_resource_filename('stoq', 'template')
-    lookup = TemplateLookup(directories=directories,
-                            output_encoding='utf8', input_encoding='utf8',
-                            default_filters=['h'])
-    tmpl = lookup.get_template(filename)
+    tmpl = get_template_lookup().get_template(filename)
+    _stats['renders'] += 1
 
     return tmpl.render(**ns)
 
@@ -49,6 +112,15 @@ def render_template_string(template, **ns):
     :param kwargs: keyword arguments to send to the template
     :return: the rendered template
     """
-    return Template(template,
-                    output_encoding='utf8', input_encoding='utf8',
-                    default_filters=['h']).render(**ns)
+    if isinstance(template, unicode):
+        key = hashlib.sha1(template.encode('utf-8')).hexdigest()
+    else:
+        key = hashlib.sha1(template).hexdigest()
+
+    cache = get_cache('templates', maxsize=STRING_TEMPLATES_MAXSIZE)
+    try:
+        tmpl = cache.get((key, ))
+    except KeyError:
+        tmpl = Template(template, **_TEMPLATE_ARGS)
+        cache.set((key, ), tmpl)
+    return tmpl.render(**ns)
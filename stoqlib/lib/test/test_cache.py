@@ -0,0 +1,151 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2013 Async Open Source
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+__tests__ = 'stoqlib.lib.cache'
+
+import gc
+import unittest
+
+import mock
+
+from stoqlib.lib.cache import Cache, get_cache
+from stoqlib.lib.decorators import cached_function, cached_property
+
+
+class _Object(object):
+    calls = 0
+
+    @cached_property()
+    def value(self):
+        self.calls += 1
+        return self.calls
+
+
+class _Subclass(_Object):
+    @cached_property()
+    def value(self):
+        return super(_Subclass, self).value * 10
+
+
+class _Slots(object):
+    __slots__ = ['calls']
+
+    def __init__(self):
+        self.calls = 0
+
+    @cached_property()
+    def value(self):
+        self.calls += 1
+        return self.calls
+
+
+class TestCache(unittest.TestCase):
+    def test_lru(self):
+        cache = Cache('test', maxsize=2)
+        cache.set(('a', ), 1)
+        cache.set(('b', ), 2)
+        self.assertEqual(cache.get(('a', )), 1)
+        cache.set(('c', ), 3)
+
+        # b was the least recently used
+        self.assertRaises(KeyError, cache.get, ('b', ))
+        self.assertEqual(cache.get(('a', )), 1)
+        self.assertEqual(cache.get(('c', )), 3)
+
+        stats = cache.get_stats()
+        self.assertEqual(stats['entries'], 2)
+        self.assertEqual(stats['hits'], 3)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['evictions'], 1)
+
+    def test_ttl(self):
+        cache = Cache('test')
+        with mock.patch('time.time', return_value=1000):
+            cache.set(('a', ), 1, ttl=10)
+            cache.set(('b', ), 2)
+        with mock.patch('time.time', return_value=1011):
+            self.assertRaises(KeyError, cache.get, ('a', ))
+            self.assertEqual(cache.get(('b', )), 2)
+        self.assertEqual(cache.get_stats()['expirations'], 1)
+
+    def test_invalidate(self):
+        cache = Cache('test')
+        cache.set(('a', 1), 1)
+        cache.set(('a', 2), 2)
+        cache.set(('b', 1), 3)
+        cache.invalidate(('a', ))
+        self.assertFalse(('a', 1) in cache)
+        self.assertFalse(('a', 2) in cache)
+        self.assertTrue(('b', 1) in cache)
+
+        cache.invalidate_on_commit(('b', ))
+        cache.commit()
+        self.assertEqual(len(cache), 0)
+
+
+class TestDecorators(unittest.TestCase):
+    def test_cached_property(self):
+        obj = _Object()
+        self.assertEqual(obj.value, 1)
+        self.assertEqual(obj.value, 1)
+        _Object.value.invalidate(obj)
+        self.assertEqual(obj.value, 2)
+
+        # The entry is gone when the object is
+        entries = len(get_cache())
+        del obj
+        gc.collect()
+        self.assertEqual(len(get_cache()), entries - 1)
+
+    def test_cached_property_subclass(self):
+        # The properties have the same module and name, but are cached
+        # separately
+        obj = _Subclass()
+        self.assertEqual(obj.value, 10)
+        self.assertEqual(super(_Subclass, obj).value, 1)
+        self.assertEqual(obj.value, 10)
+
+    def test_cached_property_without_weakref(self):
+        obj = _Slots()
+        entries = len(get_cache())
+        self.assertEqual(obj.value, 1)
+        self.assertEqual(obj.value, 2)
+        self.assertEqual(len(get_cache()), entries)
+
+    def test_cached_function(self):
+        calls = []
+
+        @cached_function()
+        def func(a, b):
+            calls.append((a, b))
+            return a + b
+
+        self.assertEqual(func(1, 2), 3)
+        self.assertEqual(func(1, 2), 3)
+        self.assertEqual(func(2, 2), 4)
+        self.assertEqual(calls, [(1, 2), (2, 2)])
+
+        func.invalidate(1)
+        self.assertEqual(func(1, 2), 3)
+        self.assertEqual(func(2, 2), 4)
+        self.assertEqual(calls, [(1, 2), (2, 2), (1, 2)])
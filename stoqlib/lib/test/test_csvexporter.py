@@ -0,0 +1,104 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2012 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+
+import datetime
+import os
+
+from kiwi.currency import currency
+from kiwi.ui.objectlist import Column
+
+from stoqlib.database.runtime import new_store
+from stoqlib.domain.sellable import Sellable
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.exporters.csvexporter import CSVExporter
+from stoqlib.exporters.streamexporter import ExportThread
+
+
+class Fruit:
+    def __init__(self, name, price, date):
+        self.name = name
+        self.price = price
+        self.date = date
+
+
+class CSVExporterTest(DomainTest):
+    def test_add_from_results(self):
+        columns = [Column('name', title='Name', data_type=str),
+                   Column('price', title='Price', data_type=currency),
+                   Column('date', title='Date', data_type=datetime.date),
+                   Column('hidden', title='Hidden', data_type=str,
+                          visible=False)]
+        fruits = [Fruit(u'Maçã', currency('4.5'), datetime.date(2014, 1, 2)),
+                  Fruit(u'Kiwi', currency('8'), None)]
+
+        progress = []
+        exporter = CSVExporter()
+        exporter.add_from_results(columns, fruits, progress=progress.append)
+        temporary = exporter.save()
+        try:
+            self.assertEqual(temporary.read(),
+                             'Name,Price,Date\r\n'
+                             'Ma\xc3\xa7\xc3\xa3,4.5,2014-01-02\r\n'
+                             'Kiwi,8,\r\n')
+        finally:
+            temporary.close()
+            os.unlink(temporary.name)
+        self.assertEqual(progress, [2])
+
+    def test_add_from_results_dotted_attribute(self):
+        columns = [Column('name', title='Name', data_type=str),
+                   Column('origin.name', title='Origin', data_type=str)]
+        fruit = Fruit(u'Kiwi', currency('8'), None)
+        fruit.origin = Fruit(u'Brasil', None, None)
+
+        exporter = CSVExporter()
+        exporter.add_from_results(columns, [fruit])
+        temporary = exporter.save()
+        try:
+            self.assertEqual(temporary.read(),
+                             'Name,Origin\r\n'
+                             'Kiwi,Brasil\r\n')
+        finally:
+            temporary.close()
+            os.unlink(temporary.name)
+
+    def test_export_thread(self):
+        columns = [Column('code', title='Code', data_type=str),
+                   Column('description', title='Description', data_type=str)]
+        progress = []
+        store = new_store()
+        results = store.find(Sellable).order_by(
+            Sellable.te_id).config(limit=2)
+        thread = ExportThread(CSVExporter(), columns, store, results,
+                              progress=progress.append)
+        thread.start()
+        thread.join()
+
+        self.assertIsNone(thread.error)
+        try:
+            lines = thread.temporary.read().splitlines()
+        finally:
+            thread.temporary.close()
+            os.unlink(thread.temporary.name)
+        self.assertEqual(lines[0], 'Code,Description')
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(progress, [2])
@@ -1,6 +1,8 @@
+import logging
 import unittest
 
-from stoqlib.lib.event import Event, _WeakRef
+from stoqlib.lib.event import (Event, _WeakRef, get_event_stats,
+                               reset_event_stats)
 
 
 class ReturnStatus:
@@ -127,3 +129,49 @@ class EventTest(unittest.TestCase):
         self.assertEqual(_WeakRef(xxx), _WeakRef(xxx))
         self.assertNotEqual(_WeakRef(xxx), _WeakRef(yyy))
         self.assertNotEqual(_WeakRef(xxx), zzz)
+
+    def test_stats(self):
+        class StatsEvent(Event):
+            pass
+
+        def callback():
+            pass
+
+        obj = TestObject()
+        StatsEvent.connect(callback)
+        StatsEvent.connect(obj.callback)
+        reset_event_stats()
+        StatsEvent.emit()
+        StatsEvent.emit()
+
+        stats = get_event_stats()['StatsEvent']
+        self.assertEqual(stats['calls'], 2)
+        self.assertEqual(
+            sorted((name, s['calls']) for name, s in
+                   stats['callbacks'].items()),
+            [('stoqlib.lib.test.test_event.TestObject.callback', 2),
+             ('stoqlib.lib.test.test_event.callback', 2)])
+
+        # The dead callbacks are removed
+        del obj
+        StatsEvent.emit()
+        self.assertEqual(len(StatsEvent._callbacks), 1)
+
+        reset_event_stats()
+        self.assertNotIn('StatsEvent', get_event_stats())
+
+    def test_lazy_logging(self):
+        class LogEvent(Event):
+            pass
+
+        class Argument(object):
+            def __repr__(self):
+                raise AssertionError("repr should not be called")
+
+        log = logging.getLogger('stoqlib.lib.event')
+        level = log.level
+        log.setLevel(logging.WARNING)
+        try:
+            LogEvent.emit(Argument())
+        finally:
+            log.setLevel(level)
@@ -25,7 +25,9 @@
 
 from decimal import Decimal
 
-from stoqlib.lib.parameters import sysparam
+from stoqlib.database.runtime import new_store
+from stoqlib.domain.parameter import ParameterData
+from stoqlib.lib.parameters import ParameterAccess, sysparam
 from stoqlib.domain.address import CityLocation
 from stoqlib.domain.person import (Branch, Client, Company, Employee,
                                    EmployeeRole, Individual, LoginUser,
@@ -200,3 +202,51 @@ class TestParameter(DomainTest):
     def test_default_area_code(self):
         param = self.sparam.get_int('DEFAULT_AREA_CODE')
         self.failUnless(isinstance(param, int), type(param))
+
+    def test_parsed_values(self):
+        param = ParameterAccess()
+        self.assertEqual(param.get_int('DEFAULT_AREA_CODE'),
+                         sysparam.get_int('DEFAULT_AREA_CODE'))
+        param.set_int(self.store, 'DEFAULT_AREA_CODE', 12)
+        self.assertEqual(param.get_int('DEFAULT_AREA_CODE'), 12)
+        param.set_bool(self.store, 'DEMO_MODE', True)
+        self.assertTrue(param.get_bool('DEMO_MODE'))
+        param.set_bool(self.store, 'DEMO_MODE', False)
+        self.assertFalse(param.get_bool('DEMO_MODE'))
+        self.assertRaises(ValueError, param.get_int, 'DEMO_MODE')
+
+    def test_get_object(self):
+        company = self.sparam.get_object(self.store, 'MAIN_COMPANY')
+        self.assertIs(self.sparam.get_object(self.store, 'MAIN_COMPANY'),
+                      company)
+
+        branch = self.create_branch()
+        self.sparam.set_object(self.store, 'MAIN_COMPANY', branch)
+        try:
+            self.assertIs(self.sparam.get_object(self.store, 'MAIN_COMPANY'),
+                          branch)
+        finally:
+            self.sparam.set_object(self.store, 'MAIN_COMPANY', company)
+
+    def test_process_notifications(self):
+        param = ParameterAccess()
+        param.listen(self.store)
+        self.addCleanup(param._listen_connection.close)
+        self.assertEqual(param.process_notifications(), [])
+        # Load the values, so that the notified ones get reloaded
+        param.get_int('DEFAULT_AREA_CODE')
+
+        def set_value(value):
+            with new_store() as store:
+                data = store.find(ParameterData,
+                                  field_name=u'DEFAULT_AREA_CODE').one()
+                old_value = data.field_value
+                data.field_value = value
+            return old_value
+
+        # The change is committed, so it needs to be undone
+        old_value = set_value(u'99')
+        self.addCleanup(set_value, old_value)
+        self.assertEqual(param.process_notifications(),
+                         [u'DEFAULT_AREA_CODE'])
+        self.assertEqual(param.get_int('DEFAULT_AREA_CODE'), 99)
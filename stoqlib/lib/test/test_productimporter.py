@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+"""Tests for module :class:`stoqlib.importers.productimporter`"""
+
+from StringIO import StringIO
+
+from stoqlib.domain.commission import CommissionSource
+from stoqlib.domain.product import ProductSupplierInfo, Storable
+from stoqlib.domain.sellable import Sellable, SellableCategory
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.exceptions import SellableError
+from stoqlib.importers.productimporter import ProductImporter
+
+CSV_DATA = """\
+% base_category, barcode, category, description, price,
+% cost, commission, commission2, markup, markup2 [, unit]
+Test Base,1111111111111,Test Category,Test Product 1,149,70,15,28,36,15
+Test Base,2222222222222,Test Category,Test Product 2,198,139,15,28,36,15
+Test Base,3333333333333,Other Category,Test Product 3,89,56,15,28,36,33,Kg
+"""
+
+
+class ProductImporterTest(DomainTest):
+
+    def _import(self, bulk, data=CSV_DATA):
+        importer = ProductImporter()
+        importer.feed(StringIO(data))
+        importer.set_dry(True)
+        importer.set_bulk(bulk)
+        importer.set_items_per_commit(2)
+        importer.process(self.store)
+
+        sellables = self.store.find(
+            Sellable, Sellable.description.startswith(u'Test Product'))
+        return sorted(sellables, key=lambda s: s.description)
+
+    def _check(self, sellables):
+        self.assertEqual(len(sellables), 3)
+        self.assertEqual(
+            self.store.find(SellableCategory,
+                            description=u'Test Base').count(), 1)
+        base_category = self.store.find(SellableCategory,
+                                        description=u'Test Base').one()
+        self.assertEqual(
+            self.store.find(CommissionSource,
+                            category=base_category).count(), 1)
+
+        s1, s2, s3 = sellables
+        self.assertEqual(s1.barcode, u'1111111111111')
+        self.assertEqual(s1.cost, 70)
+        self.assertEqual(s1.base_price, 149)
+        self.assertEqual(s1.commission, 15)
+        self.assertEqual(s1.status, Sellable.STATUS_AVAILABLE)
+        self.assertEqual(s1.category, s2.category)
+        self.assertEqual(s1.category.category, base_category)
+        self.assertNotEqual(s3.category, s1.category)
+        self.assertEqual(s3.unit.description, u'Kg')
+
+        for sellable in sellables:
+            product = sellable.product
+            self.assertTrue(product.manage_stock)
+            self.assertTrue(self.store.find(Storable, product=product).one())
+            info = self.store.find(ProductSupplierInfo, product=product).one()
+            self.assertTrue(info.is_main_supplier)
+            self.assertEqual(info.base_cost, sellable.cost)
+
+    def test_import(self):
+        self._check(self._import(bulk=False))
+
+    def test_import_bulk(self):
+        sellables = self._import(bulk=True)
+        self._check(sellables)
+        te_ids = set(s.te_id for s in sellables)
+        te_ids.update(s.product.te_id for s in sellables)
+        self.assertEqual(len(te_ids), 6)
+
+    def test_import_bulk_duplicated_barcode(self):
+        # Between the imported rows
+        data = CSV_DATA.replace('2222222222222', '1111111111111')
+        with self.assertRaisesRegexp(SellableError, '1111111111111'):
+            self._import(bulk=True, data=data)
+        with self.assertRaisesRegexp(SellableError, '1111111111111'):
+            self._import(bulk=False, data=data)
+
+    def test_import_bulk_existing_values(self):
+        sellable = self.create_sellable()
+        sellable.barcode = u'3333333333333'
+        with self.assertRaisesRegexp(SellableError, '3333333333333'):
+            self._import(bulk=True)
+
+        sellable.barcode = u''
+        sellable.code = u'02'
+        with self.assertRaisesRegexp(SellableError, "u?'02'"):
+            self._import(bulk=True)
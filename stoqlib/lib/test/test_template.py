@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2013 Async Open Source
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+__tests__ = 'stoqlib.lib.template'
+
+import unittest
+
+from stoqlib.lib.template import (get_template_lookup, get_template_stats,
+                                  render_template_string)
+
+
+class TemplateTest(unittest.TestCase):
+
+    def test_render_template_string(self):
+        before = get_template_stats()['strings']
+        for name in [u'Apple', u'Kiwi & Melon']:
+            self.assertEqual(
+                render_template_string(u'<b>${name}</b>', name=name),
+                '<b>%s</b>' % (name.replace('&', '&amp;'), ))
+
+        stats = get_template_stats()['strings']
+        self.assertEqual(stats['misses'] - before['misses'], 1)
+        self.assertEqual(stats['hits'] - before['hits'], 1)
+
+    def test_get_template_lookup(self):
+        lookup = get_template_lookup()
+        self.assertIs(get_template_lookup(), lookup)
+
+        template = lookup.get_template('objectlist.html')
+        self.assertIs(lookup.get_template('objectlist.html'), template)
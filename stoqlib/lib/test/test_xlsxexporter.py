@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2012 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU Lesser General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+
+import datetime
+import os
+import zipfile
+
+from kiwi.currency import currency
+
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.exporters.xlsxexporter import XLSXExporter
+
+
+class XLSXExporterTest(DomainTest):
+    def test_add_cells(self):
+        exporter = XLSXExporter(u'Fruits')
+        exporter.set_column_headers([u'Name', u'Price', u'Date'])
+        exporter.add_cells([[u'Apple & Kiwi', currency('4.5'),
+                             datetime.date(2014, 1, 2)],
+                            [u'Melon', 5, None]])
+        temporary = exporter.save()
+        try:
+            zf = zipfile.ZipFile(temporary)
+            self.assertIn('<sheet name="Fruits"',
+                          zf.read('xl/workbook.xml'))
+            sheet = zf.read('xl/worksheets/sheet1.xml')
+            zf.close()
+        finally:
+            temporary.close()
+            os.unlink(temporary.name)
+
+        self.assertIn(
+            '<row r="2">'
+            '<c r="A2" s="0" t="inlineStr"><is><t>Apple &amp; Kiwi</t></is></c>'
+            '<c r="B2" s="4"><v>4.5</v></c>'
+            '<c r="C2" s="2"><v>41641</v></c>'
+            '</row>', sheet)
+        self.assertIn(
+            '<row r="3">'
+            '<c r="A3" s="0" t="inlineStr"><is><t>Melon</t></is></c>'
+            '<c r="B3" s="0"><v>5</v></c>'
+            '</row>', sheet)
+        self.assertEqual(exporter.n_rows, 2)
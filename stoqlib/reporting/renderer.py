@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+##
+## Copyright (C) 2014 Async Open Source
+##
+## This program is free software; you can redistribute it and/or
+## modify it under the terms of the GNU Lesser General Public License
+## as published by the Free Software Foundation; either version 2
+## of the License, or (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU Lesser General Public License for more details.
+##
+## You should have received a copy of the GNU Lesser General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+"""Renders large table reports on worker processes
+
+Laying out a table with tens of thousands of rows takes weasyprint
+minutes and a lot of memory, all of it in the process that asked for
+the report. :func:`render_report` splits the rows of a
+:class:`stoqlib.reporting.report.TableReport` in chunks, renders each
+chunk to a pdf on a pool of processes and merges the pages of the chunks
+in a single pdf, numbering them. Each chunk starts on a new page, so the
+last page of every chunk but the last one is only partly filled, once
+every :obj:`CHUNK_ROWS` rows::
+
+    render_report(report, '/tmp/report.pdf',
+                  progress=lambda done, total: ...)
+
+The rendered reports are kept for a while on the application directory,
+so printing the same search again with the same parameters only copies
+the pdf.
+"""
+
+import hashlib
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+
+from kiwi.environ import environ
+
+from stoqlib.lib.cache import get_cache
+from stoqlib.lib.osutils import get_application_dir
+from stoqlib.lib.translation import stoqlib_gettext
+
+_ = stoqlib_gettext
+log = logging.getLogger(__name__)
+
+#: Reports with less rows than this are rendered in process, at once
+CHUNKED_MIN_ROWS = 2000
+#: The number of rows rendered by each worker at a time. Each chunk
+#: starts on a new page of the merged pdf
+CHUNK_ROWS = 500
+#: How many rendered reports are kept
+REPORTS_CACHE_SIZE = 16
+#: For how long, in seconds, a rendered report is kept
+REPORTS_CACHE_TTL = 10 * 60
+
+# The margin of the pages, as in base.css, in points
+_PAGE_MARGIN = 15 * 72 / 25.4
+_PAGE_LABEL_SIZE = 8
+
+
+def get_render_jobs():
+    """Get how many processes should render a report
+
+    :returns: the number of processors, at least 1
+    """
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def _render_chunk(task):
+    # This runs on the workers, so it should only depend on the task
+    import weasyprint
+    index, html, base_url, stylesheet, filename = task
+    document = weasyprint.HTML(string=html, base_url=base_url).render(
+        stylesheets=[weasyprint.CSS(string=stylesheet)])
+    document.write_pdf(filename)
+    return index, len(document.pages)
+
+
+def _get_reports_dir():
+    directory = os.path.join(get_application_dir(), 'reports')
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    return directory
+
+
+def _clean_reports_dir(directory):
+    # Other instances may be sharing the directory, so the files are
+    # removed by their age and count instead of when the cache drops them
+    files = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        try:
+            files.append((os.path.getmtime(path), path))
+        except OSError:
+            continue
+    files.sort(reverse=True)
+
+    oldest = time.time() - REPORTS_CACHE_TTL
+    for i, (mtime, path) in enumerate(files):
+        if i < REPORTS_CACHE_SIZE and mtime >= oldest:
+            continue
+        try:
+            os.unlink(path)
+        except OSError as e:
+            log.info('Could not remove cached report %s: %s' % (path, e))
+
+
+def _get_report_key(report, chunks, stylesheet):
+    digest = hashlib.sha1()
+    digest.update(type(report).__name__)
+    digest.update(stylesheet.encode('utf-8'))
+    for html in chunks:
+        if isinstance(html, unicode):
+            html = html.encode('utf-8')
+        digest.update(html)
+    return ('report', digest.hexdigest())
+
+
+def _render_chunks(chunks, directory, filename, base_url, stylesheet,
+                   progress, jobs):
+    total = len(chunks)
+    tasks = [(i, html, base_url, stylesheet,
+              os.path.join(directory, '%d.pdf' % (i, )))
+             for i, html in enumerate(chunks)]
+
+    jobs = min(jobs or get_render_jobs(), total)
+    pool = None
+    if jobs > 1:
+        pool = multiprocessing.Pool(jobs)
+        results = pool.imap_unordered(_render_chunk, tasks)
+    else:
+        results = itertools.imap(_render_chunk, tasks)
+
+    try:
+        for done, (index, chunk_pages) in enumerate(results, 1):
+            log.debug('Rendered chunk %d of %d, %d pages' % (
+                index + 1, total, chunk_pages))
+            if progress is not None:
+                progress(done, total)
+    finally:
+        if pool is not None:
+            pool.terminate()
+
+    return merge_pdfs([task[4] for task in tasks], filename)
+
+
+def merge_pdfs(filenames, filename, number_pages=True):
+    """Merges the pages of some pdfs in a single one
+
+    :param filenames: the pdfs to merge, in order
+    :param filename: the merged pdf
+    :param number_pages: if the pages should be numbered at their
+      bottom right corner, the same way the reports do
+    :returns: the number of pages of the merged pdf
+    """
+    import cairo
+    import poppler
+
+    pages = []
+    for name in filenames:
+        document = poppler.document_new_from_file(
+            'file://' + os.path.abspath(name), password='')
+        pages.extend(document.get_page(i)
+                     for i in range(document.get_n_pages()))
+
+    surface = None
+    for i, page in enumerate(pages, 1):
+        width, height = page.get_size()
+        if surface is None:
+            surface = cairo.PDFSurface(filename, width, height)
+        else:
+            surface.set_size(width, height)
+        cr = cairo.Context(surface)
+        page.render_for_printing(cr)
+
+        if number_pages:
+            label = '%s %d %s %d' % (_("Page"), i, _("of"), len(pages))
+            cr.select_font_face('sans-serif')
+            cr.set_font_size(_PAGE_LABEL_SIZE)
+            extents = cr.text_extents(label)
+            cr.move_to(width - _PAGE_MARGIN - extents[4],
+                       height - _PAGE_MARGIN / 2)
+            cr.set_source_rgb(0, 0, 0)
+            cr.show_text(label)
+        cr.show_page()
+
+    if surface is not None:
+        surface.finish()
+    return len(pages)
+
+
+def render_report(report, filename, stylesheet='', progress=None, jobs=None):
+    """Renders a table report to a pdf on worker processes
+
+    :param report: a :class:`stoqlib.reporting.report.TableReport`
+    :param filename: the name of the pdf
+    :param stylesheet: css applied to all the chunks, like the page
+      size chosen when printing
+    :param progress: if not ``None``, a callable called with the number
+      of chunks rendered and the total number of chunks
+    :param jobs: how many processes render the chunks, defaults to
+      :func:`get_render_jobs`
+    :returns: the number of pages of the pdf
+    """
+    chunks = report.get_html_chunks(CHUNK_ROWS)
+    total = len(chunks)
+
+    cache = get_cache('reports', maxsize=REPORTS_CACHE_SIZE)
+    key = _get_report_key(report, chunks, stylesheet)
+    try:
+        cached, n_pages = cache.get(key)
+    except KeyError:
+        cached = None
+    if cached is not None and os.path.exists(cached):
+        shutil.copyfile(cached, filename)
+        if progress is not None:
+            progress(total, total)
+        return n_pages
+
+    base_url = environ.get_resource_filename('stoq', 'template')
+    directory = tempfile.mkdtemp(prefix='stoq-report-')
+    try:
+        n_pages = _render_chunks(chunks, directory, filename, base_url,
+                                 stylesheet, progress, jobs)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    reports_dir = _get_reports_dir()
+    cached = os.path.join(reports_dir, '%s.pdf' % (key[1], ))
+    shutil.copyfile(filename, cached)
+    cache.set(key, (cached, n_pages), ttl=REPORTS_CACHE_TTL)
+    _clean_reports_dir(reports_dir)
+    return n_pages
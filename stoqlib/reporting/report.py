@@ -31,6 +31,7 @@ from stoqlib.lib.translation import stoqlib_gettext, stoqlib_ngettext
 from stoqlib.lib.formatters import (get_formatted_price, get_formatted_cost,
                                     format_quantity, format_phone_number,
                                     get_formatted_percentage)
+from stoqlib.reporting.renderer import CHUNKED_MIN_ROWS, render_report
 from stoqlib.reporting.utils import get_logo_data
 _ = stoqlib_gettext
 
@@ -54,9 +55,10 @@ class HTMLReport(object):
             'format_date': lambda d: d and d.strftime('%x') or '',
         }
 
-    def get_html(self):
+    def get_html(self, **extra):
         assert self.title
         namespace = self.get_namespace()
+        namespace.update(extra)
         # Set some defaults if the report did not provide one
         namespace.setdefault('subtitle', '')
         namespace.setdefault('notes', [])
@@ -170,6 +172,62 @@ class TableReport(HTMLReport):
                 notes.append(filter_string)
         self.notes = notes
 
+    def get_html(self, **extra):
+        if 'rows' not in extra:
+            extra['rows'] = self.get_data()
+            extra['get_summary_row'] = self.get_summary_row
+        extra.setdefault('show_header', True)
+        extra.setdefault('page_numbers', True)
+        extra.setdefault('last_chunk', True)
+        return HTMLReport.get_html(self, **extra)
+
+    def get_html_chunks(self, rows_per_chunk):
+        """Get the html of the report split in chunks of rows
+
+        Each chunk is a complete html document that can be rendered on its
+        own. Only the first one has the header and only the last one has
+        the summary row and the ``after_table`` block, templates that
+        override it should check ``last_chunk``. The chunks don't have
+        page numbers, since they can only be known after all of them are
+        rendered, see :mod:`stoqlib.reporting.renderer`.
+
+        Since the chunks are laid out separately, each one starts on a new
+        page when they are merged, and the last page of all of them but
+        the last is usually not filled up. The rows are not split on page
+        boundaries because those depend on the height of each row, which
+        is only known after the layout.
+
+        :param rows_per_chunk: the maximum number of rows on each chunk
+        :returns: a list of html strings
+        """
+        rows = list(self.get_data())
+        summary = self.get_summary_row()
+        starts = range(0, len(rows), rows_per_chunk) or [0]
+        chunks = []
+        for i, start in enumerate(starts):
+            last = i == len(starts) - 1
+            chunks.append(self.get_html(
+                rows=rows[start:start + rows_per_chunk],
+                get_summary_row=lambda last=last: summary if last else [],
+                show_header=i == 0,
+                page_numbers=False,
+                last_chunk=last))
+        return chunks
+
+    def save(self, progress=None):
+        """Saves the report as a pdf
+
+        Reports with more than :obj:`CHUNKED_MIN_ROWS` rows are rendered
+        on worker processes by :func:`render_report`.
+
+        :param progress: if not ``None``, a callable called with the
+          number of chunks rendered and the total, only for large reports
+        """
+        if len(self.data) < CHUNKED_MIN_ROWS:
+            HTMLReport.save(self)
+        else:
+            render_report(self, self.filename, progress=progress)
+
     def get_data(self):
         self.reset()
         for obj in self.data:
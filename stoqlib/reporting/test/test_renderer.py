@@ -0,0 +1,190 @@
+# -*- Mode: Python; coding: utf-8 -*-
+# vi:si:et:sw=4:sts=4:ts=4
+
+##
+## Copyright (C) 2014 Async Open Source <http://www.async.com.br>
+## All rights reserved
+##
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., or visit: http://www.gnu.org/.
+##
+## Author(s): Stoq Team <stoq-devel@async.com.br>
+##
+
+import os
+import shutil
+import tempfile
+import time
+
+import mock
+
+from stoqlib.domain.test.domaintest import DomainTest
+from stoqlib.lib.cache import get_cache
+from stoqlib.reporting.renderer import render_report, _clean_reports_dir
+from stoqlib.reporting.report import TableReport
+
+
+class _NumbersReport(TableReport):
+    title = 'Numbers'
+
+    def get_columns(self):
+        return [dict(title='Number', align='right')]
+
+    def get_row(self, obj):
+        return [str(obj)]
+
+    def reset(self):
+        self.total = 0
+
+    def accumulate(self, row):
+        self.total += row
+
+    def get_summary_row(self):
+        return ['Total: %d' % (self.total, )]
+
+
+class _BranchNumbersReport(_NumbersReport):
+    template_filename = 'sale/sold_items_by_branch.html'
+
+    def reset(self):
+        _NumbersReport.reset(self)
+        self.branch_total = {}
+        self.branch_quantity = {}
+
+    def accumulate(self, row):
+        _NumbersReport.accumulate(self, row)
+        branch = 'Even' if row % 2 == 0 else 'Odd'
+        self.branch_total.setdefault(branch, 0)
+        self.branch_quantity.setdefault(branch, 0)
+        self.branch_total[branch] += row
+        self.branch_quantity[branch] += 1
+
+
+def _render_chunk(task):
+    index, html, base_url, stylesheet, filename = task
+    open(filename, 'w').write(html.encode('utf-8'))
+    return index, 1
+
+
+def _merge_pdfs(filenames, filename):
+    with open(filename, 'w') as f:
+        for name in filenames:
+            f.write(open(name).read())
+    return len(filenames)
+
+
+class RendererTest(DomainTest):
+    def setUp(self):
+        super(RendererTest, self).setUp()
+        get_cache('reports').invalidate()
+        fd, self.filename = tempfile.mkstemp(suffix='.pdf')
+        os.close(fd)
+        self.addCleanup(os.unlink, self.filename)
+
+        self.app_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.app_dir)
+        patcher = mock.patch('stoqlib.reporting.renderer.get_application_dir',
+                             return_value=self.app_dir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_html_chunks(self):
+        report = _NumbersReport(self.filename, [1, 2, 3, 4, 5])
+        chunks = report.get_html_chunks(2)
+        self.assertEqual(len(chunks), 3)
+        self.assertIn('<header>', chunks[0])
+        self.assertNotIn('<header>', chunks[1])
+        self.assertNotIn('Total: 15', chunks[1])
+        self.assertIn('Total: 15', chunks[2])
+        for chunk in chunks:
+            self.assertNotIn('counter(pages)', chunk)
+
+        html = report.get_html()
+        self.assertIn('<header>', html)
+        self.assertIn('counter(pages)', html)
+        self.assertIn('Total: 15', html)
+
+    def test_get_html_chunks_after_table(self):
+        report = _BranchNumbersReport(self.filename, [1, 2, 3, 4, 5])
+        chunks = report.get_html_chunks(2)
+        self.assertEqual(len(chunks), 3)
+        for chunk in chunks[:2]:
+            self.assertNotIn('Totals by branch', chunk)
+        self.assertEqual(chunks[2].count('Totals by branch'), 1)
+        for chunk in chunks:
+            self.assertNotIn('counter(pages)', chunk)
+
+        html = report.get_html()
+        self.assertIn('Totals by branch', html)
+        self.assertIn('counter(pages)', html)
+
+    @mock.patch('stoqlib.reporting.renderer.CHUNK_ROWS', 2)
+    @mock.patch('stoqlib.reporting.renderer.merge_pdfs', _merge_pdfs)
+    @mock.patch('stoqlib.reporting.renderer._render_chunk')
+    def test_render_report(self, render_chunk):
+        render_chunk.side_effect = _render_chunk
+        report = _NumbersReport(self.filename, range(5))
+        progress = mock.Mock()
+        n_pages = render_report(report, self.filename, progress=progress,
+                                jobs=1)
+        self.assertEqual(n_pages, 3)
+        self.assertEqual(progress.call_args_list,
+                         [mock.call(1, 3), mock.call(2, 3), mock.call(3, 3)])
+        self.assertEqual(render_chunk.call_count, 3)
+        rendered = open(self.filename).read()
+
+        # The same report is not rendered again
+        progress.reset_mock()
+        os.unlink(self.filename)
+        n_pages = render_report(report, self.filename, progress=progress,
+                                jobs=1)
+        self.assertEqual(n_pages, 3)
+        self.assertEqual(render_chunk.call_count, 3)
+        progress.assert_called_once_with(3, 3)
+        self.assertEqual(open(self.filename).read(), rendered)
+
+        # But it is if the rows change
+        report = _NumbersReport(self.filename, range(6))
+        render_report(report, self.filename, jobs=1)
+        self.assertEqual(render_chunk.call_count, 6)
+        self.assertEqual(len(os.listdir(os.path.join(self.app_dir,
+                                                     'reports'))), 2)
+
+    @mock.patch('stoqlib.reporting.renderer._render_chunk')
+    def test_render_report_error(self, render_chunk):
+        render_chunk.side_effect = ValueError
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory, ignore_errors=True)
+        report = _NumbersReport(self.filename, range(5))
+        with mock.patch('tempfile.mkdtemp', return_value=directory):
+            with self.assertRaises(ValueError):
+                render_report(report, self.filename, jobs=1)
+        # The directory of the chunks is removed
+        self.assertFalse(os.path.exists(directory))
+
+    @mock.patch('stoqlib.reporting.renderer.REPORTS_CACHE_SIZE', 2)
+    def test_clean_reports_dir(self):
+        names = ['%d.pdf' % (i, ) for i in range(4)]
+        for i, name in enumerate(names):
+            path = os.path.join(self.app_dir, name)
+            open(path, 'w').close()
+            mtime = time.time() - i
+            os.utime(path, (mtime, mtime))
+        old = os.path.join(self.app_dir, names[1])
+        os.utime(old, (0, 0))
+
+        # The expired reports and the ones exceeding the size are removed
+        _clean_reports_dir(self.app_dir)
+        self.assertEqual(sorted(os.listdir(self.app_dir)),
+                         [names[0], names[2]])